@@ -0,0 +1 @@
+"""Offline benchmarks of the SocialMediaDownload plugin; run with ``python -m benchmarks``."""
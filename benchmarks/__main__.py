@@ -0,0 +1,213 @@
+"""Offline end-to-end benchmark of the SocialMediaDownload plugin.
+
+Runs the plugin against local stub upstreams and a fake Matrix client and reports throughput, latency and peak
+memory for a synthetic mix of links. Run from the repository root::
+
+    python -m benchmarks --messages 200 --concurrency 16 --mix reddit_image=3,bluesky_video=1
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import aiohttp
+
+from .fakes import BenchConfig, FakeClient, FakeMessageEvent
+from .stubs import RewritingSession, StubSettings, run_in_process, stub_base
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: Link templates by traffic kind; {n} is replaced with a unique number.
+LINKS = {
+    "reddit_image": "https://www.reddit.com/r/bench/comments/img{n}",
+    "reddit_video": "https://www.reddit.com/r/bench/comments/vid{n}",
+    "reddit_gallery": "https://www.reddit.com/r/bench/comments/gal{n}",
+    "youtube": "https://www.youtube.com/watch?v=bench{n}",
+    "tiktok": "https://www.tiktok.com/@bench/video/{n}",
+    "bluesky_image": "https://bsky.app/profile/bench.bsky.social/post/img{n}",
+    "bluesky_video": "https://bsky.app/profile/bench.bsky.social/post/vid{n}",
+    "aparat": "https://www.aparat.com/v/bench{n}",
+}
+
+DEFAULT_MIX = "reddit_image=4,reddit_video=1,reddit_gallery=1,youtube=2,tiktok=1,bluesky_image=1,bluesky_video=1,aparat=1"
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in LINKS:
+            raise argparse.ArgumentTypeError(f"unknown traffic kind {kind!r}, expected one of {', '.join(LINKS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def parse_override(value: str) -> Tuple[str, object]:
+    key, sep, raw = value.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected key=value")
+    try:
+        return key, json.loads(raw)
+    except ValueError:
+        return key, raw
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def make_plugin(client: FakeClient, http, config: BenchConfig):
+    sys.path.insert(0, ROOT)
+    # pylint:disable=import-outside-toplevel
+    from socialmediadownload import SocialMediaDownloadPlugin
+
+    # maubot's loader normally constructs the plugin; only the attributes the plugin uses are filled in here.
+    plugin = SocialMediaDownloadPlugin.__new__(SocialMediaDownloadPlugin)
+    plugin.client = client
+    plugin.http = http
+    plugin.config = config
+    plugin.database = None
+    plugin.id = "benchmark"
+    plugin.log = logging.getLogger("benchmark.plugin")
+    plugin.loop = asyncio.get_running_loop()
+    return plugin
+
+
+async def run(args: argparse.Namespace) -> dict:
+    settings = StubSettings(latency=args.latency / 1000, bandwidth=args.bandwidth, image_size=args.image_size,
+                            video_size=args.video_size, segments=args.segments)
+    parent_conn, child_conn = multiprocessing.Pipe()
+    # The stubs run in their own process so that they neither share the event loop nor count towards peak RSS.
+    stub_process = multiprocessing.Process(target=run_in_process, args=(settings, child_conn), daemon=True)
+    stub_process.start()
+    port = parent_conn.recv()
+
+    overrides = {
+        "data_directory": args.data_dir,
+        # There is no database to remember blobs or jobs in.
+        "deduplicate": False,
+        "journal.enabled": False,
+        **{f"{kind.split('_')[0]}.enabled": True for kind in args.mix},
+        **dict(args.set),
+    }
+    config = BenchConfig(os.path.join(ROOT, "base-config.yaml"), overrides)
+    client = FakeClient()
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*args.mix.items())
+    messages = [(kind, LINKS[kind].format(n=i)) for i, kind in
+                enumerate(rng.choices(kinds, weights, k=args.warmup + args.messages))]
+
+    latencies: Dict[str, List[float]] = {kind: [] for kind in kinds}
+    errors = 0
+    async with aiohttp.ClientSession() as session:
+        plugin = make_plugin(client, RewritingSession(session, stub_base(port)), config)
+        await plugin.start()
+
+        async def handle(i: int, link: str) -> float:
+            nonlocal errors
+            evt = FakeMessageEvent.text(client, f"!room{i % args.rooms}:localhost", f"$bench{i}", link)
+            start = time.perf_counter()
+            try:
+                await plugin.on_message(evt)
+            except Exception:
+                errors += 1
+                logging.getLogger("benchmark").exception(f"Message {link} failed")
+            return time.perf_counter() - start
+
+        try:
+            # Warm up connection pools and worker processes before measuring.
+            for i, (_, link) in enumerate(messages[:args.warmup]):
+                await handle(i, link)
+            errors = 0
+            uploads_before, sent_before, bytes_before = len(client.uploads), len(client.sent), client.uploaded_bytes
+
+            queue = list(enumerate(messages))[args.warmup:][::-1]
+
+            async def worker():
+                while queue:
+                    i, (kind, link) = queue.pop()
+                    latencies[kind].append(await handle(i, link))
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - start
+        finally:
+            await plugin.stop()
+    stub_process.kill()
+
+    everything = [latency for values in latencies.values() for latency in values]
+    return {
+        "messages": len(everything),
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "messages_per_second": len(everything) / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(everything, 0.5) * 1000,
+        "latency_p99_ms": percentile(everything, 0.99) * 1000,
+        "by_kind": {kind: {"messages": len(values),
+                           "latency_p50_ms": percentile(values, 0.5) * 1000,
+                           "latency_p99_ms": percentile(values, 0.99) * 1000}
+                    for kind, values in latencies.items() if values},
+        "uploads": len(client.uploads) - uploads_before,
+        "uploaded_bytes": client.uploaded_bytes - bytes_before,
+        "events_sent": len(client.sent) - sent_before,
+        # ru_maxrss is in kilobytes on Linux.
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def print_report(result: dict) -> None:
+    print(f"messages        {result['messages']} ({result['errors']} failed) in {result['elapsed_seconds']:.2f}s")
+    print(f"throughput      {result['messages_per_second']:.2f} messages/s")
+    print(f"latency         p50 {result['latency_p50_ms']:.1f} ms, p99 {result['latency_p99_ms']:.1f} ms")
+    print(f"uploads         {result['uploads']} ({result['uploaded_bytes'] / 1024 / 1024:.1f} MiB), "
+          f"{result['events_sent']} events sent")
+    print(f"peak RSS        {result['peak_rss_bytes'] / 1024 / 1024:.1f} MiB")
+    for kind, stats in sorted(result["by_kind"].items()):
+        print(f"  {kind:<15} {stats['messages']:>5} messages  p50 {stats['latency_p50_ms']:8.1f} ms  "
+              f"p99 {stats['latency_p99_ms']:8.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=100, help="messages to measure")
+    parser.add_argument("--warmup", type=int, default=5, help="messages sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=8, help="messages handled at the same time")
+    parser.add_argument("--rooms", type=int, default=4, help="rooms the messages are spread over")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"weighted traffic kinds (default: {DEFAULT_MIX})")
+    parser.add_argument("--latency", type=float, default=50, help="upstream response latency in ms")
+    parser.add_argument("--bandwidth", type=int, default=0, help="upstream bytes/s per response, 0 for unlimited")
+    parser.add_argument("--image-size", type=int, default=512 * 1024, help="bytes per image")
+    parser.add_argument("--video-size", type=int, default=8 * 1024 * 1024, help="bytes per video")
+    parser.add_argument("--segments", type=int, default=8, help="HLS segments per Bluesky video")
+    parser.add_argument("--set", type=parse_override, action="append", default=[], metavar="KEY=VALUE",
+                        help="override a plugin config key, e.g. --set transcode.enabled=true")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the traffic mix")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the plugin's log")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    with tempfile.TemporaryDirectory(prefix="smd-benchmark-") as data_dir:
+        args.data_dir = data_dir
+        result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
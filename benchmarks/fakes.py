@@ -0,0 +1,99 @@
+"""Stand-ins for the maubot runtime: configuration, Matrix client and message events."""
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from mautrix.types import EventType, MessageType, TextMessageEventContent
+from ruamel.yaml import YAML
+
+
+class BenchConfig:
+    """The plugin's base-config.yaml with overrides, accessed with dotted keys like :class:`BaseProxyConfig`."""
+
+    def __init__(self, path: str, overrides: Optional[Dict[str, Any]] = None):
+        with open(path, encoding="utf-8") as file:
+            self._data = YAML(typ="safe").load(file)
+        for key, value in (overrides or {}).items():
+            self[key] = value
+
+    def load_and_update(self) -> None:
+        pass
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._data
+        for part in key.split("."):
+            value = value[part]
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        *parents, last = key.split(".")
+        target = self._data
+        for part in parents:
+            target = target.setdefault(part, {})
+        target[last] = value
+
+
+@dataclass
+class MediaRepoConfig:
+    upload_size: int = 100 * 1024 * 1024
+
+
+class FakeClient:
+    """Records uploads and sent events instead of talking to a homeserver."""
+
+    def __init__(self, mxid: str = "@bench:localhost", upload_size: int = 100 * 1024 * 1024):
+        self.mxid = mxid
+        self.upload_size = upload_size
+        self.uploads: List[Tuple[str, int]] = []
+        self.sent: List[Tuple[str, Any]] = []
+        self.receipts = 0
+
+    async def get_media_repo_config(self) -> MediaRepoConfig:
+        return MediaRepoConfig(self.upload_size)
+
+    async def upload_media(self, data, mime_type: Optional[str] = None, filename: Optional[str] = None,
+                           size: Optional[int] = None) -> str:
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            received = len(data)
+        else:
+            received = 0
+            async for chunk in data:
+                received += len(chunk)
+        self.uploads.append((mime_type, received))
+        return f"mxc://localhost/bench{len(self.uploads)}"
+
+    async def send_message_event(self, room_id: str, event_type: EventType, content: Any, **kwargs) -> str:
+        self.sent.append((room_id, content))
+        return f"$sent{len(self.sent)}"
+
+    @property
+    def uploaded_bytes(self) -> int:
+        return sum(size for _, size in self.uploads)
+
+
+@dataclass
+class FakeMessageEvent:
+    """The parts of maubot's ``MessageEvent`` that the plugin uses."""
+
+    client: FakeClient
+    room_id: str
+    event_id: str
+    sender: str
+    content: TextMessageEventContent
+    timestamp: int = field(default_factory=lambda: int(time.time() * 1000))
+
+    @classmethod
+    def text(cls, client: FakeClient, room_id: str, event_id: str, body: str,
+             sender: str = "@user:localhost") -> "FakeMessageEvent":
+        return cls(client, room_id, event_id, sender, TextMessageEventContent(msgtype=MessageType.TEXT, body=body))
+
+    async def mark_read(self) -> None:
+        self.client.receipts += 1
+
+    async def reply(self, content, **kwargs) -> str:
+        if isinstance(content, str):
+            content = TextMessageEventContent(msgtype=MessageType.NOTICE, body=content)
+        return await self.client.send_message_event(self.room_id, EventType.ROOM_MESSAGE, content)
+
+    async def respond(self, content, **kwargs) -> str:
+        return await self.reply(content, **kwargs)
@@ -0,0 +1,250 @@
+"""Local stand-ins for the upstream services the plugin talks to.
+
+All services are served by a single aiohttp application. :class:`RewritingSession` sends every request of the
+plugin to it, with the original host as the first path segment, so ``https://www.reddit.com/r/x.json`` becomes
+``http://127.0.0.1:<port>/www.reddit.com/r/x.json``.
+"""
+import asyncio
+import re
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import yarl
+from aiohttp import ClientSession, web
+
+LISTEN_HOST = "127.0.0.1"
+
+
+@dataclass
+class StubSettings:
+    #: Seconds every response is delayed by before its headers are sent.
+    latency: float = 0.05
+    #: Bytes per second each media response is throttled to; 0 for unlimited.
+    bandwidth: int = 0
+    image_size: int = 512 * 1024
+    video_size: int = 8 * 1024 * 1024
+    #: Number of HLS segments the Bluesky videos are split into.
+    segments: int = 8
+    chunk_size: int = 64 * 1024
+
+
+def png_header(width: int = 1280, height: int = 720) -> bytes:
+    ihdr = b"IHDR" + struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + ihdr + struct.pack(">I", zlib.crc32(ihdr))
+
+
+MP4_HEADER = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom"
+
+
+class StubUpstreams:
+    """The request handlers of the stub services.
+
+    Media bodies are a format header followed by the resource name and zero padding, so that every resource has
+    distinct content (and a distinct hash) without the stub having to hold it in memory.
+    """
+
+    def __init__(self, settings: StubSettings):
+        self.settings = settings
+        self._zeros = bytes(settings.chunk_size)
+        self.routes = {
+            "reddit.com": self.reddit,
+            "www.reddit.com": self.reddit,
+            "sd.rapidsave.com": self.rapidsave,
+            "ttdownloader.com": self.ttdownloader,
+            "www.youtube.com": self.youtube,
+            "img.youtube.com": self.youtube_image,
+            "public.api.bsky.app": self.bluesky,
+            "video.bsky.app": self.bluesky_video,
+            "www.aparat.com": self.aparat,
+            "i.redd.it": self.media,
+            "media.bench": self.media,
+        }
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/{host}/{path:.*}", self.dispatch)
+        return app
+
+    async def dispatch(self, request: web.Request) -> web.StreamResponse:
+        handler = self.routes.get(request.match_info["host"])
+        if handler is None:
+            raise web.HTTPNotFound()
+        await asyncio.sleep(self.settings.latency)
+        return await handler(request, "/" + request.match_info["path"])
+
+    async def send_payload(self, request: web.Request, header: bytes, name: str, size: int,
+                           content_type: str) -> web.StreamResponse:
+        prefix = header + name.encode("utf-8")
+        size = max(size, len(prefix))
+        start, end, status = 0, size, 200
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        if match and request.headers.get("If-Range", f'"{name}"') == f'"{name}"':
+            start = int(match.group(1))
+            end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            status = 206
+        response = web.StreamResponse(status=status, headers={
+            "Content-Type": content_type,
+            "Accept-Ranges": "bytes",
+            "ETag": f'"{name}"',
+        })
+        if status == 206:
+            response.headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        response.content_length = end - start
+        await response.prepare(request)
+        position = start
+        while position < end:
+            if position < len(prefix):
+                chunk = prefix[position:min(end, len(prefix))]
+            else:
+                chunk = self._zeros[:min(end - position, len(self._zeros))]
+            await response.write(chunk)
+            position += len(chunk)
+            if self.settings.bandwidth:
+                await asyncio.sleep(len(chunk) / self.settings.bandwidth)
+        await response.write_eof()
+        return response
+
+    async def media(self, request: web.Request, path: str) -> web.StreamResponse:
+        name = path.rsplit("/", 1)[-1]
+        if name.endswith(".mp4") or name.endswith(".ts"):
+            return await self.send_payload(request, MP4_HEADER, path, self.settings.video_size, "video/mp4")
+        return await self.send_payload(request, png_header(), path, self.settings.image_size, "image/png")
+
+    async def reddit(self, request: web.Request, path: str) -> web.Response:
+        if not path.endswith(".json"):
+            # Permalink resolution only needs the final URL.
+            return web.Response(text="<html></html>", content_type="text/html")
+        post_id = path[:-len(".json")].rstrip("/").rsplit("/", 1)[-1]
+        post = {
+            "subreddit_name_prefixed": "r/bench",
+            "title": f"Benchmark post {post_id}",
+            "name": f"t3_{post_id}",
+        }
+        if post_id.startswith("vid"):
+            post["url_overridden_by_dest"] = f"https://v.redd.it/{post_id}"
+            post["secure_media"] = {"reddit_video": {
+                "fallback_url": f"https://v.redd.it/{post_id}/DASH_720.mp4?source=fallback",
+            }}
+        elif post_id.startswith("gal"):
+            post["url_overridden_by_dest"] = f"https://www.reddit.com/gallery/{post_id}"
+            post["is_gallery"] = True
+            post["media_metadata"] = {
+                f"{post_id}_{i}": {"m": "image/png", "s": {"u": f"https://preview.redd.it/{post_id}_{i}.png"}}
+                for i in range(3)
+            }
+        else:
+            post["url_overridden_by_dest"] = f"https://media.bench/{post_id}.png"
+        return web.json_response([{"data": {"children": [{"data": post}]}}])
+
+    async def rapidsave(self, request: web.Request, path: str) -> web.StreamResponse:
+        video_url = request.query.get("video_url", "")
+        name = yarl.URL(video_url).path.strip("/").replace("/", "_") or "video"
+        return await self.send_payload(request, MP4_HEADER, f"/{name}", self.settings.video_size, "video/mp4")
+
+    async def ttdownloader(self, request: web.Request, path: str) -> web.Response:
+        if request.method == "POST":
+            form = await request.post()
+            video_id = str(form.get("url", "")).rstrip("/").rsplit("/", 1)[-1]
+            return web.Response(text=f'<a href="https://media.bench/tiktok_{video_id}.mp4">Download</a>',
+                                content_type="text/html")
+        response = web.Response(text='<input type="hidden" id="token" name="token" value="bench-token">',
+                                content_type="text/html")
+        response.set_cookie("PHPSESSID", "bench-session")
+        return response
+
+    async def youtube(self, request: web.Request, path: str) -> web.Response:
+        return web.json_response({"title": f"Benchmark video {request.query.get('url', '')}"})
+
+    async def youtube_image(self, request: web.Request, path: str) -> web.StreamResponse:
+        return await self.send_payload(request, png_header(480, 360), path, self.settings.image_size, "image/jpeg")
+
+    async def bluesky(self, request: web.Request, path: str) -> web.Response:
+        if path.endswith("com.atproto.identity.resolveHandle"):
+            return web.json_response({"did": "did:plc:bench"})
+        post_id = request.query.get("uris", "").rsplit("/", 1)[-1]
+        if post_id.startswith("vid"):
+            embed = {
+                "playlist": f"https://video.bsky.app/watch/{post_id}/playlist.m3u8",
+                "thumbnail": f"https://media.bench/{post_id}_thumb.png",
+            }
+        else:
+            embed = {"images": [{"fullsize": f"https://media.bench/{post_id}.png", "alt": ""}]}
+        return web.json_response({"posts": [{"record": {"text": f"Benchmark post {post_id}"}, "embed": embed}]})
+
+    async def bluesky_video(self, request: web.Request, path: str) -> web.StreamResponse:
+        if path.endswith("/playlist.m3u8"):
+            return web.Response(text="#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=2000000,RESOLUTION=1280x720\n"
+                                     "720p/video.m3u8\n", content_type="application/vnd.apple.mpegurl")
+        if path.endswith(".m3u8"):
+            segment_time = 4
+            lines = ["#EXTM3U", f"#EXT-X-TARGETDURATION:{segment_time}"]
+            for i in range(self.settings.segments):
+                lines += [f"#EXTINF:{segment_time}.0,", f"video{i}.ts"]
+            lines.append("#EXT-X-ENDLIST")
+            return web.Response(text="\n".join(lines) + "\n", content_type="application/vnd.apple.mpegurl")
+        segment_size = self.settings.video_size // max(1, self.settings.segments)
+        return await self.send_payload(request, MP4_HEADER, path, segment_size, "video/mp2t")
+
+    async def aparat(self, request: web.Request, path: str) -> web.Response:
+        video_id = path.rstrip("/").rsplit("/", 1)[-1]
+        return web.json_response({"video": {
+            "title": f"Benchmark video {video_id}",
+            "big_poster": f"https://media.bench/{video_id}_poster.png",
+            "file_link_all": [
+                {"profile": "360p", "urls": [f"https://media.bench/{video_id}_360.mp4"]},
+                {"profile": "720p", "urls": [f"https://media.bench/{video_id}_720.mp4"]},
+            ],
+        }})
+
+
+async def serve(settings: StubSettings, port: int = 0) -> Tuple[web.AppRunner, int]:
+    runner = web.AppRunner(StubUpstreams(settings).app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, LISTEN_HOST, port)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+def run_in_process(settings: StubSettings, conn) -> None:
+    """Entry point of the stub server process; sends the bound port through *conn* and serves until killed."""
+    async def main():
+        _, port = await serve(settings)
+        conn.send(port)
+        await asyncio.Event().wait()
+    asyncio.run(main())
+
+
+class RewritingSession:
+    """Wraps a :class:`ClientSession` and points every request at the stub server at *base*."""
+
+    def __init__(self, session: ClientSession, base: str):
+        self.session = session
+        self.base = yarl.URL(base)
+
+    def rewrite(self, url) -> yarl.URL:
+        url = url if isinstance(url, yarl.URL) else yarl.URL(str(url))
+        if url.host == self.base.host:
+            return url
+        query = f"?{url.raw_query_string}" if url.raw_query_string else ""
+        return yarl.URL(f"{self.base}{url.raw_host}{url.raw_path}{query}", encoded=True)
+
+    def request(self, method: str, url, **kwargs):
+        return self.session.request(method, self.rewrite(url), **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self.session, name)
+
+
+def stub_base(port: int, host: Optional[str] = None) -> str:
+    return f"http://{host or LISTEN_HOST}:{port}/"
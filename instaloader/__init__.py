@@ -16,6 +16,13 @@ from .exceptions import *
 from .instaloader import Instaloader as Instaloader
 from .instaloadercontext import (InstaloaderContext as InstaloaderContext,
                                  RateController as RateController)
+try:
+    # aiohttp is only needed for the asyncio context
+    from .asyncinstaloadercontext import (AsyncInstaloaderContext as AsyncInstaloaderContext,
+                                          AsyncRateController as AsyncRateController,
+                                          post_from_shortcode as post_from_shortcode)
+except ImportError:
+    pass
 from .lateststamps import LatestStamps as LatestStamps
 from .nodeiterator import (NodeIterator as NodeIterator,
                            FrozenNodeIterator as FrozenNodeIterator,
@@ -0,0 +1,591 @@
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import urllib.parse
+from contextlib import contextmanager, suppress
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import aiohttp
+from multidict import CIMultiDict
+
+from .exceptions import *
+from .instaloadercontext import InstaloaderContext, RateController, default_iphone_headers, default_user_agent
+from .structures import Post
+
+# Headers that aiohttp sets by itself for each request.
+_TRANSPORT_HEADERS = ('Connection', 'Content-Length')
+
+
+class _SessionState:
+    """Headers and cookies of a session.
+
+    They are sent with each request rather than kept in the :class:`aiohttp.ClientSession`, so that they can be copied
+    and changed for a single query the way :func:`copy_session` does with a :class:`requests.Session`."""
+
+    def __init__(self, headers: Dict[str, str], cookies: Dict[str, str]):
+        self.headers: CIMultiDict[str] = CIMultiDict(headers)
+        self.cookies = dict(cookies)
+
+    def copy(self) -> "_SessionState":
+        return _SessionState(self.headers, self.cookies)
+
+
+class AsyncInstaloaderContext:
+    """Counterpart of :class:`InstaloaderContext` for asyncio, with its query methods as coroutines.
+
+    Requests go through one pooled :class:`aiohttp.ClientSession`, so that the post lookups of several tasks, with
+    :func:`post_from_shortcode`, run concurrently in one event loop instead of in threads. Downloads from the CDN go
+    through :attr:`cdn_http`. Retries, fatal status codes, the detection of redirects to the login page and the
+    exceptions raised are those of :class:`InstaloaderContext`, and an :class:`AsyncRateController` paces the queries.
+
+    The structures cannot use the context by themselves: their properties and constructors that send queries, such
+    as :meth:`Profile.from_username` or :meth:`Post.from_shortcode`, expect the synchronous methods of an
+    :class:`InstaloaderContext`.
+
+    *http* is the session to send requests with. Without one, the context opens its own on first use, with up to
+    *connection_limit* connections, and another one for the CDN with up to *cdn_pool_size* connections per host, and
+    closes them in :meth:`close`. Cookies are kept by the context and sent with each request. Logging in is left to
+    :class:`InstaloaderContext`, whose :meth:`~InstaloaderContext.save_session` can be passed on to
+    :meth:`load_session`.
+    """
+
+    def __init__(self, sleep: bool = True, quiet: bool = False, user_agent: Optional[str] = None,
+                 max_connection_attempts: int = 3, request_timeout: float = 300.0,
+                 rate_controller: Optional[Callable[["AsyncInstaloaderContext"], "AsyncRateController"]] = None,
+                 fatal_status_codes: Optional[List[int]] = None,
+                 iphone_support: bool = True,
+                 http: Optional[aiohttp.ClientSession] = None,
+                 connection_limit: int = 10,
+                 cdn_pool_size: int = 10):
+
+        self.user_agent = user_agent if user_agent is not None else default_user_agent()
+        self.request_timeout = request_timeout
+        self.connection_limit = connection_limit
+        self._http = http
+        self._owns_http = http is None
+        # Anonymous session for downloads from the CDN, opened on first use and kept to reuse its connections
+        self.cdn_pool_size = cdn_pool_size
+        self._cdn_http: Optional[aiohttp.ClientSession] = None
+        self._session = self._anonymous_state()
+        self.username = None
+        self.user_id = None
+        self.sleep = sleep
+        self.quiet = quiet
+        self.max_connection_attempts = max_connection_attempts
+        self.iphone_support = iphone_support
+        self.iphone_headers = default_iphone_headers()
+
+        # error log, filled with error()
+        self.error_log: List[str] = []
+
+        self._rate_controller = rate_controller(self) if rate_controller is not None else AsyncRateController(self)
+
+        # Can be set to True for testing, disables supression of AsyncInstaloaderContext.error_catcher
+        self.raise_all_errors = False
+
+        # HTTP status codes that should cause an AbortDownloadException
+        self.fatal_status_codes = fatal_status_codes or []
+
+    @property
+    def rate_controller(self) -> "AsyncRateController":
+        """The :class:`AsyncRateController` that paces our queries."""
+        return self._rate_controller
+
+    @property
+    def is_logged_in(self) -> bool:
+        """True, if a logged-in session has been loaded."""
+        return bool(self.username)
+
+    @property
+    def http(self) -> aiohttp.ClientSession:
+        """The session requests are sent with."""
+        if self._http is None:
+            self._http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connection_limit),
+                                               cookie_jar=aiohttp.DummyCookieJar())
+        return self._http
+
+    @property
+    def cdn_http(self) -> aiohttp.ClientSession:
+        """The session :meth:`get_raw` and :meth:`head` use, which can also be handed to other downloaders.
+
+        Unless *http* was given, it is a session of its own, apart from the queries, whose connections are kept alive
+        and reused from file to file, up to :attr:`cdn_pool_size` of them per host."""
+        if not self._owns_http:
+            return self.http
+        if self._cdn_http is None:
+            self._cdn_http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.cdn_pool_size),
+                cookie_jar=aiohttp.DummyCookieJar())
+        return self._cdn_http
+
+    def log(self, *msg, sep='', end='\n', flush=False):
+        """Log a message to stdout that can be suppressed with *quiet*."""
+        if not self.quiet:
+            print(*msg, sep=sep, end=end, flush=flush)
+
+    def error(self, msg, repeat_at_end=True):
+        """Log a non-fatal error message to stderr, which is repeated when the context is closed.
+
+        :param msg: Message to be printed.
+        :param repeat_at_end: Set to false if the message should be printed, but not repeated when closing."""
+        print(msg, file=sys.stderr)
+        if repeat_at_end:
+            self.error_log.append(msg)
+
+    @property
+    def has_stored_errors(self) -> bool:
+        """Returns whether any error has been reported and stored to be repeated when the context is closed."""
+        return bool(self.error_log)
+
+    async def close(self):
+        """Print error log and close the session, if it is our own."""
+        if self.error_log and not self.quiet:
+            print("\nErrors or warnings occurred:", file=sys.stderr)
+            for err in self.error_log:
+                print(err, file=sys.stderr)
+        if self._owns_http and self._http is not None:
+            await self._http.close()
+            self._http = None
+        if self._cdn_http is not None:
+            await self._cdn_http.close()
+            self._cdn_http = None
+
+    @contextmanager
+    def error_catcher(self, extra_info: Optional[str] = None):
+        """
+        Context manager to catch, print and record InstaloaderExceptions.
+
+        :param extra_info: String to prefix error message with."""
+        try:
+            yield
+        except InstaloaderException as err:
+            if extra_info:
+                self.error('{}: {}'.format(extra_info, err))
+            else:
+                self.error('{}'.format(err))
+            if self.raise_all_errors:
+                raise
+
+    def _default_http_header(self, empty_session_only: bool = False) -> Dict[str, str]:
+        # pylint:disable=protected-access
+        return InstaloaderContext._default_http_header(self, empty_session_only)  # type: ignore
+
+    def _anonymous_state(self) -> _SessionState:
+        return _SessionState(self._default_http_header(empty_session_only=True),
+                             {'sessionid': '', 'mid': '', 'ig_pr': '1', 'ig_vw': '1920', 'csrftoken': '',
+                              's_network': '', 'ds_user_id': ''})
+
+    def save_session(self) -> Dict[str, str]:
+        """The session cookies, as :meth:`InstaloaderContext.save_session` returns them."""
+        return dict(self._session.cookies)
+
+    def update_cookies(self, cookie):
+        self._session.cookies.update(cookie)
+
+    def load_session(self, username, sessiondata):
+        """Continue a session that was logged in with :class:`InstaloaderContext`."""
+        session = _SessionState(self._default_http_header(), sessiondata)
+        session.headers['X-CSRFToken'] = session.cookies['csrftoken']
+        self._session = session
+        self.username = username
+
+    async def do_sleep(self):
+        """Sleep a short time if self.sleep is set. Called before each request to instagram.com."""
+        if self.sleep:
+            await asyncio.sleep(min(random.expovariate(0.6), 15.0))
+
+    async def _request(self, method: str, url: str, session: Optional[_SessionState],
+                       http: Optional[aiohttp.ClientSession] = None,
+                       **kwargs) -> Tuple[aiohttp.ClientResponse, str]:
+        """Send a request with the headers and cookies of *session*, or anonymously, and read its body."""
+        if session is None:
+            headers = self._default_http_header(empty_session_only=True)
+            cookies = None
+        else:
+            headers = dict(session.headers)
+            cookies = session.cookies
+        for header in _TRANSPORT_HEADERS:
+            headers.pop(header, None)
+        async with (http or self.http).request(method, url, headers=headers, cookies=cookies,
+                                               timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+                                               **kwargs) as resp:
+            text = (await resp.read()).decode('utf-8', errors='replace')
+        if session is not None:
+            session.cookies.update({name: morsel.value for name, morsel in resp.cookies.items()})
+        return resp, text
+
+    @staticmethod
+    def _response_error(resp: aiohttp.ClientResponse, text: str) -> str:
+        extra_from_json: Optional[str] = None
+        with suppress(json.decoder.JSONDecodeError):
+            resp_json = json.loads(text)
+            if "status" in resp_json:
+                extra_from_json = (
+                    f"\"{resp_json['status']}\" status, message \"{resp_json['message']}\""
+                    if "message" in resp_json
+                    else f"\"{resp_json['status']}\" status"
+                )
+        return (
+            f"{resp.status} {resp.reason}"
+            f"{f' - {extra_from_json}' if extra_from_json is not None else ''}"
+            f" when accessing {resp.url}"
+        )
+
+    async def get_json(self, path: str, params: Dict[str, Any], host: str = 'www.instagram.com',
+                       session: Optional[_SessionState] = None, _attempt=1,
+                       response_headers: Optional[Dict[str, Any]] = None,
+                       use_post: bool = False) -> Dict[str, Any]:
+        """JSON request to Instagram.
+
+        :param path: URL, relative to the given domain which defaults to www.instagram.com/
+        :param params: request parameters
+        :param host: Domain part of the URL from where to download the requested JSON; defaults to www.instagram.com
+        :param session: Session state to use, or None to use that of this context
+        :param use_post: Use POST instead of GET to make the request
+        :return: Decoded response dictionary
+        :raises QueryReturnedBadRequestException: When the server responds with a 400.
+        :raises QueryReturnedNotFoundException: When the server responds with a 404.
+        :raises ConnectionException: When query repeatedly failed.
+        """
+        is_graphql_query = 'query_hash' in params and 'graphql/query' in path
+        is_doc_id_query = 'doc_id' in params and 'graphql/query' in path
+        is_iphone_query = host == 'i.instagram.com'
+        is_other_query = not is_graphql_query and not is_doc_id_query and host == "www.instagram.com"
+        sess = session if session else self._session
+        try:
+            await self.do_sleep()
+            if is_graphql_query:
+                await self._rate_controller.wait_before_query(params['query_hash'])
+            if is_doc_id_query:
+                await self._rate_controller.wait_before_query(params['doc_id'])
+            if is_iphone_query:
+                await self._rate_controller.wait_before_query('iphone')
+            if is_other_query:
+                await self._rate_controller.wait_before_query('other')
+            if use_post:
+                resp, text = await self._request('POST', 'https://{0}/{1}'.format(host, path), sess,
+                                                 data=params, allow_redirects=False)
+            else:
+                resp, text = await self._request('GET', 'https://{0}/{1}'.format(host, path), sess,
+                                                 params=params, allow_redirects=False)
+            if resp.status in self.fatal_status_codes:
+                redirect = " redirect to {}".format(resp.headers['location']) if 'location' in resp.headers else ""
+                body = ""
+                if resp.headers.get('Content-Type', '').startswith('application/json'):
+                    body = ': ' + text[:500] + ('…' if len(text) > 501 else '')
+                raise AbortDownloadException("Query to https://{}/{} responded with \"{} {}\"{}{}".format(
+                    host, path, resp.status, resp.reason, redirect, body
+                ))
+            while resp.status in (301, 302, 303, 307, 308) and 'location' in resp.headers:
+                redirect_url = resp.headers['location']
+                self.log('\nHTTP redirect from https://{0}/{1} to {2}'.format(host, path, redirect_url))
+                if (redirect_url.startswith('https://www.instagram.com/accounts/login') or
+                    redirect_url.startswith('https://i.instagram.com/accounts/login')):
+                    if not self.is_logged_in:
+                        raise LoginRequiredException("Redirected to login page. Use --login or --load-cookies.")
+                    raise AbortDownloadException("Redirected to login page. You've been logged out, please wait " +
+                                                 "some time, recreate the session and try again")
+                if redirect_url.startswith('https://{}/'.format(host)):
+                    resp, text = await self._request('GET',
+                                                     redirect_url if redirect_url.endswith('/') else redirect_url + '/',
+                                                     sess, params=params, allow_redirects=False)
+                else:
+                    break
+            if response_headers is not None:
+                response_headers.clear()
+                response_headers.update(resp.headers)
+            if resp.status == 400:
+                raise QueryReturnedBadRequestException(self._response_error(resp, text))
+            if resp.status == 404:
+                raise QueryReturnedNotFoundException(self._response_error(resp, text))
+            if resp.status == 429:
+                raise TooManyRequestsException(self._response_error(resp, text))
+            if resp.status != 200:
+                raise ConnectionException(self._response_error(resp, text))
+            else:
+                resp_json = json.loads(text)
+            if 'status' in resp_json and resp_json['status'] != "ok":
+                raise ConnectionException(self._response_error(resp, text))
+            return resp_json
+        except (ConnectionException, json.decoder.JSONDecodeError, aiohttp.ClientError, asyncio.TimeoutError) as err:
+            error_string = "JSON Query to {}: {}".format(path, err)
+            if _attempt == self.max_connection_attempts:
+                if isinstance(err, QueryReturnedNotFoundException):
+                    raise QueryReturnedNotFoundException(error_string) from err
+                else:
+                    raise ConnectionException(error_string) from err
+            self.error(error_string + " [retrying]", repeat_at_end=False)
+            if isinstance(err, TooManyRequestsException):
+                if is_graphql_query:
+                    await self._rate_controller.handle_429(params['query_hash'])
+                if is_doc_id_query:
+                    await self._rate_controller.handle_429(params['doc_id'])
+                if is_iphone_query:
+                    await self._rate_controller.handle_429('iphone')
+                if is_other_query:
+                    await self._rate_controller.handle_429('other')
+            return await self.get_json(path=path, params=params, host=host, session=sess, _attempt=_attempt + 1,
+                                       response_headers=response_headers, use_post=use_post)
+
+    def _graphql_session(self, referer: Optional[str]) -> _SessionState:
+        tmpsession = self._session.copy()
+        tmpsession.headers.update(self._default_http_header(empty_session_only=True))
+        tmpsession.headers['authority'] = 'www.instagram.com'
+        tmpsession.headers['scheme'] = 'https'
+        tmpsession.headers['accept'] = '*/*'
+        if referer is not None:
+            tmpsession.headers['referer'] = urllib.parse.quote(referer)
+        return tmpsession
+
+    async def graphql_query(self, query_hash: str, variables: Dict[str, Any],
+                            referer: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Do a GraphQL Query.
+
+        :param query_hash: Query identifying hash.
+        :param variables: Variables for the Query.
+        :param referer: HTTP Referer, or None.
+        :return: The server's response dictionary.
+        """
+        variables_json = json.dumps(variables, separators=(',', ':'))
+        resp_json = await self.get_json('graphql/query',
+                                        params={'doc_id': query_hash,
+                                                'variables': variables_json},
+                                        session=self._graphql_session(referer))
+        if 'status' not in resp_json:
+            self.error("GraphQL response did not contain a \"status\" field.")
+        return resp_json
+
+    async def doc_id_graphql_query(self, doc_id: str, variables: Dict[str, Any],
+                                   referer: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Do a doc_id-based GraphQL Query using method POST.
+
+        :param doc_id: doc_id for the query.
+        :param variables: Variables for the Query.
+        :param referer: HTTP Referer, or None.
+        :return: The server's response dictionary.
+        """
+        variables_json = json.dumps(variables, separators=(',', ':'))
+        resp_json = await self.get_json('graphql/query',
+                                        params={'variables': variables_json,
+                                                'doc_id': doc_id,
+                                                'server_timestamps': 'true'},
+                                        session=self._graphql_session(referer),
+                                        use_post=True)
+        if 'status' not in resp_json:
+            self.error("GraphQL response did not contain a \"status\" field.")
+        return resp_json
+
+    async def get_iphone_json(self, path: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """JSON request to ``i.instagram.com``.
+
+        :param path: URL, relative to ``i.instagram.com/``
+        :param params: GET parameters
+        :return: Decoded response dictionary
+        :raises QueryReturnedBadRequestException: When the server responds with a 400.
+        :raises QueryReturnedNotFoundException: When the server responds with a 404.
+        :raises ConnectionException: When query repeatedly failed.
+        """
+        tempsession = self._session.copy()
+        # Set headers to simulate an API request from iPad
+        tempsession.headers['ig-intended-user-id'] = str(self.user_id)
+        tempsession.headers['x-pigeon-rawclienttime'] = '{:.6f}'.format(time.time())
+
+        # Add headers obtained from previous iPad request
+        tempsession.headers.update(self.iphone_headers)
+
+        # Extract key information from cookies if we haven't got it already from a previous request
+        header_cookies_mapping = {'x-mid': 'mid',
+                                  'ig-u-ds-user-id': 'ds_user_id',
+                                  'x-ig-device-id': 'ig_did',
+                                  'x-ig-family-device-id': 'ig_did',
+                                  'family_device_id': 'ig_did'}
+
+        # Map the cookie value to the matching HTTP request header
+        cookies = tempsession.cookies.copy()
+        for key, value in header_cookies_mapping.items():
+            if value in cookies:
+                if key not in tempsession.headers:
+                    tempsession.headers[key] = cookies[value]
+                else:
+                    # Remove the cookie value if it's already specified as a header
+                    tempsession.cookies.pop(value, None)
+
+        # Edge case for ig-u-rur header due to special string encoding in cookie
+        if 'rur' in cookies:
+            if 'ig-u-rur' not in tempsession.headers:
+                tempsession.headers['ig-u-rur'] = cookies['rur'].strip('\"').encode('utf-8') \
+                                                                .decode('unicode_escape')
+            else:
+                tempsession.cookies.pop('rur', None)
+
+        # Remove headers specific to Desktop version
+        for header in ['Host', 'Origin', 'X-Instagram-AJAX', 'X-Requested-With', 'Referer']:
+            tempsession.headers.pop(header, None)
+
+        # No need for cookies if we have a bearer token
+        if 'authorization' in tempsession.headers:
+            tempsession.cookies.clear()
+
+        response_headers = dict()    # type: Dict[str, Any]
+        response = await self.get_json(path, params, 'i.instagram.com', tempsession, response_headers=response_headers)
+
+        # Extract the ig-set-* headers and use them in the next request
+        for key, value in response_headers.items():
+            if key.startswith('ig-set-'):
+                self.iphone_headers[key.replace('ig-set-', '')] = value
+            elif key.startswith('x-ig-set-'):
+                self.iphone_headers[key.replace('x-ig-set-', 'x-ig-')] = value
+
+        return response
+
+    async def write_raw(self, resp: Union[bytes, aiohttp.ClientResponse], filename: str) -> None:
+        """Write raw response data into a file, releasing the response."""
+        self.log(filename, end=' ', flush=True)
+        with open(filename + '.temp', 'wb') as file:
+            if isinstance(resp, bytes):
+                file.write(resp)
+            else:
+                try:
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        file.write(chunk)
+                finally:
+                    resp.release()
+        os.replace(filename + '.temp', filename)
+
+    async def _raise_for_raw(self, resp: aiohttp.ClientResponse) -> None:
+        try:
+            text = (await resp.read()).decode('utf-8', errors='replace')
+        finally:
+            resp.release()
+        if resp.status == 403:
+            # suspected invalid URL signature
+            raise QueryReturnedForbiddenException(self._response_error(resp, text))
+        if resp.status == 404:
+            # 404 not worth retrying.
+            raise QueryReturnedNotFoundException(self._response_error(resp, text))
+        raise ConnectionException(self._response_error(resp, text))
+
+    async def get_raw(self, url: str, _attempt=1) -> aiohttp.ClientResponse:
+        """Downloads a file anonymously.
+
+        The body is left to be read from the returned response, which has to be released afterwards.
+
+        :raises QueryReturnedNotFoundException: When the server responds with a 404.
+        :raises QueryReturnedForbiddenException: When the server responds with a 403.
+        :raises ConnectionException: When download failed."""
+        headers = self._default_http_header(empty_session_only=True)
+        for header in _TRANSPORT_HEADERS:
+            headers.pop(header, None)
+        try:
+            resp = await self.cdn_http.get(url, headers=headers,
+                                           timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise ConnectionException("Download of {}: {}".format(url, err)) from err
+        if resp.status == 200:
+            return resp
+        await self._raise_for_raw(resp)
+        raise AssertionError  # unreachable, _raise_for_raw() always raises
+
+    async def get_and_write_raw(self, url: str, filename: str) -> None:
+        """Downloads and writes anonymously-requested raw data into a file.
+
+        :raises QueryReturnedNotFoundException: When the server responds with a 404.
+        :raises QueryReturnedForbiddenException: When the server responds with a 403.
+        :raises ConnectionException: When download repeatedly failed."""
+        await self.write_raw(await self.get_raw(url), filename)
+
+    async def head(self, url: str, allow_redirects: bool = False) -> aiohttp.ClientResponse:
+        """HEAD a URL anonymously.
+
+        :raises QueryReturnedNotFoundException: When the server responds with a 404.
+        :raises QueryReturnedForbiddenException: When the server responds with a 403.
+        :raises ConnectionException: When request failed.
+        """
+        try:
+            resp, text = await self._request('HEAD', url, None, self.cdn_http, allow_redirects=allow_redirects)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise ConnectionException("HEAD {}: {}".format(url, err)) from err
+        if resp.status == 200:
+            return resp
+        if resp.status == 403:
+            # suspected invalid URL signature
+            raise QueryReturnedForbiddenException(self._response_error(resp, text))
+        if resp.status == 404:
+            # 404 not worth retrying.
+            raise QueryReturnedNotFoundException(self._response_error(resp, text))
+        raise ConnectionException(self._response_error(resp, text))
+
+
+class AsyncRateController(RateController):
+    """
+    :class:`RateController` of an :class:`AsyncInstaloaderContext`, which waits with :func:`asyncio.sleep`.
+
+    :meth:`sleep`, :meth:`wait_before_query` and :meth:`handle_429` are coroutines; the bookkeeping and
+    :meth:`~RateController.query_waittime` are those of :class:`RateController` and can be overridden the same way.
+    """
+
+    def __init__(self, context: AsyncInstaloaderContext):
+        super().__init__(context)  # type: ignore
+        self._turn = asyncio.Lock()
+
+    async def sleep(self, secs: float):  # type: ignore
+        """Wait given number of seconds."""
+        await asyncio.sleep(secs)
+
+    async def wait_before_query(self, query_type: str) -> None:  # type: ignore
+        """This method is called before a query to Instagram.
+
+        Queries wait for their turn one after the other, so that the waiting time of each is calculated with the
+        queries ahead of it already counted."""
+        async with self._turn:
+            waittime = self.query_waittime(query_type, time.monotonic(), False)
+            assert waittime >= 0
+            if waittime > 15:
+                formatted_waittime = ("{} seconds".format(round(waittime)) if waittime <= 666 else
+                                      "{} minutes".format(round(waittime / 60)))
+                self._context.log("\nToo many queries in the last time. Need to wait {}, until {:%H:%M}."
+                                  .format(formatted_waittime, datetime.now() + timedelta(seconds=waittime)))
+            if waittime > 0:
+                await self.sleep(waittime)
+            if query_type not in self._query_timestamps:
+                self._query_timestamps[query_type] = [time.monotonic()]
+            else:
+                self._query_timestamps[query_type].append(time.monotonic())
+
+    async def handle_429(self, query_type: str) -> None:  # type: ignore
+        """This method is called to handle a 429 Too Many Requests response."""
+        current_time = time.monotonic()
+        waittime = self.query_waittime(query_type, current_time, True)
+        assert waittime >= 0
+        self._report_429(query_type, current_time, waittime)
+        if waittime > 0:
+            await self.sleep(waittime)
+
+
+async def post_from_shortcode(context: AsyncInstaloaderContext, shortcode: str) -> Post:
+    """Fetch the metadata of the post *shortcode* with *context* and return it as a :class:`Post`.
+
+    The metadata is complete, and for a logged-in context the iPhone media info is fetched as well, so that the
+    properties of the Post do not need any further queries. Those that make requests of their own, such as comments or
+    the highest-quality :attr:`Post.video_url` of a logged-in context, need an :class:`InstaloaderContext`.
+    """
+    # pylint:disable=protected-access
+    post = Post(context, {'shortcode': shortcode})  # type: ignore
+    pic_json = await context.graphql_query('8845758582119845', {'shortcode': shortcode})
+    metadata = pic_json['data']['xdt_shortcode_media']
+    if metadata is None:
+        raise BadResponseException("Fetching Post metadata failed.")
+    if shortcode != metadata['shortcode']:
+        raise PostChangedException
+    post._full_metadata_dict = metadata
+    post._node = metadata
+    if context.iphone_support and context.is_logged_in:
+        data = await context.get_iphone_json(path='api/v1/media/{}/info/'.format(post.mediaid), params={})
+        post._iphone_struct_ = data['items'][0]
+    return post
@@ -14,6 +14,7 @@ from functools import partial
 from typing import Any, Callable, Dict, Iterator, List, Optional, Union
 
 import requests
+import requests.adapters
 import requests.utils
 
 from .exceptions import *
@@ -82,11 +83,15 @@ class InstaloaderContext:
                  max_connection_attempts: int = 3, request_timeout: float = 300.0,
                  rate_controller: Optional[Callable[["InstaloaderContext"], "RateController"]] = None,
                  fatal_status_codes: Optional[List[int]] = None,
-                 iphone_support: bool = True):
+                 iphone_support: bool = True,
+                 cdn_pool_size: int = 10):
 
         self.user_agent = user_agent if user_agent is not None else default_user_agent()
         self.request_timeout = request_timeout
         self._session = self.get_anonymous_session()
+        # Anonymous session for downloads from the CDN, opened on first use and kept to reuse its connections
+        self.cdn_pool_size = cdn_pool_size
+        self._cdn_session: Optional[requests.Session] = None
         self.username = None
         self.user_id = None
         self.sleep = sleep
@@ -130,6 +135,11 @@ class InstaloaderContext:
             self.user_id = user_id
             self.iphone_headers = iphone_headers
 
+    @property
+    def rate_controller(self) -> "RateController":
+        """The :class:`RateController` that paces our queries."""
+        return self._rate_controller
+
     @property
     def is_logged_in(self) -> bool:
         """True, if this Instaloader instance is logged in."""
@@ -163,6 +173,9 @@ class InstaloaderContext:
             for err in self.error_log:
                 print(err, file=sys.stderr)
         self._session.close()
+        if self._cdn_session is not None:
+            self._cdn_session.close()
+            self._cdn_session = None
 
     @contextmanager
     def error_catcher(self, extra_info: Optional[str] = None):
@@ -211,6 +224,19 @@ class InstaloaderContext:
         session.request = partial(session.request, timeout=self.request_timeout) # type: ignore
         return session
 
+    def get_cdn_session(self) -> requests.Session:
+        """Returns the long-lived anonymous session that :meth:`get_raw` and :meth:`head` use.
+
+        Its connections are kept alive and reused from file to file, up to :attr:`cdn_pool_size` of them per host."""
+        if self._cdn_session is None:
+            session = self.get_anonymous_session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.cdn_pool_size,
+                                                    pool_maxsize=self.cdn_pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._cdn_session = session
+        return self._cdn_session
+
     def save_session(self):
         """Not meant to be used directly, use :meth:`Instaloader.save_session`."""
         return requests.utils.dict_from_cookiejar(self._session.cookies)
@@ -670,8 +696,7 @@ class InstaloaderContext:
         :raises ConnectionException: When download failed.
 
         .. versionadded:: 4.2.1"""
-        with self.get_anonymous_session() as anonymous_session:
-            resp = anonymous_session.get(url, stream=True)
+        resp = self.get_cdn_session().get(url, stream=True)
         if resp.status_code == 200:
             resp.raw.decode_content = True
             return resp
@@ -701,8 +726,7 @@ class InstaloaderContext:
 
         .. versionadded:: 4.7.6
         """
-        with self.get_anonymous_session() as anonymous_session:
-            resp = anonymous_session.head(url, allow_redirects=allow_redirects)
+        resp = self.get_cdn_session().head(url, allow_redirects=allow_redirects)
         if resp.status_code == 200:
             return resp
         else:
@@ -737,6 +761,28 @@ class RateController:
         self._earliest_next_request_time = 0.0
         self._iphone_earliest_next_request_time = 0.0
 
+    def save_state(self) -> Dict[str, Any]:
+        """Returns the query history, to be restored with :meth:`load_state`, possibly in another process.
+
+        The timestamps are kept with :func:`time.monotonic`, which only has a meaning within one process; they are
+        converted to seconds since the epoch."""
+        offset = time.time() - time.monotonic()
+        return {'query_timestamps': {query_type: [t + offset for t in times]
+                                     for query_type, times in self._query_timestamps.items()},
+                'earliest_next_request_time': self._earliest_next_request_time + offset,
+                'iphone_earliest_next_request_time': self._iphone_earliest_next_request_time + offset}
+
+    def load_state(self, state: Dict[str, Any]) -> None:
+        """Restores a query history saved with :meth:`save_state`. Nothing is changed if *state* is incomplete."""
+        offset = time.monotonic() - time.time()
+        query_timestamps = {query_type: [t + offset for t in times]
+                            for query_type, times in state['query_timestamps'].items()}
+        earliest_next_request_time = state['earliest_next_request_time'] + offset
+        iphone_earliest_next_request_time = state['iphone_earliest_next_request_time'] + offset
+        self._query_timestamps = query_timestamps
+        self._earliest_next_request_time = earliest_next_request_time
+        self._iphone_earliest_next_request_time = iphone_earliest_next_request_time
+
     def sleep(self, secs: float):
         """Wait given number of seconds."""
         # Not static, to allow for the behavior of this method to depend on context-inherent properties, such as
@@ -858,6 +904,11 @@ class RateController:
         current_time = time.monotonic()
         waittime = self.query_waittime(query_type, current_time, True)
         assert waittime >= 0
+        self._report_429(query_type, current_time, waittime)
+        if waittime > 0:
+            self.sleep(waittime)
+
+    def _report_429(self, query_type: str, current_time: float, waittime: float) -> None:
         self._dump_query_timestamps(current_time, query_type)
         text_for_429 = ("Instagram responded with HTTP error \"429 - Too Many Requests\". Please do not run multiple "
                         "instances of Instaloader in parallel or within short sequence. Also, do not use any Instagram "
@@ -869,5 +920,3 @@ class RateController:
             self._context.error("The request will be retried in {}, at {:%H:%M}."
                                 .format(formatted_waittime, datetime.now() + timedelta(seconds=waittime)),
                                 repeat_at_end=False)
-        if waittime > 0:
-            self.sleep(waittime)
@@ -0,0 +1,41 @@
+"""Download, buffering and upload plumbing shared by the SocialMediaDownload handlers."""
+
+from .backlog import Backlog as Backlog
+from .budget import MemoryBudget as MemoryBudget
+from .db import (BlobStore as BlobStore,
+                 JobJournal as JobJournal,
+                 JournalEntry as JournalEntry,
+                 upgrade_table as upgrade_table)
+from .download import (DownloadError as DownloadError,
+                       DownloadRefused as DownloadRefused,
+                       Downloader as Downloader)
+from .fixtures import (FixtureMissing as FixtureMissing,
+                       FixtureSession as FixtureSession,
+                       FixtureStore as FixtureStore)
+from .jobs import JobRegistry as JobRegistry
+from .lru import LRUCache as LRUCache
+from .media import Media as Media
+from .mediacache import (MediaCache as MediaCache,
+                         canonical_url as canonical_url)
+from .metacache import (CachedMetadata as CachedMetadata,
+                        MetadataCache as MetadataCache,
+                        MetadataStore as MetadataStore)
+from .metrics import (PipelineMetrics as PipelineMetrics,
+                      current_platform as current_platform)
+from .priority import PriorityGate as PriorityGate
+from .probe import (blurhash_encode as blurhash_encode,
+                    image_dimensions as image_dimensions,
+                    probe_image as probe_image)
+from .reencode import reencode_image as reencode_image
+from .scheduler import (FairScheduler as FairScheduler,
+                        Slot as Slot,
+                        TokenBucket as TokenBucket,
+                        current_slot as current_slot)
+from .tracing import (JSONLExporter as JSONLExporter,
+                      OTLPExporter as OTLPExporter,
+                      Span as Span,
+                      Tracer as Tracer,
+                      current_span as current_span)
+from .transcode import (TranscodeError as TranscodeError,
+                        Transcoder as Transcoder)
+from .watchdog import LoopWatchdog as LoopWatchdog
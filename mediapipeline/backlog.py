@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+
+class Backlog:
+    """Messages that arrived late, e.g. after a restart or a sync gap, held back so only the newest get handled.
+
+    :meth:`add` keeps the latest *keep* events per room and drops the older ones. Once no backlogged event has
+    arrived for *settle* seconds, the retained events are passed to *handler* one at a time, oldest first, and only
+    while *idle* reports that no fresh messages are being handled. Events can be withdrawn with :meth:`discard` until
+    they are handled.
+    """
+
+    def __init__(self, keep: int, handler: Callable[[Any], Awaitable[None]], idle: Callable[[], bool],
+                 log: logging.Logger, settle: float = 5.0, poll_interval: float = 0.5):
+        self.keep = keep
+        self.handler = handler
+        self.idle = idle
+        self.log = log
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self._rooms: Dict[str, Deque[Any]] = {}
+        # Events taken from _rooms by _drain() that have yet to be handled, oldest first
+        self._pending: List[Any] = []
+        self._last_added = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return sum(len(events) for events in self._rooms.values()) + len(self._pending)
+
+    def add(self, evt) -> bool:
+        """Queue *evt*; returns False if it displaced an older event of the same room, which is dropped."""
+        events = self._rooms.setdefault(evt.room_id, deque(maxlen=self.keep))
+        displaced = len(events) == events.maxlen
+        events.append(evt)
+        loop = asyncio.get_running_loop()
+        self._last_added = loop.time()
+        if self._task is None:
+            self._task = loop.create_task(self._drain())
+        return not displaced
+
+    def discard(self, room_id: str, event_id: Optional[str] = None) -> int:
+        """Drop the held events of *room_id*, or only *event_id*; returns how many there were."""
+        def held(evt) -> bool:
+            return evt.room_id == room_id and (event_id is None or evt.event_id == event_id)
+
+        events = self._rooms.get(room_id, ())
+        kept = [evt for evt in events if not held(evt)]
+        pending = [evt for evt in self._pending if not held(evt)]
+        discarded = len(events) - len(kept) + len(self._pending) - len(pending)
+        if room_id in self._rooms:
+            self._rooms[room_id] = deque(kept, maxlen=self.keep)
+        self._pending[:] = pending
+        return discarded
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._rooms.clear()
+        self._pending.clear()
+
+    async def _drain(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            while (remaining := self._last_added + self.settle - loop.time()) > 0:
+                await asyncio.sleep(remaining)
+            self._pending = sorted((evt for events in self._rooms.values() for evt in events),
+                                   key=lambda evt: evt.timestamp)
+            self._rooms.clear()
+            if not self._pending:
+                self._task = None
+                return
+            self.log.info(f"Handling {len(self._pending)} backlogged messages")
+            while self._pending:
+                while not self.idle():
+                    await asyncio.sleep(self.poll_interval)
+                if not self._pending:
+                    break
+                evt = self._pending.pop(0)
+                try:
+                    await self.handler(evt)
+                except Exception:
+                    self.log.exception(f"Failed to handle backlogged message {evt.event_id} in {evt.room_id}")
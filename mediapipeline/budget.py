@@ -0,0 +1,65 @@
+import asyncio
+from collections import deque
+from typing import Deque, Tuple
+
+
+class MemoryBudget:
+    """Plugin-wide ceiling for media bytes held in memory by in-flight downloads.
+
+    Jobs reserve the number of bytes they expect to buffer with :meth:`acquire` and give them back with
+    :meth:`release`. Reservations are granted in FIFO order, so a large job waiting for room is not starved by a
+    stream of small ones. A single reservation is capped at the whole budget, which keeps every request satisfiable.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+
+    @property
+    def waiting(self) -> int:
+        """Number of jobs currently blocked on a reservation."""
+        return sum(1 for _, fut in self._waiters if not fut.done())
+
+    def fits(self, nbytes: int) -> bool:
+        """Whether a reservation of *nbytes* would be granted without waiting."""
+        return not self._waiters and self.used + max(0, min(nbytes, self.limit)) <= self.limit
+
+    async def acquire(self, nbytes: int) -> int:
+        """Wait until *nbytes* fit into the budget and reserve them.
+
+        :return: The number of bytes actually reserved, to be passed to :meth:`release`."""
+        nbytes = max(0, min(nbytes, self.limit))
+        if not self._waiters and self.used + nbytes <= self.limit:
+            self.used += nbytes
+            return nbytes
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append((nbytes, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                # Still queued; dropping out may let the next waiter in.
+                self._wake()
+            else:
+                # Granted just before the cancellation arrived.
+                self.release(nbytes)
+            raise
+        return nbytes
+
+    def release(self, nbytes: int) -> None:
+        """Return a reservation obtained from :meth:`acquire`."""
+        self.used -= nbytes
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters:
+            nbytes, fut = self._waiters[0]
+            if fut.done():
+                self._waiters.popleft()
+                continue
+            if self.used + nbytes > self.limit:
+                break
+            self._waiters.popleft()
+            self.used += nbytes
+            fut.set_result(None)
@@ -0,0 +1,138 @@
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from mautrix.util.async_db import Connection, Database, UpgradeTable
+
+upgrade_table = UpgradeTable()
+
+
+@upgrade_table.register(description="Add content-addressed table of uploaded media")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE media_blob (
+            sha256     TEXT PRIMARY KEY,
+            mxc        TEXT NOT NULL,
+            info       TEXT NOT NULL,
+            created_at BIGINT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add journal of unfinished jobs")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE job (
+            id           TEXT PRIMARY KEY,
+            room_id      TEXT NOT NULL,
+            event_id     TEXT NOT NULL,
+            platform     TEXT NOT NULL,
+            url          TEXT NOT NULL,
+            stage        TEXT NOT NULL,
+            download_url TEXT,
+            spool_path   TEXT,
+            validator    TEXT,
+            sent         TEXT NOT NULL,
+            created_at   BIGINT NOT NULL,
+            updated_at   BIGINT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Add cache of upstream metadata responses")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE metadata_cache (
+            key        TEXT PRIMARY KEY,
+            status     INTEGER NOT NULL,
+            url        TEXT NOT NULL,
+            headers    TEXT NOT NULL,
+            body       TEXT NOT NULL,
+            fetched_at BIGINT NOT NULL,
+            expires_at BIGINT NOT NULL
+        )"""
+    )
+
+
+class BlobStore:
+    """Maps the SHA-256 of downloaded media to the mxc URI and info of its upload."""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def get(self, sha256: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        row = await self.db.fetchrow("SELECT mxc, info FROM media_blob WHERE sha256=$1", sha256)
+        if row is None:
+            return None
+        return row["mxc"], json.loads(row["info"])
+
+    async def put(self, sha256: str, mxc: str, info: Dict[str, Any]) -> None:
+        await self.db.execute(
+            """INSERT INTO media_blob (sha256, mxc, info, created_at) VALUES ($1, $2, $3, $4)
+               ON CONFLICT (sha256) DO UPDATE SET mxc=excluded.mxc, info=excluded.info""",
+            sha256, mxc, json.dumps(info), int(time.time() * 1000),
+        )
+
+
+@dataclass
+class JournalEntry:
+    id: str
+    room_id: str
+    event_id: str
+    platform: str
+    url: str
+    stage: str = "queued"
+    #: The download in progress, and the spool file and validator it can be resumed from.
+    download_url: Optional[str] = None
+    spool_path: Optional[str] = None
+    validator: Optional[str] = None
+    #: Source URLs of the media the job has already sent.
+    sent: Set[str] = field(default_factory=set)
+    created_at: int = 0
+
+    def resume_for(self, url: str) -> Optional[Tuple[str, str]]:
+        """The spool file and validator an interrupted download of *url* can be continued from."""
+        if self.download_url == url and self.spool_path and self.validator:
+            return self.spool_path, self.validator
+        return None
+
+
+class JobJournal:
+    """Queued and running jobs, with their stage and partial download, so that they can be resumed after a crash."""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def add(self, room_id: str, event_id: str, platform: str, url: str) -> JournalEntry:
+        entry = JournalEntry(f"{room_id} {event_id} {url}", room_id, event_id, platform, url,
+                             created_at=int(time.time() * 1000))
+        await self.db.execute(
+            """INSERT INTO job (id, room_id, event_id, platform, url, stage, sent, created_at, updated_at)
+               VALUES ($1, $2, $3, $4, $5, $6, '[]', $7, $7)
+               ON CONFLICT (id) DO UPDATE SET stage=excluded.stage, updated_at=excluded.updated_at""",
+            entry.id, room_id, event_id, platform, url, entry.stage, entry.created_at,
+        )
+        return entry
+
+    async def update(self, entry: JournalEntry) -> None:
+        await self.db.execute(
+            """UPDATE job SET stage=$2, download_url=$3, spool_path=$4, validator=$5, sent=$6, updated_at=$7
+               WHERE id=$1""",
+            entry.id, entry.stage, entry.download_url, entry.spool_path, entry.validator,
+            json.dumps(sorted(entry.sent)), int(time.time() * 1000),
+        )
+
+    async def finish(self, entry: JournalEntry) -> None:
+        await self.db.execute("DELETE FROM job WHERE id=$1", entry.id)
+
+    async def unfinished(self) -> List[JournalEntry]:
+        rows = await self.db.fetch(
+            """SELECT id, room_id, event_id, platform, url, stage, download_url, spool_path, validator, sent,
+                      created_at
+               FROM job ORDER BY created_at"""
+        )
+        return [JournalEntry(row["id"], row["room_id"], row["event_id"], row["platform"], row["url"], row["stage"],
+                             row["download_url"], row["spool_path"], row["validator"], set(json.loads(row["sent"])),
+                             row["created_at"])
+                for row in rows]
@@ -0,0 +1,265 @@
+import asyncio
+import os
+import random
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncContextManager, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from .budget import MemoryBudget
+from .media import Media
+
+#: Longest wait between two attempts to continue a download.
+MAX_BACKOFF = 30.0
+
+#: Called with the expected size of a body, if known, for a context to read it in; see :meth:`Downloader.fetch`.
+TransferGate = Callable[[Optional[int]], AsyncContextManager[None]]
+
+
+@asynccontextmanager
+async def _ungated(size: Optional[int]) -> AsyncIterator[None]:
+    yield
+
+
+class DownloadError(Exception):
+    """Raised when a media URL does not answer with HTTP 200."""
+
+    def __init__(self, url: str, status: int):
+        super().__init__(f"HTTP {status} when fetching {url}")
+        self.url = url
+        self.status = status
+
+
+class DownloadRefused(Exception):
+    """Raised by a transfer gate to drop a download once its expected size is known; see :meth:`Downloader.fetch`."""
+
+
+class Downloader:
+    """Fetches media into :class:`Media` payloads while keeping memory use within a :class:`MemoryBudget`.
+
+    Each download reserves its expected size before the body is read: the ``Content-Length`` of the response, or
+    else the *expected_size* passed to :meth:`fetch`, which handlers take from the platform's metadata where it
+    reports one. Downloads of unknown size reserve *spill_threshold* bytes and continue in a spool file once they
+    outgrow it. Downloads expected to be larger than *spool_threshold* are
+    written to a spool file in *spool_dir* from the start and reserve no memory at all.
+
+    Responses of at least *parallel_threshold* bytes from servers that advertise ``Accept-Ranges: bytes`` are split
+    into *parallel_ranges* byte ranges which are fetched concurrently into a preallocated payload.
+
+    When the connection drops during a download from a server that supports ranges, the download is continued
+    from the last byte received with a ``Range`` request validated by ``If-Range``, up to *range_attempts* times;
+    parallel downloads continue each range on its own. Attempts are spaced by an exponential backoff starting at
+    *retry_backoff* seconds, with full jitter so that downloads that failed together do not retry together.
+
+    Sequential downloads into a spool file can also be continued after a restart, see :meth:`fetch`.
+
+    *budget_wait*, if given, is entered while a reservation has to wait for room in the budget, e.g. to give up a
+    scheduler slot in the meantime.
+    """
+
+    def __init__(self, http: aiohttp.ClientSession, budget: MemoryBudget, spill_threshold: int,
+                 spool_threshold: int, spool_dir: Optional[str] = None, chunk_size: int = 64 * 1024,
+                 parallel_ranges: int = 1, parallel_threshold: int = 0, range_attempts: int = 3,
+                 retry_backoff: float = 0.5,
+                 budget_wait: Optional[Callable[[], AsyncContextManager[None]]] = None):
+        self.http = http
+        self.budget = budget
+        self.spill_threshold = spill_threshold
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.chunk_size = chunk_size
+        self.parallel_ranges = parallel_ranges
+        self.parallel_threshold = parallel_threshold
+        self.range_attempts = range_attempts
+        self.retry_backoff = retry_backoff
+        self.budget_wait = budget_wait
+
+    async def open(self, expected_size: Optional[int] = None,
+                   on_spill: Optional[Callable[[str], None]] = None) -> Media:
+        """Reserve memory for a payload of *expected_size* bytes and return an empty :class:`Media` for it."""
+        if expected_size and expected_size > self.spool_threshold:
+            return Media(0, self.spool_dir, on_spill=on_spill)
+        nbytes = expected_size if expected_size else self.spill_threshold
+        if self.budget_wait is None or self.budget.fits(nbytes):
+            reserved = await self.budget.acquire(nbytes)
+        else:
+            async with self.budget_wait():
+                reserved = await self.budget.acquire(nbytes)
+        return Media(reserved, self.spool_dir, on_close=lambda: self.budget.release(reserved), on_spill=on_spill)
+
+    async def fetch(self, url, headers: Optional[Dict[str, str]] = None, expected_size: Optional[int] = None,
+                    resume: Optional[Tuple[str, str]] = None,
+                    on_spool: Optional[Callable[[str, str], None]] = None,
+                    transfer: Optional[TransferGate] = None) -> Media:
+        """Download *url* into a new :class:`Media`. The caller is responsible for closing it.
+
+        :param resume: Path and validator (``ETag`` or ``Last-Modified``) of a spool file holding the start of an
+           interrupted download of *url*. The download continues from its end if the server still serves the same
+           entity and supports ranges; otherwise the file is deleted and the download starts over.
+        :param on_spool: Called with the path and validator once a download that could be resumed like this is
+           written to a spool file.
+        :param transfer: Entered around reading the body, once its memory has been reserved, e.g. to hold a
+           transfer slot. Taking a slot only then keeps downloads that hold one from waiting for memory that only
+           jobs waiting for a slot could give back. It can raise :class:`DownloadRefused` to drop the download
+           before its body is read.
+        :raises DownloadError: When the server does not respond with 200."""
+        transfer = transfer or _ungated
+        offset = 0
+        request_headers = headers
+        if resume is not None:
+            path, validator = resume
+            with suppress(OSError):
+                offset = os.path.getsize(path)
+            if offset:
+                request_headers = {**(headers or {}), "Range": f"bytes={offset}-", "If-Range": validator}
+        async with self.http.get(url, headers=request_headers) as response:
+            if resume is not None:
+                content_range = response.headers.get("Content-Range", "")
+                if offset and response.status == 206 and content_range.startswith(f"bytes {offset}-"):
+                    return await self._continue(url, headers, resume, response, transfer)
+                if offset and response.status == 416 and content_range == f"bytes */{offset}":
+                    # The download was complete when it was interrupted.
+                    return await self._continue(url, headers, resume, None, transfer)
+                # The server no longer has the same entity or ignored the range; start over.
+                with suppress(OSError):
+                    os.unlink(resume[0])
+                if response.status != 200:
+                    return await self.fetch(url, headers, expected_size, on_spool=on_spool, transfer=transfer)
+            if response.status != 200:
+                raise DownloadError(str(url), response.status)
+            size = response.content_length
+            ranged = self._supports_ranges(response)
+            validator = self._resumable(response)
+            on_spill = None
+            if on_spool is not None and validator and not ranged:
+                on_spill = lambda path: on_spool(path, validator)
+            media = await self.open(size or expected_size, on_spill=on_spill)
+            try:
+                async with transfer(size or expected_size):
+                    if ranged:
+                        await self._fetch_ranges(url, headers, response, media, size)
+                    else:
+                        await self._read_resuming(url, headers, validator, media, response)
+            except BaseException:
+                media.close()
+                raise
+        return media
+
+    async def _continue(self, url, headers: Optional[Dict[str, str]], resume: Tuple[str, str],
+                        response: Optional[aiohttp.ClientResponse], transfer: TransferGate) -> Media:
+        path, validator = resume
+        media = Media(0, self.spool_dir)
+        try:
+            media.adopt(path)
+            if response is not None:
+                async with transfer(response.content_length):
+                    await self._read_resuming(url, headers, validator, media, response)
+        except BaseException:
+            media.close()
+            raise
+        return media
+
+    async def read_into(self, media: Media, response: aiohttp.ClientResponse) -> None:
+        """Append the body of *response* to *media*."""
+        async for chunk in response.content.iter_chunked(self.chunk_size):
+            media.write(chunk)
+
+    async def _read_resuming(self, url, headers: Optional[Dict[str, str]], validator: Optional[str], media: Media,
+                             response: aiohttp.ClientResponse) -> None:
+        """Append the body of *response* to *media*, continuing from the last byte received if the connection
+        drops and *validator* identifies the entity."""
+        for attempt in range(1, self.range_attempts + 1):
+            try:
+                if response is None:
+                    await asyncio.sleep(self.backoff(attempt - 1))
+                    range_headers = {**(headers or {}), "Range": f"bytes={media.size}-", "If-Range": validator}
+                    response = await self.http.get(url, headers=range_headers)
+                    if (response.status != 206
+                            or not response.headers.get("Content-Range", "").startswith(f"bytes {media.size}-")):
+                        raise DownloadError(str(url), response.status)
+                # aiohttp raises ClientPayloadError if the body ends before its Content-Length.
+                await self.read_into(media, response)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if validator is None or attempt == self.range_attempts:
+                    raise
+            finally:
+                if response is not None:
+                    response.release()
+                    response = None
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait before retry number *attempt*."""
+        return random.uniform(0, min(MAX_BACKOFF, self.retry_backoff * 2 ** (attempt - 1)))
+
+    @staticmethod
+    def _resumable(response: aiohttp.ClientResponse) -> Optional[str]:
+        """The validator to continue *response* with in a range request, if the server supports those."""
+        if (response.headers.get("Accept-Ranges", "").lower() != "bytes"
+                # Ranges refer to the encoded body, which aiohttp decodes on the fly.
+                or "Content-Encoding" in response.headers):
+            return None
+        etag = response.headers.get("ETag")
+        # If-Range only accepts strong entity tags.
+        if etag and not etag.startswith("W/"):
+            return etag
+        return response.headers.get("Last-Modified")
+
+    def _supports_ranges(self, response: aiohttp.ClientResponse) -> bool:
+        return (self.parallel_ranges > 1
+                and response.headers.get("Accept-Ranges", "").lower() == "bytes"
+                and response.content_length is not None
+                and response.content_length >= max(self.parallel_threshold, 2 * self.chunk_size)
+                # Content-Length and ranges refer to the encoded body, which aiohttp decodes on the fly.
+                and "Content-Encoding" not in response.headers)
+
+    def _split(self, size: int) -> List[Tuple[int, int]]:
+        part_size = max(-(-size // self.parallel_ranges), self.chunk_size)
+        return [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+
+    async def _fetch_ranges(self, url, headers: Optional[Dict[str, str]], response: aiohttp.ClientResponse,
+                            media: Media, size: int) -> None:
+        media.allocate(size)
+        # Ranges only make sense against the exact same entity as the first response.
+        validator = self._resumable(response)
+        ranges = self._split(size)
+        tasks = [asyncio.create_task(self._fetch_range(url, headers, validator, media, start, end))
+                 for start, end in ranges[1:]]
+        try:
+            # The response we already have covers the first range; it is cut off once that range is complete.
+            first_start, first_end = ranges[0]
+            await self._fetch_range(url, headers, validator, media, first_start, first_end, response)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _fetch_range(self, url, headers: Optional[Dict[str, str]], validator: Optional[str], media: Media,
+                           start: int, end: int, response: Optional[aiohttp.ClientResponse] = None) -> None:
+        position = start
+        for attempt in range(1, self.range_attempts + 1):
+            try:
+                if response is None:
+                    if attempt > 1:
+                        await asyncio.sleep(self.backoff(attempt - 1))
+                    range_headers = dict(headers or {})
+                    range_headers["Range"] = f"bytes={position}-{end - 1}"
+                    if validator:
+                        range_headers["If-Range"] = validator
+                    response = await self.http.get(url, headers=range_headers)
+                    if response.status != 206:
+                        raise DownloadError(str(url), response.status)
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    chunk = chunk[:end - position]
+                    media.write_at(position, chunk)
+                    position += len(chunk)
+                    if position >= end:
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError):
+                if attempt == self.range_attempts:
+                    raise
+            finally:
+                if response is not None:
+                    response.release()
+                    response = None
+        raise aiohttp.ClientPayloadError(f"Incomplete range {start}-{end - 1} of {url}")
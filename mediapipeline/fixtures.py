@@ -0,0 +1,292 @@
+"""Recording and replay of upstream HTTP traffic, for benchmarking against real payloads without network access.
+
+:class:`FixtureSession` stands in for the aiohttp sessions of the plugin and of its Instaloader context; it records
+into or replays from a :class:`FixtureStore`.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+import urllib.parse
+from dataclasses import dataclass
+from http.cookies import SimpleCookie
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+import yarl
+from multidict import CIMultiDict, CIMultiDictProxy
+
+MEDIA_TYPES = ("image/", "video/", "audio/", "application/octet-stream", "application/mp4")
+
+#: Response headers that describe the transfer rather than the entity, and no longer apply to a stored body.
+_TRANSFER_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+
+class FixtureMissing(aiohttp.ClientConnectionError):
+    """A replayed request was not recorded."""
+
+    def __init__(self, key: str):
+        super().__init__(f"No recorded response for {key}")
+        self.key = key
+
+
+@dataclass
+class Exchange:
+    status: int
+    reason: str
+    url: str
+    headers: List[Tuple[str, str]]
+    body: bytes
+    #: Seconds until the response headers arrived, and until the whole body had been received.
+    ttfb: float
+    duration: float
+
+
+def _body_key(data: Any = None, json_body: Any = None) -> Optional[bytes]:
+    if json_body is not None:
+        return json.dumps(json_body, sort_keys=True).encode("utf-8")
+    if isinstance(data, dict):
+        return urllib.parse.urlencode(sorted(data.items())).encode("utf-8")
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    return None
+
+
+class FixtureStore:
+    """Request/response pairs stored in *directory*.
+
+    ``index.jsonl`` holds one line per exchange and ``bodies/`` the response bodies, named by their SHA-256 so that
+    repeated payloads are stored once. Media bodies are kept whole (*media* ``"full"``), cut to *media_limit* bytes
+    (``"truncate"``) or dropped with only their hash kept (``"hash"``); cut bodies are padded with zeros to their
+    recorded size when they are replayed. Requests that were recorded several times are replayed in order, and
+    replay starts over once all recordings of a request have been served.
+    """
+
+    def __init__(self, directory: str, media: str = "full", media_limit: int = 64 * 1024):
+        if media not in ("full", "truncate", "hash"):
+            raise ValueError(f"Unknown media mode {media!r}")
+        self.directory = directory
+        self.media = media
+        self.media_limit = media_limit
+        self._bodies = os.path.join(directory, "bodies")
+        self._index = os.path.join(directory, "index.jsonl")
+        self._entries: Dict[str, List[dict]] = {}
+        self._cursors: Dict[str, int] = {}
+        os.makedirs(self._bodies, exist_ok=True)
+        if os.path.exists(self._index):
+            with open(self._index, encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries.setdefault(entry["key"], []).append(entry)
+
+    @staticmethod
+    def key(method: str, url: str, range_header: Optional[str] = None, body: Optional[bytes] = None) -> str:
+        key = f"{method.upper()} {url}"
+        if range_header:
+            key += f" [{range_header}]"
+        if body:
+            key += f" #{hashlib.sha256(body).hexdigest()[:16]}"
+        return key
+
+    def record(self, key: str, exchange: Exchange) -> None:
+        content_type = next((value for name, value in exchange.headers if name.lower() == "content-type"), "")
+        stored = exchange.body
+        if self.media != "full" and content_type.startswith(MEDIA_TYPES):
+            stored = stored[:self.media_limit] if self.media == "truncate" else b""
+        digest = hashlib.sha256(stored).hexdigest()
+        path = os.path.join(self._bodies, digest)
+        if not os.path.exists(path):
+            with open(f"{path}.tmp", "wb") as file:
+                file.write(stored)
+            os.replace(f"{path}.tmp", path)
+        entry = {
+            "key": key,
+            "status": exchange.status,
+            "reason": exchange.reason,
+            "url": exchange.url,
+            "headers": [(name, value) for name, value in exchange.headers if name.lower() not in _TRANSFER_HEADERS],
+            "body": digest,
+            "size": len(exchange.body),
+            "sha256": hashlib.sha256(exchange.body).hexdigest() if stored is not exchange.body else digest,
+            "ttfb": round(exchange.ttfb, 4),
+            "duration": round(exchange.duration, 4),
+        }
+        self._entries.setdefault(key, []).append(entry)
+        with open(self._index, "a", encoding="utf-8") as file:
+            file.write(json.dumps(entry) + "\n")
+
+    def lookup(self, key: str) -> Optional[Exchange]:
+        entries = self._entries.get(key)
+        if not entries:
+            return None
+        cursor = self._cursors.get(key, 0)
+        self._cursors[key] = cursor + 1
+        entry = entries[cursor % len(entries)]
+        with open(os.path.join(self._bodies, entry["body"]), "rb") as file:
+            body = file.read()
+        if len(body) < entry["size"]:
+            body += bytes(entry["size"] - len(body))
+        return Exchange(entry["status"], entry["reason"], entry["url"], [tuple(h) for h in entry["headers"]], body,
+                        entry["ttfb"], entry["duration"])
+
+
+class _FixtureStream:
+    """The part of :class:`aiohttp.StreamReader` that the plugin reads bodies with."""
+
+    def __init__(self, body: bytes, transfer_time: float):
+        self._body = memoryview(body)
+        self._position = 0
+        self._rate = len(body) / transfer_time if transfer_time > 0 and body else 0
+
+    async def read(self, n: int = -1) -> bytes:
+        end = len(self._body) if n < 0 else min(len(self._body), self._position + n)
+        chunk = bytes(self._body[self._position:end])
+        self._position = end
+        if self._rate:
+            await asyncio.sleep(len(chunk) / self._rate)
+        return chunk
+
+    async def iter_chunked(self, n: int) -> AsyncIterator[bytes]:
+        while chunk := await self.read(n):
+            yield chunk
+
+    async def iter_any(self) -> AsyncIterator[bytes]:
+        async for chunk in self.iter_chunked(64 * 1024):
+            yield chunk
+
+    def at_eof(self) -> bool:
+        return self._position >= len(self._body)
+
+
+class FixtureResponse:
+    """A recorded response with the interface of :class:`aiohttp.ClientResponse` that the plugin uses."""
+
+    def __init__(self, method: str, exchange: Exchange, timing: bool):
+        self.method = method
+        self.status = exchange.status
+        self.reason = exchange.reason
+        self.url = yarl.URL(exchange.url, encoded=True)
+        headers = CIMultiDict((name, value) for name, value in exchange.headers
+                              if name.lower() not in _TRANSFER_HEADERS)
+        headers["Content-Length"] = str(len(exchange.body))
+        self.headers = CIMultiDictProxy(headers)
+        self.cookies: SimpleCookie = SimpleCookie()
+        for value in headers.getall("Set-Cookie", []):
+            self.cookies.load(value)
+        self._body = exchange.body
+        self.content = _FixtureStream(exchange.body, exchange.duration - exchange.ttfb if timing else 0)
+
+    @property
+    def content_length(self) -> Optional[int]:
+        return len(self._body)
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    async def read(self) -> bytes:
+        if not self.content.at_eof():
+            await self.content.read()
+        return self._body
+
+    async def text(self, encoding: Optional[str] = None) -> str:
+        return (await self.read()).decode(encoding or "utf-8", errors="replace")
+
+    async def json(self, **kwargs) -> Any:
+        return json.loads(await self.text())
+
+    def raise_for_status(self) -> None:
+        if not self.ok:
+            raise aiohttp.ClientResponseError(None, (), status=self.status, message=self.reason)
+
+    def release(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    async def __aenter__(self) -> "FixtureResponse":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.release()
+
+
+class _FixtureRequest:
+    """Makes :meth:`FixtureSession.request` usable both with ``await`` and with ``async with``."""
+
+    def __init__(self, coro):
+        self._coro = coro
+        self._response: Optional[FixtureResponse] = None
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self) -> FixtureResponse:
+        self._response = await self._coro
+        return self._response
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._response.release()
+
+
+class FixtureSession:
+    """Stands in for an aiohttp session: records the traffic of *session* into *store*, or, without a session,
+    replays it from *store*, waiting for the recorded response times if *timing* is set.
+
+    Recorded responses are read whole before they are handed on, so recording holds each body in memory once.
+    """
+
+    def __init__(self, store: FixtureStore, session: Optional[aiohttp.ClientSession] = None, timing: bool = True):
+        self.store = store
+        self.session = session
+        self.timing = timing
+
+    @property
+    def recording(self) -> bool:
+        return self.session is not None
+
+    def request(self, method: str, url, **kwargs) -> _FixtureRequest:
+        return _FixtureRequest(self._request(method, url, **kwargs))
+
+    def get(self, url, **kwargs) -> _FixtureRequest:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs) -> _FixtureRequest:
+        return self.request("POST", url, **kwargs)
+
+    def head(self, url, **kwargs) -> _FixtureRequest:
+        return self.request("HEAD", url, **kwargs)
+
+    async def _request(self, method: str, url, **kwargs) -> FixtureResponse:
+        full_url = yarl.URL(url) if not isinstance(url, yarl.URL) else url
+        if kwargs.get("params"):
+            full_url = full_url.update_query(kwargs["params"])
+        range_header = (kwargs.get("headers") or {}).get("Range")
+        key = self.store.key(method, str(full_url), range_header, _body_key(kwargs.get("data"), kwargs.get("json")))
+        if not self.recording:
+            exchange = self.store.lookup(key)
+            if exchange is None:
+                raise FixtureMissing(key)
+            if self.timing:
+                await asyncio.sleep(exchange.ttfb)
+            return FixtureResponse(method, exchange, self.timing)
+
+        start = time.monotonic()
+        async with self.session.request(method, url, **kwargs) as response:
+            ttfb = time.monotonic() - start
+            body = await response.read()
+            exchange = Exchange(response.status, response.reason or "", str(response.url),
+                                list(response.headers.items()), body, ttfb, time.monotonic() - start)
+        self.store.record(key, exchange)
+        return FixtureResponse(method, exchange, timing=False)
+
+    def __getattr__(self, name: str) -> Any:
+        if self.session is None:
+            raise AttributeError(name)
+        return getattr(self.session, name)
+
@@ -0,0 +1,71 @@
+import asyncio
+import weakref
+from typing import Dict, Set
+
+
+class JobRegistry:
+    """Running jobs by the room and event that triggered them, so that they can be cancelled.
+
+    Each job runs in its own task, started by the caller and awaited with :meth:`run`. Cancelling a job through
+    :meth:`cancel_event` or :meth:`cancel_room` only ends that task; the caller sees :meth:`run` return False and
+    carries on.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Set[asyncio.Task]]] = {}
+        self._cancelled: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+
+    def __len__(self) -> int:
+        return sum(len(tasks) for events in self._jobs.values() for tasks in events.values())
+
+    async def run(self, room_id: str, event_id: str, job: asyncio.Task) -> bool:
+        """Wait for *job*, registered as triggered by *event_id* in *room_id*.
+
+        :return: False if the job was cancelled through the registry, True if it ran to completion.
+        :raises: Whatever the job raised."""
+        tasks = self._jobs.setdefault(room_id, {}).setdefault(event_id, set())
+        tasks.add(job)
+        try:
+            # Unlike awaiting the task, asyncio.wait() tells its cancellation apart from our own.
+            await asyncio.wait([job])
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        finally:
+            tasks.discard(job)
+            if not tasks:
+                events = self._jobs[room_id]
+                events.pop(event_id, None)
+                if not events:
+                    del self._jobs[room_id]
+        if job.cancelled():
+            return False
+        job.result()
+        return True
+
+    def cancel_event(self, room_id: str, event_id: str) -> int:
+        """Cancel the jobs triggered by *event_id*; returns how many there were."""
+        tasks = self._jobs.get(room_id, {}).get(event_id, set())
+        for task in tasks:
+            self._cancelled.add(task)
+            task.cancel()
+        return len(tasks)
+
+    def cancelled(self, job: asyncio.Task) -> bool:
+        """Whether *job* was cancelled through the registry, rather than by e.g. a shutdown."""
+        return job in self._cancelled
+
+    async def shutdown(self) -> None:
+        """Cancel all jobs and wait for them to unwind. They do not count as :meth:`cancelled` through the
+        registry, so that they can be picked up again after a restart."""
+        tasks = [task for events in self._jobs.values() for tasks in events.values() for task in tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def cancel_room(self, room_id: str) -> int:
+        """Cancel all jobs in *room_id*; returns how many there were."""
+        cancelled = 0
+        for event_id in list(self._jobs.get(room_id, {})):
+            cancelled += self.cancel_event(room_id, event_id)
+        return cancelled
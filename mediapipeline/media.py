@@ -0,0 +1,243 @@
+import hashlib
+import mmap
+import os
+import tempfile
+from contextlib import suppress
+from typing import AsyncIterator, Callable, Dict, IO, Optional, Union
+
+
+class Media:
+    """Media payload that stays in memory up to its budget reservation and is spooled to a file past it.
+
+    :param spill_threshold: Number of bytes that may be buffered in memory before switching to a spool file.
+       With 0, the payload is written to the spool file from the first byte on.
+    :param spool_dir: Directory for the spool file, or None for the system default.
+    :param on_close: Called once when the payload is closed, used to give the memory reservation back.
+    :param on_spill: Called with the path of the spool file once the payload moves into it.
+
+    The SHA-256 of the payload is computed while it is written, see :meth:`digest`.
+    """
+
+    def __init__(self, spill_threshold: int, spool_dir: Optional[str] = None,
+                 on_close: Optional[Callable[[], None]] = None, on_spill: Optional[Callable[[str], None]] = None):
+        self.spill_threshold = spill_threshold
+        self.spool_dir = spool_dir
+        self.size = 0
+        self.path: Optional[str] = None
+        self._buffer: Optional[bytearray] = bytearray()
+        self._file: Optional[IO[bytes]] = None
+        self._on_close = on_close
+        self._on_spill = on_spill
+        # Whether the file at path belongs to the payload and is deleted with it.
+        self._owned = True
+        self._hash = hashlib.sha256()
+        self._hashed = 0
+        # Regions written with write_at() beyond the hashed prefix, as start -> end and end -> start.
+        self._pending: Dict[int, int] = {}
+        self._pending_ends: Dict[int, int] = {}
+        self._digest: Optional[str] = None
+
+    @classmethod
+    def from_file(cls, path: str, digest: str, spool_dir: Optional[str] = None) -> "Media":
+        """A payload served from the existing file at *path* with SHA-256 *digest*, e.g. a cache entry.
+
+        The file is only read and never deleted; processing the payload with :meth:`replace` or
+        :meth:`replace_content` puts the result into a new spool file instead."""
+        media = cls(0, spool_dir)
+        media._file = open(path, "rb")
+        media._buffer = None
+        media._owned = False
+        media.path = path
+        media.size = os.fstat(media._file.fileno()).st_size
+        media._hash = None
+        media._digest = digest
+        return media
+
+    @property
+    def spilled(self) -> bool:
+        """True if the payload lives in a spool file."""
+        return self._file is not None
+
+    def _spill(self) -> None:
+        fd, self.path = tempfile.mkstemp(suffix=".part", dir=self.spool_dir)
+        self._file = os.fdopen(fd, "w+b")
+        self._file.write(self._buffer)
+        self._buffer = None
+        if self._on_spill is not None:
+            self._on_spill(self.path)
+
+    def adopt(self, path: str) -> None:
+        """Continue the interrupted download kept in the spool file at *path*; its content becomes the start of
+        this (empty) payload and later writes are appended to it."""
+        self._file = open(path, "r+b")
+        self._buffer = None
+        self.path = path
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._hash_stored(0, self.size)
+        self._hashed = self.size
+        self._file.seek(0, os.SEEK_END)
+
+    def write(self, data: bytes) -> None:
+        if self._file is None and self.size + len(data) > self.spill_threshold:
+            self._spill()
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._buffer += data
+        self.size += len(data)
+        if self._hash is not None:
+            self._hash.update(data)
+            self._hashed += len(data)
+
+    def spool(self) -> str:
+        """Move the payload to a spool file if it is not already in one and return the file's path."""
+        if self._file is None:
+            self._spill()
+        self._file.flush()
+        return self.path
+
+    def digest(self) -> Optional[str]:
+        """Hex SHA-256 of the payload as it was downloaded, or None while it is incomplete.
+
+        The digest keeps referring to the downloaded bytes after the payload has been replaced by a processed
+        version with :meth:`replace` or :meth:`replace_content`."""
+        if self._hash is not None and self._digest is None and self._hashed == self.size and not self._pending:
+            self._digest = self._hash.hexdigest()
+        return self._digest
+
+    def _freeze_digest(self) -> None:
+        self.digest()
+        self._hash = None
+
+    def replace(self, path: str) -> None:
+        """Swap the payload for the file at *path*, which must live in the spool directory.
+
+        The previous spool file is deleted and the new file is deleted when the payload is closed."""
+        self._freeze_digest()
+        old_path = self.path
+        if self._file is not None:
+            self._file.close()
+        self._buffer = None
+        self._file = open(path, "r+b")
+        self.path = path
+        self.size = os.fstat(self._file.fileno()).st_size
+        if old_path is not None and old_path != path and self._owned:
+            with suppress(FileNotFoundError):
+                os.unlink(old_path)
+        self._owned = True
+
+    def replace_content(self, data: bytes) -> None:
+        """Swap the payload for *data*, which must not be larger than the current payload."""
+        self._freeze_digest()
+        if self._file is not None:
+            fd, path = tempfile.mkstemp(suffix=".part", dir=self.spool_dir)
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            self.replace(path)
+        else:
+            self._buffer = bytearray(data)
+            self.size = len(data)
+
+    def allocate(self, size: int) -> None:
+        """Preallocate an empty payload of *size* bytes to be filled with :meth:`write_at`."""
+        self._hashed = 0
+        if size > self.spill_threshold:
+            self._spill()
+            self._file.truncate(size)
+        else:
+            self._buffer = bytearray(size)
+        self.size = size
+
+    def write_at(self, offset: int, data: bytes) -> None:
+        """Write *data* at *offset* of a payload preallocated with :meth:`allocate`."""
+        if self._file is not None:
+            self._file.seek(offset)
+            self._file.write(data)
+        else:
+            self._buffer[offset:offset + len(data)] = data
+        if self._hash is not None:
+            self._hash_region(offset, offset + len(data), data)
+
+    def _hash_region(self, start: int, end: int, data: bytes) -> None:
+        if start != self._hashed:
+            # Written ahead of the hashed prefix: remember the region, merged with its neighbours.
+            if start in self._pending_ends:
+                start = self._pending_ends.pop(start)
+            if end in self._pending:
+                end = self._pending.pop(end)
+                del self._pending_ends[end]
+            self._pending[start] = end
+            self._pending_ends[end] = start
+            return
+        self._hash.update(data)
+        self._hashed = end
+        # Catch up with regions that other ranges wrote ahead of the prefix. They were written moments ago, so
+        # reading them back hits memory or the page cache.
+        while self._hashed in self._pending:
+            region_end = self._pending.pop(self._hashed)
+            del self._pending_ends[region_end]
+            self._hash_stored(self._hashed, region_end)
+            self._hashed = region_end
+
+    def _hash_stored(self, start: int, end: int, chunk_size: int = 1024 * 1024) -> None:
+        if self._file is None:
+            self._hash.update(memoryview(self._buffer)[start:end])
+            return
+        self._file.seek(start)
+        while start < end:
+            chunk = self._file.read(min(chunk_size, end - start))
+            if not chunk:
+                break
+            self._hash.update(chunk)
+            start += len(chunk)
+
+    def getvalue(self) -> Union[bytes, bytearray]:
+        """Return the whole payload. Only cheap while the payload is still held in memory."""
+        if self._file is None:
+            return self._buffer
+        self._file.seek(0)
+        return self._file.read()
+
+    async def chunks(self, chunk_size: int = 1024 * 1024) -> AsyncIterator[Union[bytes, memoryview]]:
+        """Iterate over the payload without loading it into memory at once.
+
+        Spooled payloads are memory-mapped and handed out as :class:`memoryview` slices of the mapping, so the
+        upload reads straight from the page cache instead of copying the file into Python objects."""
+        if self._file is None:
+            view = memoryview(self._buffer)
+            for offset in range(0, self.size, chunk_size):
+                yield view[offset:offset + chunk_size]
+            return
+        if self.size == 0:
+            return
+        self._file.flush()
+        mapped = mmap.mmap(self._file.fileno(), self.size, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            for offset in range(0, self.size, chunk_size):
+                yield view[offset:offset + chunk_size]
+        finally:
+            del view
+            with suppress(BufferError):
+                # The consumer may still hold the last slice; the mapping is then released with it.
+                mapped.close()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            if self._owned:
+                with suppress(FileNotFoundError):
+                    os.unlink(self.path)
+            self.path = None
+        self._buffer = None
+        if self._on_close is not None:
+            self._on_close()
+            self._on_close = None
+
+    async def __aenter__(self) -> "Media":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import urllib.parse
+from collections import OrderedDict
+from contextlib import suppress
+from typing import Dict, Optional, Set, Union
+
+from .media import Media
+
+
+def canonical_url(url) -> str:
+    """*url* with the parts that do not change the resource normalised: lower-case scheme and host, no default
+    port, no fragment and the query parameters in sorted order."""
+    parts = urllib.parse.urlsplit(str(url))
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != {"http": 80, "https": 443}.get(parts.scheme.lower()):
+        host = f"{host}:{parts.port}"
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((parts.scheme.lower(), host, parts.path or "/", query, ""))
+
+
+class MediaCache:
+    """Downloaded media kept on disk in *directory*, keyed by content hash and looked up by canonical URL.
+
+    Files are stored once per SHA-256 under ``objects/`` and the least recently used are evicted once they take up
+    more than *max_bytes*. Files are written to a temporary name and renamed into place, so a crash never leaves a
+    truncated entry behind. The index is an append-only log, ``index.jsonl``, that is replayed at startup and
+    rewritten once it has grown to several times the number of entries.
+
+    Hits are returned as :class:`Media` backed by the cached file, which the upload memory-maps instead of reading
+    it into memory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, spool_dir: Optional[str] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.spool_dir = spool_dir
+        self.size = 0
+        self._objects = os.path.join(directory, "objects")
+        self._index_path = os.path.join(directory, "index.jsonl")
+        # SHA-256 -> size, least recently used first.
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._urls: Dict[str, str] = {}
+        self._urls_by_digest: Dict[str, Set[str]] = {}
+        self._log_lines = 0
+        os.makedirs(self._objects, exist_ok=True)
+        self._load()
+        self._index = open(self._index_path, "a", encoding="utf-8")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self._objects, digest)
+
+    def _load(self) -> None:
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r+b") as file:
+                end = 0
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        # The last line of a log that was being appended to during a crash; cut it off, or the
+                        # next record would be appended to it and be lost as well.
+                        file.truncate(end)
+                        break
+                    end += len(line)
+                    self._log_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record[0] == "put":
+                        _, digest, size, url = record
+                        self._add(digest, size, url)
+                    elif record[0] == "hit" and record[1] in self._entries:
+                        self._entries.move_to_end(record[1])
+                    elif record[0] == "del":
+                        self._remove(record[1])
+        # Files that were written but not yet logged when the process died, and unfinished temporary files.
+        with os.scandir(self._objects) as entries:
+            for entry in entries:
+                if entry.name not in self._entries:
+                    with suppress(FileNotFoundError):
+                        os.unlink(entry.path)
+        if self._log_lines > 4 * len(self._entries) + 1000:
+            self._compact()
+
+    def _compact(self) -> None:
+        fd, path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            for digest, size in self._entries.items():
+                urls = self._urls_by_digest.get(digest) or {""}
+                for url in urls:
+                    file.write(json.dumps(["put", digest, size, url]) + "\n")
+        os.replace(path, self._index_path)
+        self._log_lines = sum(len(self._urls_by_digest.get(digest) or {""}) for digest in self._entries)
+
+    def _log(self, *record) -> None:
+        self._index.write(json.dumps(record) + "\n")
+        self._index.flush()
+        self._log_lines += 1
+        if self._log_lines > 4 * len(self._entries) + 1000:
+            self._index.close()
+            self._compact()
+            self._index = open(self._index_path, "a", encoding="utf-8")
+
+    def _add(self, digest: str, size: int, url: str) -> None:
+        if digest not in self._entries:
+            self._entries[digest] = size
+            self.size += size
+        self._entries.move_to_end(digest)
+        if url:
+            previous = self._urls.get(url)
+            if previous is not None and previous != digest:
+                self._urls_by_digest[previous].discard(url)
+            self._urls[url] = digest
+            self._urls_by_digest.setdefault(digest, set()).add(url)
+
+    def _remove(self, digest: str) -> None:
+        size = self._entries.pop(digest, None)
+        if size is None:
+            return
+        self.size -= size
+        for url in self._urls_by_digest.pop(digest, ()):
+            self._urls.pop(url, None)
+
+    def _evict(self, digest: str) -> None:
+        self._remove(digest)
+        with suppress(FileNotFoundError):
+            os.unlink(self._path(digest))
+        self._log("del", digest)
+
+    def digest_for(self, url) -> Optional[str]:
+        """The SHA-256 of the cached content of *url*, if there is any."""
+        return self._urls.get(canonical_url(url))
+
+    def open(self, digest: str) -> Optional[Media]:
+        """The cached content with SHA-256 *digest* as a :class:`Media`, or None if it is not cached."""
+        if digest not in self._entries:
+            return None
+        try:
+            media = Media.from_file(self._path(digest), digest, self.spool_dir)
+        except FileNotFoundError:
+            self._remove(digest)
+            self._log("del", digest)
+            return None
+        self._entries.move_to_end(digest)
+        self._log("hit", digest)
+        return media
+
+    def get(self, url) -> Optional[Media]:
+        """The cached content of *url* as a :class:`Media`, or None if it is not cached."""
+        digest = self.digest_for(url)
+        return self.open(digest) if digest is not None else None
+
+    async def put(self, url, media: Media) -> None:
+        """Add the downloaded content of *media* as the content of *url*.
+
+        Spooled payloads are hard-linked into the cache where the file system allows it, so that caching them does
+        not copy any data."""
+        digest = media.digest()
+        if digest is None or media.size > self.max_bytes:
+            return
+        url = canonical_url(url)
+        if digest not in self._entries:
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self._objects)
+            try:
+                if media.spilled:
+                    os.close(fd)
+                    os.unlink(tmp)
+                    try:
+                        os.link(media.spool(), tmp)
+                    except OSError:
+                        await asyncio.get_running_loop().run_in_executor(None, shutil.copyfile, media.path, tmp)
+                else:
+                    await asyncio.get_running_loop().run_in_executor(None, self._write, fd, media.getvalue())
+                os.replace(tmp, self._path(digest))
+            except BaseException:
+                with suppress(FileNotFoundError):
+                    os.unlink(tmp)
+                raise
+        self._add(digest, media.size, url)
+        self._log("put", digest, media.size, url)
+        while self.size > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    @staticmethod
+    def _write(fd: int, data: Union[bytes, bytearray]) -> None:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+
+    def close(self) -> None:
+        self._index.close()
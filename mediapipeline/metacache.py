@@ -0,0 +1,122 @@
+import json
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+from mautrix.util.async_db import Database
+
+from .fixtures import Exchange, FixtureResponse
+from .lru import LRUCache
+from .mediacache import canonical_url
+
+#: Response headers that are kept with a cached response.
+_KEPT_HEADERS = ("content-type", "etag", "last-modified")
+
+
+@dataclass
+class CachedMetadata:
+    status: int
+    url: str
+    headers: List[Tuple[str, str]]
+    body: bytes
+    #: When the response was fetched or last revalidated, and until when it is served without asking upstream,
+    #: both in milliseconds since the epoch.
+    fetched_at: int
+    expires_at: int
+
+    def response(self) -> FixtureResponse:
+        # Served as the same kind of buffered response that fixture replay hands out.
+        return FixtureResponse("GET", Exchange(self.status, "OK", self.url, self.headers, self.body, 0, 0),
+                               timing=False)
+
+    def header(self, name: str) -> Optional[str]:
+        return next((value for key, value in self.headers if key.lower() == name), None)
+
+
+class MetadataStore:
+    """Persists :class:`MetadataCache` entries in the plugin database, so that they survive restarts."""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def get(self, key: str) -> Optional[CachedMetadata]:
+        row = await self.db.fetchrow(
+            "SELECT status, url, headers, body, fetched_at, expires_at FROM metadata_cache WHERE key=$1", key)
+        if row is None:
+            return None
+        return CachedMetadata(row["status"], row["url"], [tuple(h) for h in json.loads(row["headers"])],
+                              row["body"].encode("utf-8"), row["fetched_at"], row["expires_at"])
+
+    async def put(self, key: str, entry: CachedMetadata) -> None:
+        await self.db.execute(
+            """INSERT INTO metadata_cache (key, status, url, headers, body, fetched_at, expires_at)
+               VALUES ($1, $2, $3, $4, $5, $6, $7)
+               ON CONFLICT (key) DO UPDATE SET status=excluded.status, url=excluded.url, headers=excluded.headers,
+                   body=excluded.body, fetched_at=excluded.fetched_at, expires_at=excluded.expires_at""",
+            key, entry.status, entry.url, json.dumps(entry.headers), entry.body.decode("utf-8", errors="replace"),
+            entry.fetched_at, entry.expires_at,
+        )
+
+    async def prune(self, before: int) -> None:
+        """Forget entries that expired before *before* (milliseconds since the epoch)."""
+        await self.db.execute("DELETE FROM metadata_cache WHERE expires_at < $1", before)
+
+
+class MetadataCache:
+    """Metadata responses of upstream APIs, kept for a time to live and revalidated once it has passed.
+
+    :meth:`get` answers from memory (or the optional *store*) while an entry is fresh. A stale entry that came with
+    an ``ETag`` or ``Last-Modified`` is revalidated with ``If-None-Match``/``If-Modified-Since``; a 304 keeps it
+    for another time to live without transferring the body again. Only 200 responses are cached.
+    """
+
+    def __init__(self, http: aiohttp.ClientSession, max_entries: int, store: Optional[MetadataStore] = None):
+        self.http = http
+        self.store = store
+        self._entries: LRUCache[str, CachedMetadata] = LRUCache(max_entries)
+
+    async def _lookup(self, key: str) -> Optional[CachedMetadata]:
+        entry = self._entries.get(key)
+        if entry is None and self.store is not None:
+            entry = await self.store.get(key)
+            if entry is not None:
+                self._entries[key] = entry
+        return entry
+
+    async def _store(self, key: str, entry: CachedMetadata) -> None:
+        self._entries[key] = entry
+        if self.store is not None:
+            await self.store.put(key, entry)
+
+    async def get(self, url, ttl: float, headers: Optional[Dict[str, str]] = None,
+                  **kwargs) -> Tuple[FixtureResponse, str]:
+        """GET *url* through the cache, keeping a 200 response for *ttl* seconds.
+
+        :return: The response, with its body already read, and how it was served: ``"hit"``, ``"revalidated"`` or
+           ``"miss"``."""
+        key = canonical_url(url)
+        now = int(time.time() * 1000)
+        entry = await self._lookup(key)
+        if entry is not None and now < entry.expires_at:
+            return entry.response(), "hit"
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry.header("etag"):
+                request_headers["If-None-Match"] = entry.header("etag")
+            if entry.header("last-modified"):
+                request_headers["If-Modified-Since"] = entry.header("last-modified")
+        async with self.http.get(url, headers=request_headers, **kwargs) as response:
+            if response.status == 304 and entry is not None:
+                entry.fetched_at, entry.expires_at = now, now + int(ttl * 1000)
+                await self._store(key, entry)
+                return entry.response(), "revalidated"
+            body = await response.read()
+            fetched = CachedMetadata(response.status, str(response.url),
+                                     [(name, value) for name, value in response.headers.items()
+                                      if name.lower() in _KEPT_HEADERS],
+                                     body, now, now + int(ttl * 1000))
+        if fetched.status == 200:
+            await self._store(key, fetched)
+        return fetched.response(), "miss"
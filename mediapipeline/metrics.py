@@ -0,0 +1,201 @@
+"""Minimal Prometheus instrumentation for the download pipeline, rendered in the text exposition format."""
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import aiohttp
+
+from .download import DownloadError
+from .tracing import Tracer
+
+#: Platform of the job running in the current task, used as the ``platform`` label.
+current_platform: ContextVar[str] = ContextVar("current_platform", default="none")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> Iterator[Tuple[str, LabelValues, float, Sequence[str]]]:
+        """The samples to render: name suffix, label values, value and the names of any extra labels."""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, values, value, extra_names in self.samples():
+            labels = _format_labels(self.labelnames + tuple(extra_names), values)
+            lines.append(f"{self.name}{suffix}{labels} {value:g}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield "", key, value, ()
+
+
+class Gauge(Metric):
+    """Gauge whose value is set directly or read from a callback at render time."""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        self._functions[self._key(labels)] = function
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield "", key, value, ()
+        for key, function in self._functions.items():
+            yield "", key, function(), ()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self._sums[key] = self._sums.get(key, 0) + value
+
+    def samples(self):
+        for key, counts in self._counts.items():
+            for bound, count in zip(self.buckets, counts):
+                yield "_bucket", key + (f"{bound:g}",), count, ("le",)
+            yield "_bucket", key + ("+Inf",), counts[-1], ("le",)
+            yield "_sum", key, self._sums[key], ()
+            yield "_count", key, counts[-1], ()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+def _error_label(err: BaseException) -> str:
+    if isinstance(err, DownloadError):
+        return str(err.status)
+    if isinstance(err, aiohttp.ClientResponseError):
+        return str(err.status)
+    return type(err).__name__
+
+
+class PipelineMetrics:
+    """The metrics of the SocialMediaDownload pipeline.
+
+    Stages are ``extract``, ``schedule``, ``metadata``, ``download``, ``transcode``, ``reencode``, ``probe``, ``upload`` and
+    ``send``; every metric is labelled with the platform from :data:`current_platform`. With a *tracer*, every
+    stage is also recorded as a span of the current job's trace.
+    """
+
+    def __init__(self, tracer: Optional[Tracer] = None):
+        self.tracer = tracer
+        self.registry = Registry()
+        self.stage_seconds = self.registry.register(Histogram(
+            "smd_stage_duration_seconds", "Latency of pipeline stages.", ("platform", "stage")))
+        self.stage_errors = self.registry.register(Counter(
+            "smd_stage_errors_total", "Failed pipeline stages by HTTP status code or exception type.",
+            ("platform", "stage", "status")))
+        self.bytes = self.registry.register(Counter(
+            "smd_bytes_total", "Bytes moved by pipeline stages.", ("platform", "stage")))
+        self.cache = self.registry.register(Counter(
+            "smd_cache_requests_total", "Cache lookups by cache and result.", ("cache", "result")))
+        self.jobs = self.registry.register(Counter(
+            "smd_jobs_total", "Links handled, by platform.", ("platform",)))
+        self.jobs_cancelled = self.registry.register(Counter(
+            "smd_jobs_cancelled_total", "Links whose handling was cancelled, by reason.", ("reason",)))
+        self.backlog = self.registry.register(Counter(
+            "smd_backlog_messages_total", "Messages older than catchup.max_age, by what happened to them.",
+            ("action",)))
+        self.queue_depth = self.registry.register(Gauge(
+            "smd_queue_depth", "Jobs waiting for a shared resource.", ("queue",)))
+        self.loop_lag = self.registry.register(Histogram(
+            "smd_event_loop_lag_seconds", "How late the event loop runs scheduled callbacks.",
+            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)))
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Time the enclosed block as *stage* and count exceptions escaping it as errors."""
+        platform = current_platform.get()
+        start = time.monotonic()
+        try:
+            if self.tracer is not None:
+                with self.tracer.span(stage, platform=platform):
+                    yield
+            else:
+                yield
+        except Exception as err:
+            self.stage_errors.inc(platform=platform, stage=stage, status=_error_label(err))
+            raise
+        finally:
+            self.stage_seconds.observe(time.monotonic() - start, platform=platform, stage=stage)
+
+    def error(self, stage: str, status) -> None:
+        """Count a failed *stage* that was handled without an exception, e.g. a non-200 response."""
+        self.stage_errors.inc(platform=current_platform.get(), stage=stage, status=str(status))
+
+    def add_bytes(self, stage: str, amount: int) -> None:
+        self.bytes.inc(amount, platform=current_platform.get(), stage=stage)
+
+    def cache_lookup(self, cache: str, hit: bool) -> None:
+        self.cache.inc(cache=cache, result="hit" if hit else "miss")
+
+    def render(self) -> str:
+        return self.registry.render()
@@ -0,0 +1,70 @@
+import asyncio
+import math
+from contextlib import asynccontextmanager
+from itertools import count
+from typing import AsyncIterator, List, NamedTuple
+
+
+class _Waiter(NamedTuple):
+    size_class: int
+    enqueued: float
+    seq: int
+    future: asyncio.Future
+
+
+class PriorityGate:
+    """Concurrent transfer slots handed out cheapest first.
+
+    Waiters are ordered by the order of magnitude (log2) of their expected cost in bytes, so a thumbnail overtakes
+    a video download that is still waiting. Every *aging* seconds spent waiting moves a waiter up one class, which
+    keeps a steady stream of small transfers from starving the large ones. Equal classes are served in order.
+    A *slots* of 0 means no limit, as for :class:`FairScheduler`.
+    """
+
+    def __init__(self, slots: int, aging: float = 10.0):
+        self.slots = slots
+        self.aging = aging
+        self.used = 0
+        self._waiters: List[_Waiter] = []
+        self._seq = count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for waiter in self._waiters if not waiter.future.done())
+
+    @asynccontextmanager
+    async def slot(self, cost: int) -> AsyncIterator[None]:
+        await self.acquire(cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, cost: int) -> None:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._waiters.append(_Waiter(int(math.log2(max(1, cost))), loop.time(), next(self._seq), fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                # The slot was granted just as we were cancelled.
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.used -= 1
+        self._dispatch()
+
+    def _priority(self, waiter: _Waiter, now: float):
+        return waiter.size_class - (now - waiter.enqueued) / self.aging, waiter.seq
+
+    def _dispatch(self) -> None:
+        self._waiters = [waiter for waiter in self._waiters if not waiter.future.done()]
+        now = asyncio.get_running_loop().time()
+        while self._waiters and (not self.slots or self.used < self.slots):
+            waiter = min(self._waiters, key=lambda w: self._priority(w, now))
+            self._waiters.remove(waiter)
+            self.used += 1
+            waiter.future.set_result(None)
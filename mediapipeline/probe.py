@@ -0,0 +1,146 @@
+"""Media probing helpers meant to run in a worker thread.
+
+Everything here is a plain top-level function that works on bytes or a path, so it can be handed to an executor.
+"""
+import io
+import math
+import struct
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+_BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+# JPEG start-of-frame markers, which carry the image dimensions.
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_HEADER_READ_LIMIT = 1024 * 1024
+
+
+def image_dimensions(header: bytes) -> Optional[Tuple[int, int]]:
+    """Read width and height from the header of a PNG, GIF, WebP or JPEG image without decoding it.
+
+    :return: ``(width, height)``, or None if the format is unknown or *header* is too short."""
+    try:
+        if header.startswith(b"\x89PNG\r\n\x1a\n"):
+            return struct.unpack(">II", header[16:24])
+        if header[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", header[6:10])
+        if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+            chunk = header[12:16]
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", header[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L":
+                bits = int.from_bytes(header[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8X":
+                return int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+            return None
+        if header.startswith(b"\xFF\xD8"):
+            offset = 2
+            while offset + 9 < len(header):
+                if header[offset] != 0xFF:
+                    offset += 1
+                    continue
+                marker = header[offset + 1]
+                if marker == 0xFF:
+                    offset += 1
+                    continue
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    offset += 2
+                    continue
+                if marker in _JPEG_SOF:
+                    height, width = struct.unpack(">HH", header[offset + 5:offset + 9])
+                    return width, height
+                offset += 2 + struct.unpack(">H", header[offset + 2:offset + 4])[0]
+    except struct.error:
+        pass
+    return None
+
+
+def _srgb_to_linear(value: int) -> float:
+    v = value / 255
+    return v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4
+
+
+def _linear_to_srgb(value: float) -> int:
+    v = max(0.0, min(1.0, value))
+    return int(v * 12.92 * 255 + 0.5) if v <= 0.0031308 else int((1.055 * v ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _base83(value: int, length: int) -> str:
+    return "".join(_BASE83[(value // 83 ** (length - i - 1)) % 83] for i in range(length))
+
+
+def blurhash_encode(pixels: Sequence[Tuple[int, int, int]], width: int, height: int,
+                    x_components: int = 4, y_components: int = 3) -> str:
+    """Encode row-major RGB *pixels* of a (small) image as a BlurHash string."""
+    linear = [(_srgb_to_linear(r), _srgb_to_linear(g), _srgb_to_linear(b)) for r, g, b in pixels]
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            normalisation = 1 if i == 0 and j == 0 else 2
+            r = g = b = 0.0
+            for y in range(height):
+                basis_y = math.cos(math.pi * j * y / height)
+                for x in range(width):
+                    basis = basis_y * math.cos(math.pi * i * x / width)
+                    pr, pg, pb = linear[y * width + x]
+                    r += basis * pr
+                    g += basis * pg
+                    b += basis * pb
+            scale = normalisation / (width * height)
+            factors.append((r * scale, g * scale, b * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if ac:
+        quantised_max = max(0, min(82, int(max(abs(c) for factor in ac for c in factor) * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+        result += _base83(quantised_max, 1)
+    else:
+        max_value = 1.0
+        result += _base83(0, 1)
+    result += _base83((_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8) + _linear_to_srgb(dc[2]), 4)
+    for factor in ac:
+        r, g, b = (max(0, min(18, int(math.floor(math.copysign(abs(c / max_value) ** 0.5, c) * 9 + 9.5))))
+                   for c in factor)
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
+
+def compute_blurhash(source: Union[str, bytes]) -> Optional[str]:
+    """BlurHash of an image file or image bytes, or None if Pillow is not installed or cannot decode it."""
+    try:
+        # pylint:disable=import-outside-toplevel
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+            image.draft("RGB", (64, 64))
+            small = image.convert("RGB")
+            small.thumbnail((32, 32))
+            return blurhash_encode(list(small.getdata()), small.width, small.height)
+    except (OSError, ValueError):
+        return None
+
+
+def probe_image(source: Union[str, bytes], blurhash: bool = True) -> Dict[str, Any]:
+    """Collect the Matrix ``info`` fields of an image file or image bytes.
+
+    :return: A dict with ``w`` and ``h`` and, if requested and possible, ``xyz.amorgan.blurhash``."""
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            header = file.read(64 * 1024)
+            dimensions = image_dimensions(header)
+            if dimensions is None and len(header) == 64 * 1024:
+                # JPEGs can carry large EXIF blocks in front of the frame header.
+                dimensions = image_dimensions(header + file.read(_HEADER_READ_LIMIT))
+    else:
+        dimensions = image_dimensions(source[:_HEADER_READ_LIMIT])
+    info: Dict[str, Any] = {}
+    if dimensions is not None:
+        info["w"], info["h"] = dimensions
+    if blurhash:
+        hashed = compute_blurhash(source)
+        if hashed is not None:
+            info["xyz.amorgan.blurhash"] = hashed
+    return info
@@ -0,0 +1,46 @@
+"""Image re-encoding meant to run in a worker thread."""
+import io
+from typing import Optional, Tuple, Union
+
+FORMATS = {
+    "webp": ("WEBP", "image/webp", ".webp"),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+}
+
+
+def reencode_image(source: Union[str, bytes], target_format: str = "webp", quality: int = 80,
+                   max_dimension: int = 0, target_size: int = 0) -> Optional[Tuple[bytes, str, str]]:
+    """Re-encode an image file or image bytes as WebP or progressive JPEG.
+
+    The image is scaled down to fit *max_dimension* (0 keeps its size) and encoded with *quality*. If the result is
+    larger than *target_size* bytes, the quality is lowered step by step down to 40 to reach it.
+
+    :return: ``(data, mimetype, file extension)``, or None if Pillow is not installed, the image cannot be decoded,
+       or it cannot be represented in the target format (animations; transparency for JPEG)."""
+    try:
+        # pylint:disable=import-outside-toplevel
+        from PIL import Image
+    except ImportError:
+        return None
+    pil_format, mimetype, extension = FORMATS[target_format]
+    try:
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+            if getattr(image, "is_animated", False):
+                return None
+            has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+            if has_alpha and pil_format == "JPEG":
+                return None
+            image = image.convert("RGBA" if has_alpha else "RGB")
+            if max_dimension and max(image.size) > max_dimension:
+                image.thumbnail((max_dimension, max_dimension))
+            while True:
+                output = io.BytesIO()
+                if pil_format == "JPEG":
+                    image.save(output, format="JPEG", quality=quality, progressive=True, optimize=True)
+                else:
+                    image.save(output, format="WEBP", quality=quality, method=4)
+                if not target_size or output.tell() <= target_size or quality <= 40:
+                    return output.getvalue(), mimetype, extension
+                quality -= 10
+    except (OSError, ValueError):
+        return None
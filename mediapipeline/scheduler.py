@@ -0,0 +1,215 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Deque, Dict, NamedTuple, Optional
+
+from .lru import LRUCache
+
+#: The scheduler slot of the job running in the current task.
+current_slot: ContextVar[Optional["Slot"]] = ContextVar("current_slot", default=None)
+
+
+class TokenBucket:
+    """Allows *rate* events per second on average and bursts of up to *burst*; a rate of 0 allows everything."""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until the next event is allowed."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+
+class _Waiter(NamedTuple):
+    user_id: str
+    future: asyncio.Future
+    #: Whether the slot counts against the room's and user's quota; not for jobs taking back a slot they gave up.
+    charge: bool
+
+
+class Slot:
+    """A job's claim on a :class:`FairScheduler` slot, which it can give up temporarily with :meth:`yielded`."""
+
+    def __init__(self, scheduler: "FairScheduler", room_id: str, user_id: str):
+        self.scheduler = scheduler
+        self.room_id = room_id
+        self.user_id = user_id
+        self.held = False
+
+    async def acquire(self, charge: bool = True) -> None:
+        await self.scheduler.acquire(self.room_id, self.user_id, charge)
+        self.held = True
+
+    def release(self) -> None:
+        if self.held:
+            self.held = False
+            self.scheduler.release()
+
+    @asynccontextmanager
+    async def yielded(self) -> AsyncIterator[None]:
+        """Let other jobs have the slot during the enclosed block, and wait for it again afterwards.
+
+        Taking the slot back is not charged to the quotas again, as the job already was when it started. A block
+        that raises, e.g. because the job was cancelled, does not wait for it: the job is unwinding and only needs to
+        give back what else it holds."""
+        self.release()
+        yield
+        await self.acquire(charge=False)
+
+
+class FairScheduler:
+    """Hands out *slots* concurrent job slots fairly between rooms.
+
+    Rooms with waiting jobs take turns; a room gets up to its weight from *weights* (default 1) slots per turn, and
+    jobs within a room are served in order. With a non-zero *room_rate* or *user_rate*, each room and each user
+    also has a token bucket, and a job whose room or user is out of tokens waits while the other rooms go ahead.
+    A flood of links in one room thereby only delays that room. A *slots* of 0 means no limit.
+    """
+
+    def __init__(self, slots: int, weights: Optional[Dict[str, int]] = None, room_rate: float = 0,
+                 room_burst: float = 1, user_rate: float = 0, user_burst: float = 1, max_buckets: int = 10000):
+        self.slots = slots
+        self.weights = weights or {}
+        self.room_rate, self.room_burst = room_rate, room_burst
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.used = 0
+        self._queues: Dict[str, Deque[_Waiter]] = {}
+        self._turns: Deque[str] = deque()
+        self._credits: Dict[str, int] = {}
+        self._room_buckets: LRUCache[str, TokenBucket] = LRUCache(max_buckets)
+        self._user_buckets: LRUCache[str, TokenBucket] = LRUCache(max_buckets)
+        self._unlimited = TokenBucket(0, 1, 0)
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def waiting(self) -> int:
+        """Number of jobs waiting for a slot."""
+        return sum(1 for queue in self._queues.values() for waiter in queue if not waiter.future.done())
+
+    def _weight(self, room_id: str) -> int:
+        return max(1, self.weights.get(room_id, 1))
+
+    def _bucket(self, buckets: LRUCache, key: str, rate: float, burst: float, now: float) -> TokenBucket:
+        if not rate:
+            return self._unlimited
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    @asynccontextmanager
+    async def slot(self, room_id: str, user_id: str) -> AsyncIterator[Slot]:
+        slot = Slot(self, room_id, user_id)
+        await slot.acquire()
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    async def acquire(self, room_id: str, user_id: str, charge: bool = True) -> None:
+        """Wait for a slot for a job of *user_id* in *room_id*; pass it back with :meth:`release`.
+
+        Without *charge*, the slot is not taken from the room's and user's token buckets, nor held back by them."""
+        fut = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(room_id)
+        if queue is None:
+            queue = self._queues[room_id] = deque()
+            self._turns.append(room_id)
+        queue.append(_Waiter(user_id, fut, charge))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                # The slot was granted just as we were cancelled.
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.used -= 1
+        self._dispatch()
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        wake_in: Optional[float] = None
+        throttled = 0
+        while self._turns and (not self.slots or self.used < self.slots) and throttled < len(self._turns):
+            room_id = self._turns[0]
+            queue = self._queues[room_id]
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if not queue:
+                self._turns.popleft()
+                del self._queues[room_id]
+                self._credits.pop(room_id, None)
+                continue
+
+            room_bucket = self._bucket(self._room_buckets, room_id, self.room_rate, self.room_burst, now)
+            room_delay = room_bucket.delay(now)
+            waiter = user_bucket = None
+            delay = 0.0
+            for candidate in queue:
+                if candidate.future.done():
+                    continue
+                if not candidate.charge:
+                    waiter = candidate
+                    break
+                if room_delay:
+                    # Only jobs taking back their slot may go ahead.
+                    delay = room_delay
+                    continue
+                bucket = self._bucket(self._user_buckets, candidate.user_id, self.user_rate, self.user_burst, now)
+                user_delay = bucket.delay(now)
+                if not user_delay:
+                    waiter, user_bucket = candidate, bucket
+                    break
+                delay = min(delay or user_delay, user_delay)
+            if waiter is None:
+                # This room has to wait for its quota; give the others their turn.
+                wake_in = delay if wake_in is None else min(wake_in, delay)
+                throttled += 1
+                self._turns.rotate(-1)
+                continue
+
+            throttled = 0
+            queue.remove(waiter)
+            if waiter.charge:
+                room_bucket.take(now)
+                user_bucket.take(now)
+            self.used += 1
+            waiter.future.set_result(None)
+            credits = self._credits.get(room_id, self._weight(room_id)) - 1
+            if credits <= 0:
+                self._credits.pop(room_id, None)
+                self._turns.rotate(-1)
+            else:
+                self._credits[room_id] = credits
+
+        if wake_in is not None:
+            if self._timer is not None and self._timer.when() > now + wake_in:
+                # A shorter wait came up; wake up for it instead.
+                self._timer.cancel()
+                self._timer = None
+            if self._timer is None:
+                self._timer = loop.call_later(wake_in, self._on_timer)
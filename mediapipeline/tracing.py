@@ -0,0 +1,162 @@
+"""Per-job trace spans, exported as OTLP/HTTP JSON or as JSON lines."""
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+import aiohttp
+
+#: The innermost open span of the current task; new spans become its children.
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class JSONLExporter:
+    """Appends finished spans to *path*, one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _write(self, lines: str) -> None:
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(lines)
+
+    async def export(self, spans: List[Span]) -> None:
+        lines = "".join(json.dumps(span.to_dict()) + "\n" for span in spans)
+        await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+
+
+class OTLPExporter:
+    """Posts finished spans to an OTLP/HTTP collector using the JSON encoding."""
+
+    def __init__(self, http: aiohttp.ClientSession, endpoint: str, service_name: str):
+        self.http = http
+        self.endpoint = endpoint
+        self.service_name = service_name
+
+    async def export(self, spans: List[Span]) -> None:
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": _otlp_value(self.service_name)}]},
+            "scopeSpans": [{
+                "scope": {"name": "socialmediadownload"},
+                "spans": [{
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                    "name": span.name,
+                    "kind": 1,
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns),
+                    "attributes": [{"key": key, "value": _otlp_value(value)}
+                                   for key, value in span.attributes.items()],
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+                } for span in spans],
+            }],
+        }]}
+        async with self.http.post(self.endpoint, json=body) as response:
+            if response.status >= 300:
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+
+
+class Tracer:
+    """Records nested spans and exports them in batches every *interval* seconds.
+
+    Without exporters :meth:`span` does nothing, so instrumented code costs next to nothing when tracing is off.
+    """
+
+    def __init__(self, exporters: List[Any], log: logging.Logger, interval: float = 5.0, max_pending: int = 10000):
+        self.exporters = exporters
+        self.log = log
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: List[Span] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """Open a child of the current span (or a new trace) named *name* for the enclosed block."""
+        if not self.exporters:
+            yield None
+            return
+        span = Span(name, current_span.get(), attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as err:
+            span.error = f"{type(err).__name__}: {err}"
+            raise
+        finally:
+            current_span.reset(token)
+            span.end_ns = time.time_ns()
+            if len(self._pending) < self.max_pending:
+                self._pending.append(span)
+
+    def start(self) -> None:
+        if self.exporters:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        spans, self._pending = self._pending, []
+        if not spans:
+            return
+        for exporter in self.exporters:
+            try:
+                await exporter.export(spans)
+            except Exception as e:
+                self.log.warning(f"Failed to export {len(spans)} spans with {type(exporter).__name__}: {e}")
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from .media import Media
+
+
+class TranscodeError(Exception):
+    """Raised when ffmpeg or ffprobe fails on a payload."""
+
+
+class Transcoder:
+    """Re-encodes or remuxes downloaded videos with ffmpeg.
+
+    ffmpeg runs as a child process awaited through asyncio, so the event loop keeps serving other jobs while a
+    video is processed. At most *max_workers* processes run at once, which defaults to the number of CPUs.
+
+    :param spool_dir: Directory for ffmpeg's output files.
+    :param max_size: Videos larger than this many bytes are re-encoded to fit, 0 disables the limit.
+    :param max_bitrate: Videos with a higher overall bitrate (bits/s) are re-encoded to it, 0 disables the limit.
+    :param audio_bitrate: Audio bitrate (bits/s) used when re-encoding.
+    """
+
+    def __init__(self, spool_dir: Optional[str] = None, max_workers: Optional[int] = None,
+                 ffmpeg: str = "ffmpeg", ffprobe: str = "ffprobe", max_size: int = 0, max_bitrate: int = 0,
+                 audio_bitrate: int = 128000):
+        self.spool_dir = spool_dir
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self.max_size = max_size
+        self.max_bitrate = max_bitrate
+        self.audio_bitrate = audio_bitrate
+        self._slots = asyncio.Semaphore(max_workers or os.cpu_count() or 1)
+        #: Number of ffmpeg/ffprobe runs waiting for a free slot.
+        self.waiting = 0
+
+    async def _run(self, *args: str) -> bytes:
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                           stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE)
+            try:
+                stdout, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+        finally:
+            self._slots.release()
+        if process.returncode != 0:
+            raise TranscodeError(f"{os.path.basename(args[0])} exited with {process.returncode}: "
+                                 f"{stderr.decode(errors='replace')[-500:]}")
+        return stdout
+
+    async def probe(self, path: str) -> Dict[str, Any]:
+        """Return the ``format`` section of ffprobe's output for *path*."""
+        output = await self._run(self.ffprobe, "-v", "error", "-show_entries", "format=format_name,duration,bit_rate",
+                                 "-of", "json", path)
+        return json.loads(output).get("format", {})
+
+    async def probe_video(self, path: str) -> Dict[str, Any]:
+        """Collect the Matrix ``info`` fields ``w``, ``h`` and ``duration`` (in ms) of the video at *path*."""
+        output = await self._run(self.ffprobe, "-v", "error", "-select_streams", "v:0",
+                                 "-show_entries", "stream=width,height:format=duration", "-of", "json", path)
+        data = json.loads(output)
+        info: Dict[str, Any] = {}
+        streams = data.get("streams") or [{}]
+        if streams[0].get("width") and streams[0].get("height"):
+            info["w"], info["h"] = streams[0]["width"], streams[0]["height"]
+        duration = data.get("format", {}).get("duration")
+        if duration:
+            info["duration"] = int(float(duration) * 1000)
+        return info
+
+    async def poster_frame(self, path: str, max_dimension: int = 800) -> bytes:
+        """Extract the first frame of the video at *path* as a JPEG scaled down to *max_dimension*."""
+        scale = f"scale='min({max_dimension},iw)':'min({max_dimension},ih)':force_original_aspect_ratio=decrease"
+        return await self._run(self.ffmpeg, "-v", "error", "-i", path, "-frames:v", "1", "-vf", scale,
+                               "-f", "image2", "-c:v", "mjpeg", "pipe:1")
+
+    def _target_bitrate(self, size: int, duration: float, bitrate: int) -> Optional[int]:
+        targets = []
+        if self.max_size and size > self.max_size and duration > 0:
+            # Leave some room for the container overhead.
+            targets.append(int(self.max_size * 8 * 0.95 / duration))
+        if self.max_bitrate and bitrate > self.max_bitrate:
+            targets.append(self.max_bitrate)
+        return min(targets) if targets else None
+
+    async def process(self, media: Media) -> bool:
+        """Bring *media* within the configured size and bitrate and into an MP4 container.
+
+        The payload is replaced in place. Videos that are already small enough MP4 files are left untouched.
+
+        :return: True if the payload was changed.
+        :raises TranscodeError: When ffmpeg or ffprobe fails."""
+        source = media.spool()
+        info = await self.probe(source)
+        duration = float(info.get("duration") or 0)
+        bitrate = int(info.get("bit_rate") or 0)
+        is_mp4 = "mp4" in info.get("format_name", "").split(",")
+        target_bitrate = self._target_bitrate(media.size, duration, bitrate)
+        if target_bitrate is None and is_mp4:
+            return False
+
+        args: List[str] = [self.ffmpeg, "-y", "-v", "error", "-i", source]
+        if target_bitrate is None:
+            # Only the container is wrong, e.g. the concatenated MPEG-TS segments of an HLS stream.
+            args += ["-c", "copy", "-bsf:a", "aac_adtstoasc"]
+        else:
+            video_bitrate = max(target_bitrate - self.audio_bitrate, 100000)
+            args += ["-c:v", "libx264", "-preset", "veryfast", "-b:v", str(video_bitrate),
+                     "-maxrate", str(video_bitrate), "-bufsize", str(2 * video_bitrate),
+                     "-c:a", "aac", "-b:a", str(self.audio_bitrate)]
+        fd, target = tempfile.mkstemp(suffix=".mp4", dir=self.spool_dir)
+        os.close(fd)
+        try:
+            await self._run(*args, "-movflags", "+faststart", "-f", "mp4", target)
+        except BaseException:
+            os.unlink(target)
+            raise
+        if target_bitrate is not None and os.path.getsize(target) >= media.size:
+            os.unlink(target)
+            return False
+        media.replace(target)
+        return True
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from .metrics import Histogram
+
+
+class LoopWatchdog:
+    """Measures event loop scheduling lag and reports what blocks the loop.
+
+    A heartbeat task sleeps for *interval* seconds at a time and records how late it wakes up in *histogram*. A
+    separate thread watches the heartbeat; once it is more than *threshold* seconds overdue, the loop is stuck in
+    synchronous code, and the thread logs the loop thread's current stack together with the job that was running.
+    Jobs announce themselves with :meth:`track`.
+    """
+
+    def __init__(self, log: logging.Logger, histogram: Histogram, interval: float = 0.5, threshold: float = 1.0):
+        self.log = log
+        self.histogram = histogram
+        self.interval = interval
+        self.threshold = threshold
+        self._jobs: Dict[asyncio.Task, str] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Start watching the running loop. Must be called from the loop's thread."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._heartbeat = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="event-loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @contextmanager
+    def track(self, description: str) -> Iterator[None]:
+        """Mark the current task as running the job *description* for the duration of the block."""
+        task = asyncio.current_task()
+        previous = self._jobs.get(task)
+        self._jobs[task] = description
+        try:
+            yield
+        finally:
+            if previous is None:
+                self._jobs.pop(task, None)
+            else:
+                self._jobs[task] = previous
+
+    async def _beat(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.histogram.observe(max(0.0, now - start - self.interval))
+            self._last_beat = now
+
+    def _watch(self) -> None:
+        reported = False
+        while not self._stopped.wait(self.interval / 2):
+            overdue = time.monotonic() - self._last_beat - self.interval
+            if overdue <= self.threshold:
+                reported = False
+            elif not reported:
+                reported = True
+                self._report(overdue)
+
+    def _report(self, overdue: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread)  # pylint:disable=protected-access
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no stack)\n"
+        task = asyncio.current_task(self._loop)
+        job = self._jobs.get(task) if task is not None else None
+        if job is None:
+            # Fall back to the innermost handler on the stack, if the blocking code is not inside a tracked job.
+            handlers = [line for line in traceback.format_stack(frame) if ", in handle_" in line] if frame else []
+            job = handlers[-1].split(", in ")[-1].split("\n")[0] if handlers else "unknown"
+        self.log.warning(f"Event loop blocked for more than {overdue:.1f}s in job {job} "
+                         f"(task {task.get_name() if task is not None else None}):\n{stack}")
@@ -1,21 +1,35 @@
+import os
 import re
 import json
+import shutil
+import tempfile
+import time
 import mimetypes
 import instaloader
 import urllib
 import yarl
-import requests
 import asyncio
 import concurrent.futures
+import types
+from contextlib import AsyncExitStack, asynccontextmanager, nullcontext
+from contextvars import ContextVar
 from urllib.parse import urljoin
 
-from typing import Type
+from typing import Type, Optional
 from urllib.parse import quote
-from mautrix.types import ImageInfo, EventType, MessageType
-from mautrix.types.event.message import BaseFileInfo, Format, TextMessageEventContent
+from mautrix.types import EventType, Membership, MessageType, RedactionEvent, StateEvent
+from mautrix.types.event.message import Format, TextMessageEventContent
+from mautrix.util.async_db import UpgradeTable
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 from maubot import Plugin, MessageEvent
-from maubot.handlers import event
+from maubot.handlers import event, web
+from aiohttp.web import Request, Response
+
+from mediapipeline import Backlog, BlobStore, FairScheduler, JobJournal, JobRegistry, LoopWatchdog, PriorityGate, Slot, current_slot, upgrade_table
+from mediapipeline import JSONLExporter, OTLPExporter, Tracer
+from mediapipeline import FixtureSession, FixtureStore
+from mediapipeline import MediaCache, MetadataCache, MetadataStore
+from mediapipeline import DownloadError, DownloadRefused, Downloader, LRUCache, Media, MemoryBudget, PipelineMetrics, current_platform, TranscodeError, Transcoder, probe_image, reencode_image
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
@@ -23,7 +37,42 @@ class Config(BaseProxyConfig):
             for suffix in ["enabled", "info", "image", "video", "thumbnail"]:
                 helper.copy(f"{prefix}.{suffix}")
 
+        for key in ["max_items", "parallel_items", "max_bytes", "cdn_pool_size"]:
+            helper.copy(f"instagram.{key}")
         helper.copy("respond_to_notice")
+        helper.copy("deduplicate")
+        helper.copy("event_cache_size")
+        for key in ["enabled", "interval", "threshold"]:
+            helper.copy(f"watchdog.{key}")
+        for key in ["jsonl_file", "otlp_endpoint", "interval"]:
+            helper.copy(f"tracing.{key}")
+        for key in ["mode", "directory", "media", "media_limit", "timing"]:
+            helper.copy(f"fixtures.{key}")
+        for key in ["max_age", "policy", "keep", "settle"]:
+            helper.copy(f"catchup.{key}")
+        for key in ["enabled", "max_age"]:
+            helper.copy(f"journal.{key}")
+        for key in ["workers", "room_weights", "room_rate", "room_burst", "user_rate", "user_burst"]:
+            helper.copy(f"scheduler.{key}")
+        for key in ["transfers", "aging", "image_estimate", "video_estimate", "large_size"]:
+            helper.copy(f"priority.{key}")
+        helper.copy("download.memory_budget")
+        helper.copy("download.spill_threshold")
+        helper.copy("download.spool_threshold")
+        helper.copy("download.parallel_ranges")
+        helper.copy("download.parallel_threshold")
+        helper.copy("download.range_attempts")
+        helper.copy("download.retry_backoff")
+        helper.copy("data_directory")
+        helper.copy("media_cache.max_size")
+        for key in ["max_entries", "persist", "ttl"]:
+            helper.copy(f"metadata_cache.{key}")
+        for key in ["enabled", "ffmpeg", "ffprobe", "max_workers", "max_size", "max_bitrate", "audio_bitrate"]:
+            helper.copy(f"transcode.{key}")
+        for key in ["enabled", "thumbnails", "blurhash", "max_workers", "cache_size"]:
+            helper.copy(f"probe.{key}")
+        for key in ["enabled", "format", "quality", "min_size", "target_size", "max_dimension", "min_savings"]:
+            helper.copy(f"reencode.{key}")
 
 reddit_pattern = re.compile(r"((?:https?:)?\/\/)?((?:www|m|old|nm)\.)?((?:reddit\.com|redd\.it))(\/r\/[^/]+\/(?:comments|s)\/[a-zA-Z0-9_\-]+)")
 instagram_pattern = re.compile(r"(?:https?:\/\/)?(?:www\.)?instagram\.com\/?([a-zA-Z0-9\.\_\-]+)?\/([p]+)?([reel]+)?([tv]+)?([stories]+)?\/([a-zA-Z0-9\-\_\.]+)\/?([0-9]+)?")
@@ -32,51 +81,341 @@ tiktok_pattern = re.compile(r"((?:https?:)?\/\/)?((?:www|m|vm)\.)?((?:tiktok\.co
 bluesky_pattern = re.compile(r"((?:https?:)?\/\/)?((?:www|bsky)\.)?((?:bsky\.app))(\/profile\/[a-zA-Z0-9\-\_\.]+)(\/post\/[a-zA-Z0-9\-\_]+)")
 aparat_pattern = re.compile(r"((?:https?:)?\/\/)?((?:www\.)?aparat\.(?:com|ir))\/(?:v=|v\/)([\w\-]+)")
 
+#: The journal entry of the job running in the current task, if journalling is enabled.
+current_job = ContextVar("current_job", default=None)
+
+platform_patterns = [
+    ("youtube", youtube_pattern),
+    ("instagram", instagram_pattern),
+    ("reddit", reddit_pattern),
+    ("tiktok", tiktok_pattern),
+    ("bluesky", bluesky_pattern),
+    ("aparat", aparat_pattern),
+]
+
 class SocialMediaDownloadPlugin(Plugin):
     async def start(self) -> None:
         self.config.load_and_update()
+        exporters = []
+        if self.config["tracing.jsonl_file"]:
+            exporters.append(JSONLExporter(self.config["tracing.jsonl_file"]))
+        if self.config["tracing.otlp_endpoint"]:
+            exporters.append(OTLPExporter(self.http, self.config["tracing.otlp_endpoint"], f"socialmediadownload/{self.id}"))
+        self.tracer = Tracer(exporters, self.log, interval=self.config["tracing.interval"])
+        self.tracer.start()
+        self.metrics = PipelineMetrics(self.tracer)
+        self.data_dir = self.config["data_directory"] or os.path.join(tempfile.gettempdir(), "socialmediadownload", self.id)
+        self.spool_dir = os.path.join(self.data_dir, "spool")
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.journal = JobJournal(self.database)
+        unfinished = await self.journal.unfinished() if self.config["journal.enabled"] else []
+        resumable = {entry.spool_path for entry in unfinished}
+        for leftover in os.listdir(self.spool_dir):
+            # Spool files of a previous run that did not shut down cleanly, except partial downloads to resume.
+            path = os.path.join(self.spool_dir, leftover)
+            if path not in resumable:
+                os.unlink(path)
+
+        # Session for Instagram's queries, set when recording or replaying fixtures; otherwise the Instaloader
+        # context opens a pooled one of its own.
+        instagram_http = None
+        mode = self.config["fixtures.mode"]
+        if mode in ("record", "replay"):
+            store = FixtureStore(self.config["fixtures.directory"] or os.path.join(self.data_dir, "fixtures"),
+                                 media=self.config["fixtures.media"], media_limit=self.config["fixtures.media_limit"])
+            recording = mode == "record"
+            self.http = FixtureSession(store, self.http if recording else None, timing=self.config["fixtures.timing"])
+            instagram_http = self.http
+            self.log.info(f"{'Recording' if recording else 'Replaying'} upstream HTTP traffic in {store.directory}")
+        elif mode:
+            self.log.warning(f"Unknown fixtures.mode {mode!r}, expected record or replay")
+
+        self.budget = MemoryBudget(self.config["download.memory_budget"])
+        self.downloader = self.new_downloader(self.http)
+        store = None
+        if self.config["metadata_cache.persist"]:
+            store = MetadataStore(self.database)
+            # Entries that are this old are unlikely to be revalidated rather than refetched anyway.
+            await store.prune(int((time.time() - 7 * 24 * 3600) * 1000))
+        self.metadata_cache = MetadataCache(self.http, self.config["metadata_cache.max_entries"], store)
+        self.media_cache = None
+        if self.config["media_cache.max_size"]:
+            self.media_cache = MediaCache(os.path.join(self.data_dir, "media_cache"),
+                                          self.config["media_cache.max_size"], self.spool_dir)
+
+        max_size = self.config["transcode.max_size"]
+        if self.config["transcode.enabled"] and not max_size:
+            try:
+                max_size = (await self.client.get_media_repo_config()).upload_size or 0
+            except Exception as e:
+                self.log.warning(f"Failed to fetch the homeserver upload limit: {e}")
+        self.transcoder = Transcoder(self.spool_dir, max_workers=self.config["transcode.max_workers"],
+                                     ffmpeg=self.config["transcode.ffmpeg"], ffprobe=self.config["transcode.ffprobe"],
+                                     max_size=max_size, max_bitrate=self.config["transcode.max_bitrate"],
+                                     audio_bitrate=self.config["transcode.audio_bitrate"])
+        # Videos are probed with ffprobe and their thumbnails taken with ffmpeg; without them, skip both from the
+        # start instead of failing for every video.
+        self.probe_videos = self.config["probe.enabled"] and bool(shutil.which(self.config["transcode.ffprobe"]))
+        self.video_thumbnails = (self.probe_videos and self.config["probe.thumbnails"]
+                                 and bool(shutil.which(self.config["transcode.ffmpeg"])))
+        if self.config["probe.enabled"] and not self.probe_videos:
+            self.log.warning(f"{self.config['transcode.ffprobe']} not found, videos are sent without their info")
+        elif self.config["probe.thumbnails"] and not self.video_thumbnails:
+            self.log.warning(f"{self.config['transcode.ffmpeg']} not found, videos are sent without thumbnails")
+
+        # One long-lived Instaloader context, so that its connections, cookies and rate limiting history carry over
+        # from post to post. It runs on the event loop, so lookups of several posts go on concurrently.
+        self.instaloader = instaloader.AsyncInstaloaderContext(user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
+                                                               http=instagram_http,
+                                                               cdn_pool_size=self.config["instagram.cdn_pool_size"])
+        # Instagram's media is fetched through the context's CDN session, which keeps its connections alive.
+        self.instagram_downloader = self.new_downloader(self.instaloader.cdn_http)
+        self.instagram_state_file = os.path.join(self.data_dir, "instagram.json")
+        self.instagram_state_task = None
+        self.load_instagram_state()
+
+        # Worker threads for image probing and re-encoding, which Pillow mostly does without holding the GIL. Worker
+        # processes would have to fork, as spawned ones cannot import the plugin's modules from the .mbp archive,
+        # and forking a process that runs threads, like the watchdog's and the loop's executor, can deadlock.
+        self.probe_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.config["probe.max_workers"] or os.cpu_count(),
+                                                                thread_name_prefix="probe")
+        # Source URL -> (mxc URI, info, file name) of media that has already been uploaded.
+        self.sent_media = LRUCache(self.config["probe.cache_size"])
+        self.blobs = BlobStore(self.database)
+        self.jobs = JobRegistry()
+        # Journal writes started from synchronous callbacks, kept so that they are not garbage collected.
+        self.journal_updates = set()
+        self.scheduler = FairScheduler(self.config["scheduler.workers"], weights=self.config["scheduler.room_weights"],
+                                       room_rate=self.config["scheduler.room_rate"],
+                                       room_burst=self.config["scheduler.room_burst"],
+                                       user_rate=self.config["scheduler.user_rate"],
+                                       user_burst=self.config["scheduler.user_burst"])
+        self.transfers = PriorityGate(self.config["priority.transfers"], aging=self.config["priority.aging"])
+        # IDs of events already seen, to ignore repeated deliveries, and the links handled for each original
+        # (unedited) event, so that edits only trigger links they add.
+        self.seen_events = LRUCache(self.config["event_cache_size"])
+        self.handled_links = LRUCache(self.config["event_cache_size"])
+        self.backlog = Backlog(max(1, self.config["catchup.keep"]), self.handle_message, lambda: not len(self.jobs),
+                               self.log, settle=self.config["catchup.settle"])
+
+        self.metrics.queue_depth.set_function(lambda: self.budget.waiting, queue="memory_budget")
+        self.metrics.queue_depth.set_function(lambda: self.transcoder.waiting, queue="ffmpeg")
+        self.metrics.queue_depth.set_function(lambda: len(self.backlog), queue="backlog")
+        self.metrics.queue_depth.set_function(lambda: self.scheduler.waiting, queue="scheduler")
+        self.metrics.queue_depth.set_function(lambda: self.transfers.waiting, queue="transfers")
+
+        self.watchdog = LoopWatchdog(self.log, self.metrics.loop_lag, interval=self.config["watchdog.interval"],
+                                     threshold=self.config["watchdog.threshold"])
+        if self.config["watchdog.enabled"]:
+            self.watchdog.start()
+
+        self.resume_task = asyncio.create_task(self.resume_jobs(unfinished)) if unfinished else None
+
+    async def stop(self) -> None:
+        self.backlog.stop()
+        if self.resume_task is not None:
+            self.resume_task.cancel()
+        # Running jobs are cut off, leaving their journal entries to the next start, before anything they use is
+        # torn down; otherwise they would carry on next to the jobs the next instance resumes.
+        await self.jobs.shutdown()
+        if self.journal_updates:
+            await asyncio.gather(*self.journal_updates, return_exceptions=True)
+        self.watchdog.stop()
+        self.probe_pool.shutdown(wait=False, cancel_futures=True)
+        self.save_instagram_state()
+        await self.instaloader.close()
+        if self.media_cache is not None:
+            self.media_cache.close()
+        await self.tracer.stop()
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
         return Config
 
+    @classmethod
+    def get_db_upgrade_table(cls) -> Optional[UpgradeTable]:
+        return upgrade_table
+
     @event.on(EventType.ROOM_MESSAGE)
     async def on_message(self, evt: MessageEvent) -> None:
+        if evt.event_id in self.seen_events:
+            return
+        self.seen_events[evt.event_id] = True
         if (evt.content.msgtype != MessageType.TEXT and
         not (self.config["respond_to_notice"] and evt.content.msgtype == MessageType.NOTICE) or
         evt.content.body.startswith("!")):
             return
 
+        max_age = self.config["catchup.max_age"]
+        if max_age and time.time() * 1000 - evt.timestamp > max_age * 1000:
+            # Left over from a restart or a sync gap; handling the whole backlog at once gets us rate-limited.
+            if self.config["catchup.policy"] == "latest":
+                if not self.backlog.add(evt):
+                    self.metrics.backlog.inc(action="dropped")
+                self.metrics.backlog.inc(action="queued")
+            else:
+                self.metrics.backlog.inc(action="dropped")
+            return
 
-        for url_tup in youtube_pattern.findall(evt.content.body):
-            await evt.mark_read()
-            if self.config["youtube.enabled"]:
-                await self.handle_youtube(evt, url_tup)
-
-        for url_tup in instagram_pattern.findall(evt.content.body):
-            await evt.mark_read()
-            if self.config["instagram.enabled"] and url_tup[5]:
-                await self.handle_instagram(evt, url_tup)
-
-        for url_tup in reddit_pattern.findall(evt.content.body):
-            await evt.mark_read()
-            if self.config["reddit.enabled"]:
-                await self.handle_reddit(evt, url_tup)
+        await self.handle_message(evt)
 
-        for url_tup in tiktok_pattern.findall(evt.content.body):
-            await evt.mark_read()
-            if self.config["tiktok.enabled"]:
-                await self.handle_tiktok(evt, url_tup)
-        
-        if self.config["bluesky.enabled"]:
-            for url_tup in bluesky_pattern.findall(evt.content.body):
+    async def handle_message(self, evt: MessageEvent) -> None:
+        with self.tracer.span("on_message", event_id=evt.event_id, room_id=evt.room_id):
+            original = evt.content.get_edit()
+            if original and evt.content.new_content:
+                body = evt.content.new_content.body
+            else:
+                original, body = evt.event_id, evt.content.body
+            with self.metrics.stage("extract"):
+                links = self.extract_links(body)
+
+            handled = self.handled_links.get(original)
+            if handled is None:
+                handled = self.handled_links[original] = set()
+            for platform, url_tup in links:
+                url = "".join(url_tup)
+                if url in handled:
+                    continue
+                handled.add(url)
                 await evt.mark_read()
-                await self.handle_bluesky(evt, url_tup)
-                
-        for url_tup in aparat_pattern.findall(evt.content.body):
-            await evt.mark_read()
-            if self.config["aparat.enabled"]:
-                await self.handle_aparat(evt, url_tup)
+                if self.config[f"{platform}.enabled"] and (platform != "instagram" or url_tup[5]):
+                    if not await self.run_handler(platform, evt, url_tup, event_id=original):
+                        # Cancelled because the message was redacted or the room left; skip its other links too.
+                        break
+
+    def extract_links(self, body) -> list:
+        links = []
+        for platform, pattern in platform_patterns:
+            for url_tup in pattern.findall(body):
+                links.append((platform, url_tup))
+        return links
+
+    async def run_handler(self, platform, evt, url_tup, entry=None, event_id=None) -> bool:
+        # Each link is handled in its own task so that it can be cancelled without cancelling the event handler.
+        # Links added by an edit belong to the original message, whose redaction cancels them.
+        event_id = event_id or evt.event_id
+        job = asyncio.create_task(self._run_handler(platform, evt, url_tup, entry, event_id), name=f"handle_{platform} {event_id}")
+        if await self.jobs.run(evt.room_id, event_id, job):
+            return True
+        self.log.info(f"Cancelled handle_{platform} for {event_id} in {evt.room_id}")
+        return False
+
+    async def _run_handler(self, platform, evt, url_tup, entry=None, event_id=None) -> None:
+        token = current_platform.set(platform)
+        url = "".join(url_tup)
+        if entry is None and self.config["journal.enabled"]:
+            entry = await self.journal.add(evt.room_id, event_id or evt.event_id, platform, url)
+        job_token = current_job.set(entry)
+        finished = True
+        try:
+            self.metrics.jobs.inc(platform=platform)
+            slot = Slot(self.scheduler, evt.room_id, evt.sender)
+            with self.metrics.stage("schedule"):
+                await slot.acquire()
+            slot_token = current_slot.set(slot)
+            try:
+                await self.journal_stage("running")
+                with self.watchdog.track(f"handle_{platform} {url} in {evt.room_id}"), \
+                        self.tracer.span(f"handle_{platform}", url=url):
+                    await getattr(self, f"handle_{platform}")(evt, url_tup)
+            finally:
+                current_slot.reset(slot_token)
+                slot.release()
+        except asyncio.CancelledError:
+            # Jobs cut off by a shutdown or reload stay in the journal to be resumed; only those cancelled because
+            # their message was redacted or the room left are done with.
+            finished = self.jobs.cancelled(asyncio.current_task())
+            raise
+        finally:
+            current_job.reset(job_token)
+            current_platform.reset(token)
+            if entry is not None and finished:
+                await self.finish_job(entry)
+
+    async def finish_job(self, entry) -> None:
+        # A resumed download that was not picked up again leaves its spool file behind.
+        if entry.spool_path and os.path.exists(entry.spool_path):
+            os.unlink(entry.spool_path)
+        await self.journal.finish(entry)
+
+    async def journal_stage(self, stage, **fields) -> None:
+        entry = current_job.get()
+        if entry is None:
+            return
+        entry.stage = stage
+        for name, value in fields.items():
+            setattr(entry, name, value)
+        await self.journal.update(entry)
+
+    async def resume_jobs(self, entries) -> None:
+        """Handle the jobs left unfinished by a previous run, in the order they were started."""
+        max_age = self.config["journal.max_age"]
+        for entry in entries:
+            if max_age and time.time() * 1000 - entry.created_at > max_age * 1000:
+                self.log.info(f"Giving up on unfinished job for {entry.url} in {entry.room_id}")
+                await self.finish_job(entry)
+                continue
+            pattern = dict(platform_patterns)[entry.platform]
+            url_tup = next((tup for tup in pattern.findall(entry.url) if "".join(tup) == entry.url), None)
+            try:
+                evt = MessageEvent(await self.client.get_event(entry.room_id, entry.event_id), self.client)
+            except Exception as e:
+                self.log.warning(f"Failed to fetch {entry.event_id} to resume its job for {entry.url}: {e}")
+                evt = None
+            if evt is None or url_tup is None:
+                await self.finish_job(entry)
+                continue
+            self.log.info(f"Resuming job for {entry.url} in {entry.room_id} from stage {entry.stage}")
+            self.seen_events[evt.event_id] = True
+            handled = self.handled_links.get(evt.event_id)
+            if handled is None:
+                handled = self.handled_links[evt.event_id] = set()
+            handled.add(entry.url)
+            # Jobs run concurrently like fresh ones; the scheduler limits how many are active.
+            asyncio.create_task(self.run_handler(entry.platform, evt, url_tup, entry))
+
+    @event.on(EventType.ROOM_REDACTION)
+    async def on_redaction(self, evt: RedactionEvent) -> None:
+        redacts = getattr(evt.content, "redacts", None) or evt.redacts
+        cancelled = self.jobs.cancel_event(evt.room_id, redacts)
+        if cancelled:
+            self.log.debug(f"Cancelling {cancelled} jobs of redacted event {redacts} in {evt.room_id}")
+            self.metrics.jobs_cancelled.inc(cancelled, reason="redacted")
+        if self.backlog.discard(evt.room_id, redacts):
+            self.log.debug(f"Dropping backlogged event {redacts} in {evt.room_id}, which was redacted")
+            self.metrics.backlog.inc(action="redacted")
+
+    @event.on(EventType.ROOM_MEMBER)
+    async def on_membership(self, evt: StateEvent) -> None:
+        if evt.state_key != self.client.mxid or evt.content.membership not in (Membership.LEAVE, Membership.BAN):
+            return
+        cancelled = self.jobs.cancel_room(evt.room_id)
+        if cancelled:
+            self.log.debug(f"Cancelling {cancelled} jobs in {evt.room_id} after leaving it")
+            self.metrics.jobs_cancelled.inc(cancelled, reason=evt.content.membership.value)
+        dropped = self.backlog.discard(evt.room_id)
+        if dropped:
+            self.log.debug(f"Dropping {dropped} backlogged events in {evt.room_id} after leaving it")
+            self.metrics.backlog.inc(dropped, action=evt.content.membership.value)
+
+    @web.get("/metrics")
+    async def metrics_endpoint(self, req: Request) -> Response:
+        return Response(body=self.metrics.render().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def get_metadata(self, url, cache=False, **kwargs):
+        """GET the metadata at *url*. With *cache*, the response is served through the metadata cache with the
+        current platform's time to live, and its body has already been read."""
+        ttl = self.config["metadata_cache.ttl"].get(current_platform.get(), 0) if cache else 0
+        with self.metrics.stage("metadata"):
+            if ttl:
+                response, result = await self.metadata_cache.get(url, ttl, **kwargs)
+                self.metrics.cache_lookup("metadata", result != "miss")
+            else:
+                response = await self.http.get(url, **kwargs)
+        if response.status != 200:
+            self.metrics.error("metadata", response.status)
+        return response
 
     async def get_ttdownloader_params(self, tokensDict, url) -> list:
         cookies = {
@@ -105,52 +444,46 @@ class SocialMediaDownloadPlugin(Plugin):
         }
         return cookies, headers, data
         
-    def get_ttdownloader_tokens(self) -> dict:
+    async def get_ttdownloader_tokens(self) -> dict:
         tokens = {}
-        response = requests.get('https://ttdownloader.com/')
-        if response.status_code != 200:
-            self.log.warning(f"Unexpected status fetching tokens for ttdownloader.com: {response.status_code}")
-            return
-        
-        token_match = re.search(r'<input type="hidden" id="token" name="token" value="([^"]+)"', response.text)
+        async with await self.get_metadata('https://ttdownloader.com/') as response:
+            if response.status != 200:
+                self.log.warning(f"Unexpected status fetching tokens for ttdownloader.com: {response.status}")
+                return
+            text = await response.text()
+
+        token_match = re.search(r'<input type="hidden" id="token" name="token" value="([^"]+)"', text)
         token = token_match.group(1) if token_match else None
         tokens["token"] = token
 
-        for cookie in response.cookies:
-            tokens[cookie.name] = cookie.value
-        
+        for name, cookie in response.cookies.items():
+            tokens[name] = cookie.value
+
         return tokens
 
     async def handle_tiktok(self, evt, url_tup):  
         url = ''.join(url_tup)
 
         if self.config["tiktok.video"]:
-            loop = asyncio.get_running_loop()
-            with concurrent.futures.ThreadPoolExecutor() as pool:
-                tokensDict = await loop.run_in_executor(
-                pool, self.get_ttdownloader_tokens)
+            tokensDict = await self.get_ttdownloader_tokens()
+            if tokensDict is None:
+                return
 
             cookies, headers, data = await self.get_ttdownloader_params(tokensDict, url)
-            response = await self.http.post('https://ttdownloader.com/search/',cookies=cookies, headers=headers, data=data)
+            with self.metrics.stage("metadata"):
+                response = await self.http.post('https://ttdownloader.com/search/',cookies=cookies, headers=headers, data=data)
             
             if response.status != 200:
+                self.metrics.error("metadata", response.status)
                 self.log.warning(f"Unexpected status sending download request to ttdownloader.com: {response.status}")
                 return
             
             href_values = re.findall(r'href="([^"]+)"', await response.text())
             valid_urls = [url for url in href_values if yarl.URL(url).scheme in ['http', 'https']]
-            response = await self.http.get(valid_urls[0])
-            
-            if response.status != 200:
-                self.log.warning(f"Unexpected status fetching video for TikTok URL {url_tup}: {response.status}")
-                return
-
-            media = await response.read()
             mime_type = 'video/mp4'
             file_extension = ".mp4"
             file_name = str(hash(url)) + file_extension
-            uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
-            await self.client.send_file(evt.room_id, url=uri, info=BaseFileInfo(mimetype=mime_type, size=len(media)), file_name=file_name, file_type=MessageType.VIDEO)     
+            await self.send_remote_media(evt, valid_urls[0], mime_type, file_name, MessageType.VIDEO, f"video for TikTok URL {url_tup}")
 
     async def get_youtube_video_id(self, url):
         if "youtu.be" in url:
@@ -170,7 +503,7 @@ class SocialMediaDownloadPlugin(Plugin):
         video_id = await self.get_youtube_video_id(url)
 
         query_url = await self.generate_youtube_query_url(url)
-        response = await self.http.get(query_url)
+        response = await self.get_metadata(query_url, cache=True)
         if response.status != 200:
             self.log.warning(f"Unexpected status fetching video title {query_url}: {response.status}")
             return
@@ -183,68 +516,438 @@ class SocialMediaDownloadPlugin(Plugin):
 
         if self.config["youtube.thumbnail"]:
             thumbnail_link = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
-            response = await self.http.get(thumbnail_link)
-            if response.status != 200:
-                self.log.warning(f"Unexpected status fetching image {thumbnail_link}: {response.status}")
-                return
-            thumbnail = await response.read()
             filename = f"{video_id}.jpg"
-            uri = await self.client.upload_media(thumbnail, mime_type='image/jpeg', filename=filename)
-            await self.client.send_image(evt.room_id, url=uri, file_name=filename, info=ImageInfo(mimetype='image/jpeg'))
+            await self.send_remote_media(evt, thumbnail_link, 'image/jpeg', filename, description="image")
+
+    def load_instagram_state(self) -> None:
+        try:
+            with open(self.instagram_state_file, encoding="utf-8") as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.log.warning(f"Failed to load Instagram session from {self.instagram_state_file}: {e}")
+            return
+        try:
+            cookies = dict(state["cookies"])
+            self.instaloader.rate_controller.load_state(state["rate_controller"])
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            self.log.warning(f"Ignoring malformed Instagram session in {self.instagram_state_file}: {e!r}")
+            return
+        self.instaloader.update_cookies(cookies)
+
+    def save_instagram_state_soon(self) -> None:
+        # Posts loaded in quick succession share one write, which is done off the event loop.
+        if self.instagram_state_task is None or self.instagram_state_task.done():
+            self.instagram_state_task = asyncio.create_task(self._save_instagram_state_later())
+
+    async def _save_instagram_state_later(self) -> None:
+        await asyncio.sleep(5)
+        await asyncio.get_running_loop().run_in_executor(None, self.write_instagram_state, self.instagram_state())
+
+    def instagram_state(self) -> dict:
+        return {
+            "cookies": self.instaloader.save_session(),
+            "rate_controller": self.instaloader.rate_controller.save_state(),
+        }
+
+    def save_instagram_state(self) -> None:
+        if self.instagram_state_task is not None:
+            self.instagram_state_task.cancel()
+            self.instagram_state_task = None
+        self.write_instagram_state(self.instagram_state())
+
+    def write_instagram_state(self, state) -> None:
+        try:
+            with open(self.instagram_state_file + ".tmp", "w", encoding="utf-8") as file:
+                json.dump(state, file)
+            os.replace(self.instagram_state_file + ".tmp", self.instagram_state_file)
+        except OSError as e:
+            self.log.warning(f"Failed to save Instagram session to {self.instagram_state_file}: {e}")
+
+    async def load_instagram_post(self, shortcode):
+        post = await instaloader.post_from_shortcode(self.instaloader, shortcode)
+        # Read everything the handler needs right away, while the post is known to hold all of it.
+        loaded = types.SimpleNamespace(**{field: getattr(post, field) for field in [
+            "owner_username", "caption", "caption_hashtags", "caption_mentions", "likes", "comments", "is_video",
+            "url", "video_url"]})
+        # The items of a carousel come with the post's metadata; only the first max_items are kept.
+        loaded.sidecar_nodes = list(post.get_sidecar_nodes(0, self.config["instagram.max_items"] - 1))
+        self.save_instagram_state_soon()
+        return loaded
 
     async def handle_instagram(self, evt, url_tup):
-        L = instaloader.Instaloader(user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36")
         shortcode = url_tup[5]
         self.log.warning(shortcode)
-        post = instaloader.Post.from_shortcode(L.context, shortcode)
+        with self.metrics.stage("metadata"):
+            post = await self.load_instagram_post(shortcode)
 
         if self.config["instagram.info"]:
             await evt.reply(TextMessageEventContent(msgtype=MessageType.TEXT, format=Format.HTML, formatted_body=f"""<p>Username: {post.owner_username}<br>Caption: {post.caption}<br>Hashtags: {post.caption_hashtags}<br>Mentions: {post.caption_mentions}<br>Likes: {post.likes}<br>Comments: {post.comments}</p>"""))
 
-        if (post.is_video and self.config["instagram.thumbnail"]) or (not post.is_video and self.config["instagram.image"]):
-            response = await self.http.get(post.url)
-            if response.status != 200:
-                self.log.warning(f"Unexpected status fetching instagram image {post.url}: {response.status}")
-                return
+        if post.sidecar_nodes:
+            items = []
+            for i, node in enumerate(post.sidecar_nodes, 1):
+                if node.is_video and self.config["instagram.video"]:
+                    items.append((yarl.URL(node.video_url, encoded=True), 'video/mp4', f"{shortcode}_{i}.mp4", MessageType.VIDEO))
+                elif (node.is_video and self.config["instagram.thumbnail"]) or (not node.is_video and self.config["instagram.image"]):
+                    items.append((node.display_url, 'image/jpeg', f"{shortcode}_{i}.jpg", MessageType.IMAGE))
+            await self.send_media_group(evt, items, self.config["instagram.parallel_items"], self.config["instagram.max_bytes"])
+            return
 
-            media = await response.read()
+        if (post.is_video and self.config["instagram.thumbnail"]) or (not post.is_video and self.config["instagram.image"]):
             mime_type = 'image/jpeg'
             file_extension = ".jpg"
             file_name = shortcode + file_extension
-            uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
+            if not await self.send_remote_media(evt, post.url, mime_type, file_name, description="instagram image"):
+                return
             self.log.warning(f"{mime_type} {file_name}")
-            await self.client.send_image(evt.room_id, url=uri, file_name=file_name, info=ImageInfo(mimetype='image/jpeg'))
 
         if post.is_video and self.config["instagram.video"]:
-            response = await self.http.get(yarl.URL(post.video_url,encoded=True))
-            if response.status != 200:
-                self.log.warning(f"Unexpected status fetching instagram video {post.video_url}: {response.status}")
-                return
-
-            media = await response.read()
             mime_type = 'video/mp4'
             file_extension = ".mp4"
             file_name = shortcode + file_extension
-            uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
-            await self.client.send_file(evt.room_id, url=uri, info=BaseFileInfo(mimetype=mime_type, size=len(media)), file_name=file_name, file_type=MessageType.VIDEO)
+            await self.send_remote_media(evt, yarl.URL(post.video_url,encoded=True), mime_type, file_name, MessageType.VIDEO, "instagram video")
 
     async def get_redirected_url(self, short_url: str) -> str:
-        async with self.http.get(short_url, allow_redirects=True) as response:
+        async with await self.get_metadata(short_url, allow_redirects=True) as response:
             if response.status == 200:
                 return str(response.url)
             else:
                 self.log.warning(f"Unexpected status fetching redirected URL: {response.status}")
                 return None
             
-    async def send_image(self, evt, media_url, mime_type, file_name):
-        response = await self.http.get(media_url)
-        if response.status != 200:
-            self.log.warning(f"Unexpected status fetching media {media_url}: {response.status}")
-            return
+    @asynccontextmanager
+    async def transfer(self, cost):
+        """Hold a transfer slot for a download or upload of about *cost* bytes.
+
+        Small transfers get their slots first. While a large one waits or runs, the job gives up its scheduler
+        slot, so that the info texts and thumbnails of other jobs are not held up behind it."""
+        async with AsyncExitStack() as stack:
+            slot = current_slot.get()
+            if slot is not None and cost >= self.config["priority.large_size"]:
+                await stack.enter_async_context(slot.yielded())
+            with self.metrics.stage("schedule"):
+                await stack.enter_async_context(self.transfers.slot(cost))
+            yield
+
+    def new_downloader(self, http) -> Downloader:
+        return Downloader(http, self.budget, self.config["download.spill_threshold"],
+                          self.config["download.spool_threshold"], self.spool_dir,
+                          parallel_ranges=self.config["download.parallel_ranges"],
+                          parallel_threshold=self.config["download.parallel_threshold"],
+                          range_attempts=self.config["download.range_attempts"],
+                          retry_backoff=self.config["download.retry_backoff"],
+                          budget_wait=self.budget_wait)
+
+    def budget_wait(self):
+        """Give up the job's scheduler slot while its download waits for memory: jobs that hold memory may need a
+        slot again before they can give it back."""
+        slot = current_slot.get()
+        return slot.yielded() if slot is not None else nullcontext()
+
+    def estimate_size(self, msgtype, expected_size=None) -> int:
+        if expected_size:
+            return expected_size
+        return self.config["priority.video_estimate" if msgtype == MessageType.VIDEO else "priority.image_estimate"]
+
+    async def download_media(self, url, description, headers=None, expected_size=None, msgtype=MessageType.IMAGE, admit=None) -> Media:
+        """:param admit: Called with the expected size of the download, if known, before its body is read; it is dropped
+           if this returns False."""
+        if self.media_cache is not None:
+            media = self.media_cache.get(url)
+            self.metrics.cache_lookup("media", media is not None)
+            if media is not None:
+                return media
+        entry = current_job.get()
+        resume = on_spool = None
+        if entry is not None:
+            resume = entry.resume_for(str(url))
+            if resume is None and entry.spool_path and os.path.exists(entry.spool_path):
+                # The interrupted download is for another URL, e.g. one the platform signs anew every time.
+                os.unlink(entry.spool_path)
+            if resume is None:
+                await self.journal_stage("download", download_url=str(url), spool_path=None, validator=None)
+            on_spool = lambda path, validator: self.journal_spool(entry, path, validator)
+        def transfer(size):
+            if admit is not None and not admit(size):
+                raise DownloadRefused()
+            return self.transfer(self.estimate_size(msgtype, size))
+
+        try:
+            with self.metrics.stage("download"):
+                # The transfer slot is taken once the download's memory is reserved, never while waiting for it.
+                downloader = self.instagram_downloader if current_platform.get() == "instagram" else self.downloader
+                media = await downloader.fetch(url, headers=headers, expected_size=expected_size,
+                                               resume=resume, on_spool=on_spool, transfer=transfer)
+            self.metrics.add_bytes("download", media.size)
+            if self.media_cache is not None:
+                try:
+                    await self.media_cache.put(url, media)
+                except OSError as e:
+                    self.log.warning(f"Failed to cache {description}: {e}")
+            return media
+        except DownloadError as e:
+            self.log.warning(f"Unexpected status fetching {description}: {e.status}")
+            return None
+        except DownloadRefused:
+            return None
+
+    def journal_spool(self, entry, path, validator) -> None:
+        # Called from the download as it moves into a spool file; record it so that it can be resumed from there.
+        entry.spool_path, entry.validator = path, validator
+        self.journal_updates.add(task := asyncio.create_task(self.journal.update(entry)))
+        task.add_done_callback(self.journal_updates.discard)
+
+    async def send_remote_media(self, evt, url, mime_type, file_name, msgtype=MessageType.IMAGE, description="media", expected_size=None) -> bool:
+        entry = current_job.get()
+        if entry is not None and str(url) in entry.sent:
+            # Sent before the job was interrupted.
+            return True
+        prepared = await self.prepare_media(url, mime_type, file_name, msgtype, description, expected_size)
+        if prepared is None:
+            return False
+        uri, info, file_name = prepared
+        await self.send_media_event(evt.room_id, uri, info, file_name, msgtype, str(url))
+        return True
+
+    async def prepare_media(self, url, mime_type, file_name, msgtype=MessageType.IMAGE, description="media", expected_size=None, accept=None, admit=None):
+        """Download, process and upload the media at *url*, unless it has been uploaded before.
+
+        :param accept: Called with the downloaded media; it is dropped if this returns False.
+        :param admit: See :meth:`download_media`.
+        :return: The mxc URI, info and file name to send it with, or None if it was not fetched or not accepted."""
+        cached = self.sent_media.get(str(url))
+        self.metrics.cache_lookup("url", cached is not None)
+        if cached is not None:
+            return cached
+
+        media = await self.download_media(url, f"{description} {url}", expected_size=expected_size, msgtype=msgtype,
+                                          admit=admit)
+        if media is None:
+            return None
 
-        media = await response.read()
-        uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
-        await self.client.send_image(evt.room_id, url=uri, file_name=file_name, info=ImageInfo(mimetype=mime_type))
+        async with media:
+            if media.size == 0:
+                self.log.warning(f"Received 0 bytes when fetching {description} {url}")
+                return None
+            if accept is not None and not accept(media):
+                return None
+            known = await self.find_known_blob(media, str(url), file_name)
+            if known is not None:
+                return known
+            if msgtype == MessageType.VIDEO:
+                await self.postprocess_video(media, url)
+            else:
+                mime_type, file_name = await self.postprocess_image(media, mime_type, file_name, url)
+            uri, info = await self.upload_and_record(media, mime_type, msgtype, file_name, str(url))
+        return uri, info, file_name
+
+    async def send_cached(self, room_id, source, file_name, msgtype) -> bool:
+        cached = self.sent_media.get(source)
+        self.metrics.cache_lookup("url", cached is not None)
+        if cached is None:
+            return False
+        uri, info, file_name = cached
+        await self.send_media_event(room_id, uri, info, file_name, msgtype, source)
+        return True
+
+    async def find_known_blob(self, media: Media, source, file_name):
+        # The same file often arrives through several platforms; reuse its upload if the content is known.
+        digest = media.digest()
+        if not self.config["deduplicate"] or digest is None:
+            return None
+        known = await self.blobs.get(digest)
+        self.metrics.cache_lookup("blob", known is not None)
+        if known is None:
+            return None
+        uri, info = known
+        known = self.sent_media[source] = uri, info, self.uploaded_file_name(file_name, info)
+        return known
+
+    @staticmethod
+    def uploaded_file_name(file_name, info):
+        # The upload may have been re-encoded to another format; name it after what was uploaded.
+        mime_type = info.get("mimetype")
+        if mime_type and mimetypes.guess_type(file_name)[0] != mime_type:
+            extension = mimetypes.guess_extension(mime_type)
+            if extension:
+                return os.path.splitext(file_name)[0] + extension
+        return file_name
+
+    async def send_known_blob(self, room_id, media: Media, file_name, msgtype, source) -> bool:
+        known = await self.find_known_blob(media, source, file_name)
+        if known is None:
+            return False
+        uri, info, file_name = known
+        await self.send_media_event(room_id, uri, info, file_name, msgtype, source)
+        return True
+
+    async def upload_and_record(self, media: Media, mime_type, msgtype, file_name, source=None):
+        info = {"mimetype": mime_type, "size": media.size}
+        if self.config["probe.enabled"]:
+            info.update(await self.probe_media(media, msgtype, source))
+        uri = await self.upload_media(media, mime_type, file_name)
+        if source is not None:
+            self.sent_media[source] = (uri, info, file_name)
+        digest = media.digest()
+        if self.config["deduplicate"] and digest is not None:
+            await self.blobs.put(digest, uri, info)
+        return uri, info
+
+    async def send_media(self, room_id, media: Media, mime_type, file_name, msgtype, source=None) -> None:
+        uri, info = await self.upload_and_record(media, mime_type, msgtype, file_name, source)
+        await self.send_media_event(room_id, uri, info, file_name, msgtype, source)
+
+    async def send_media_group(self, evt, items, parallel, max_bytes=0) -> None:
+        """Send *items*, tuples of URL, mime type, file name and message type, in order.
+
+        Up to *parallel* items are downloaded and uploaded at the same time, while the next one in line is sent. Each
+        download takes its expected size out of *max_bytes* (if not 0) before its body is read, and its actual size
+        once it is complete; the first item that no longer fits is skipped with all items after it, and those of
+        them still in flight are cancelled."""
+        entry = current_job.get()
+        semaphore = asyncio.Semaphore(max(1, parallel))
+        # Bytes taken by each item so far, and the index of the first item that is skipped.
+        sizes = {}
+        limit = len(items)
+
+        def take(index, size) -> bool:
+            nonlocal limit
+            if index >= limit:
+                return False
+            sizes[index] = size or 0
+            if max_bytes:
+                total = 0
+                for i in sorted(sizes):
+                    if i >= limit:
+                        break
+                    total += sizes[i]
+                    if total > max_bytes:
+                        limit = i
+                        for task in tasks[i:]:
+                            if task is not asyncio.current_task():
+                                task.cancel()
+                        break
+            return index < limit
+
+        async def prepare(index, url, mime_type, file_name, msgtype):
+            if entry is not None and str(url) in entry.sent:
+                return None
+            # The items share the job's scheduler slot; they must not give it up and take it back concurrently.
+            current_slot.set(None)
+            async with semaphore:
+                if index >= limit:
+                    return None
+                return await self.prepare_media(url, mime_type, file_name, msgtype,
+                                                accept=lambda media: take(index, media.size),
+                                                admit=lambda size: take(index, size))
+
+        tasks = [asyncio.create_task(prepare(index, *item)) for index, item in enumerate(items)]
+        try:
+            for index, ((url, _, _, msgtype), task) in enumerate(zip(items, tasks)):
+                # Items are only cancelled by those before them, which are all done by now.
+                if index >= limit:
+                    break
+                prepared = await task
+                if prepared is not None:
+                    uri, info, file_name = prepared
+                    await self.send_media_event(evt.room_id, uri, info, file_name, msgtype, str(url))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if limit < len(items):
+            self.log.info(f"Skipped items of {evt.event_id} beyond {max_bytes} bytes")
+
+    async def send_media_event(self, room_id, uri, info, file_name, msgtype, source=None) -> None:
+        # Sent as raw content, as mautrix's info classes have no field for the blurhash.
+        content = {"msgtype": msgtype.value, "body": file_name, "url": uri, "info": info}
+        with self.metrics.stage("send"):
+            await self.client.send_message_event(room_id, EventType.ROOM_MESSAGE, content)
+        entry = current_job.get()
+        if entry is not None and source is not None:
+            entry.sent.add(source)
+            await self.journal_stage("sent")
+
+    async def probe_media(self, media: Media, msgtype, source) -> dict:
+        try:
+            with self.metrics.stage("probe"):
+                if msgtype == MessageType.VIDEO:
+                    return await self.probe_video(media) if self.probe_videos else {}
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.probe_pool, probe_image, media.path if media.spilled else media.getvalue(), self.config["probe.blurhash"])
+        except (TranscodeError, OSError) as e:
+            self.log.warning(f"Failed to probe media from {source}: {e}")
+            return {}
+        except RuntimeError:
+            # The worker pool has been shut down; send the media without its info.
+            return {}
+
+    async def probe_video(self, media: Media) -> dict:
+        path = media.spool()
+        info = await self.transcoder.probe_video(path)
+        if self.video_thumbnails:
+            poster = await self.transcoder.poster_frame(path)
+            if poster:
+                loop = asyncio.get_running_loop()
+                poster_info = await loop.run_in_executor(self.probe_pool, probe_image, poster, self.config["probe.blurhash"])
+                if "xyz.amorgan.blurhash" in poster_info:
+                    info["xyz.amorgan.blurhash"] = poster_info.pop("xyz.amorgan.blurhash")
+                with self.tracer.span("upload_thumbnail", size=len(poster)):
+                    info["thumbnail_url"] = await self.client.upload_media(poster, mime_type="image/jpeg", filename="thumbnail.jpg")
+                info["thumbnail_info"] = {"mimetype": "image/jpeg", "size": len(poster), **poster_info}
+        return info
+
+    async def upload_media(self, media: Media, mime_type, file_name):
+        await self.journal_stage("upload")
+        async with self.transfer(media.size):
+            with self.metrics.stage("upload"):
+                if media.spilled:
+                    # Stream spooled payloads from a memory map instead of reading them back into memory.
+                    uri = await self.client.upload_media(media.chunks(), mime_type=mime_type, filename=file_name, size=media.size)
+                else:
+                    uri = await self.client.upload_media(media.getvalue(), mime_type=mime_type, filename=file_name)
+        self.metrics.add_bytes("upload", media.size)
+        return uri
+
+    async def postprocess_video(self, media: Media, source) -> None:
+        if not self.config["transcode.enabled"]:
+            return
+        try:
+            with self.metrics.stage("transcode"):
+                transcoded = await self.transcoder.process(media)
+            if transcoded:
+                self.log.info(f"Transcoded video from {source} to {media.size} bytes")
+        except (TranscodeError, OSError) as e:
+            self.log.warning(f"Failed to transcode video from {source}: {e}")
+
+    async def postprocess_image(self, media: Media, mime_type, file_name, source):
+        if not self.config["reencode.enabled"] or media.size < self.config["reencode.min_size"]:
+            return mime_type, file_name
+        loop = asyncio.get_running_loop()
+        with self.metrics.stage("reencode"):
+            try:
+                result = await loop.run_in_executor(self.probe_pool, reencode_image,
+                                                    media.path if media.spilled else media.getvalue(),
+                                                    self.config["reencode.format"], self.config["reencode.quality"],
+                                                    self.config["reencode.max_dimension"], self.config["reencode.target_size"])
+            except RuntimeError:
+                # The worker pool has been shut down; send the original.
+                return mime_type, file_name
+        if result is None:
+            return mime_type, file_name
+        data, new_mime_type, extension = result
+        # Keep the original unless re-encoding saves enough to be worth the lost fidelity.
+        if len(data) > media.size * (1 - self.config["reencode.min_savings"]):
+            return mime_type, file_name
+        self.log.debug(f"Re-encoded image from {source}: {media.size} -> {len(data)} bytes")
+        media.replace_content(data)
+        return new_mime_type, os.path.splitext(file_name)[0] + extension
+
+    async def send_image(self, evt, media_url, mime_type, file_name, expected_size=None):
+        with self.tracer.span("send_image", url=media_url):
+            await self.send_remote_media(evt, media_url, mime_type, file_name, expected_size=expected_size)
 
     async def handle_reddit(self, evt, url_tup):
         url = ''.join(url_tup).split('?')[0]
@@ -257,7 +960,7 @@ class SocialMediaDownloadPlugin(Plugin):
         url = await self.get_redirected_url(url)
         query_url = quote(url).replace('%3A', ':') + ".json" + "?limit=1"
         headers = {'User-Agent': 'ggogel/SocialMediaDownloadMaubot'}
-        response = await self.http.request('GET', query_url, headers=headers)
+        response = await self.get_metadata(query_url, cache=True, headers=headers)
 
         if response.status != 200:
             self.log.warning(f"Unexpected status fetching reddit listing {query_url}: {response.status}")
@@ -274,6 +977,7 @@ class SocialMediaDownloadPlugin(Plugin):
         if 'url_overridden_by_dest' in post_data:
             media_url = post_data['url_overridden_by_dest']
             mime_type = mimetypes.guess_type(media_url)[0]
+            expected_size = None
 
             if mime_type is None:
                 if 'is_gallery' in post_data and post_data['is_gallery']:
@@ -284,14 +988,17 @@ class SocialMediaDownloadPlugin(Plugin):
                         await self.send_image(evt, media_url, mime_type, file_name)
                     return
                 elif 'secure_media' in post_data and 'reddit_video' in post_data['secure_media']:
-                    fallback_url = post_data['secure_media']['reddit_video']['fallback_url']
+                    reddit_video = post_data['secure_media']['reddit_video']
                 elif 'preview' in post_data and 'reddit_video_preview' in post_data['preview']:
-                    fallback_url = post_data['preview']['reddit_video_preview']['fallback_url']
+                    reddit_video = post_data['preview']['reddit_video_preview']
                 else:
                     self.log.warning(f"Unable to determine media url for {query_url}")
                     return
                 
-                media_url = fallback_url.split('?')[0]
+                media_url = reddit_video['fallback_url'].split('?')[0]
+                if reddit_video.get('bitrate_kbps') and reddit_video.get('duration'):
+                    # Reddit only reports the bitrate and duration of the video.
+                    expected_size = reddit_video['bitrate_kbps'] * 125 * reddit_video['duration']
                 mime_type = mimetypes.guess_type(media_url)[0]
 
             file_extension = mimetypes.guess_extension(mime_type)
@@ -304,20 +1011,7 @@ class SocialMediaDownloadPlugin(Plugin):
                 audio_url = media_url.replace("DASH_720", "DASH_audio")
                 url = urllib.parse.quote(url)
                 download_url = f"https://sd.rapidsave.com/download.php?permalink={url}&video_url={media_url}?source=fallback&audio_url={audio_url}?source=fallback"
-                response = await self.http.get(download_url)
-
-                if response.status != 200:
-                    self.log.warning(f"Unexpected status fetching media {download_url}: {response.status}")
-                    return
-
-                media = await response.read()
-
-                if len(media) == 0:
-                    self.log.warning(f"Received 0 bytes when fetching media {download_url}")
-                    return
-
-                uri = await self.client.upload_media(media, mime_type=mime_type, filename=file_name)
-                await self.client.send_file(evt.room_id, url=uri, info=BaseFileInfo(mimetype=mime_type, size=len(media)), file_name=file_name, file_type=MessageType.VIDEO)
+                await self.send_remote_media(evt, download_url, mime_type, file_name, MessageType.VIDEO, expected_size=expected_size)
 
             elif self.config["reddit.image"] or self.config["reddit.video"]:
                 self.log.warning(f"Unknown media type {query_url}: {mime_type}")
@@ -330,7 +1024,7 @@ class SocialMediaDownloadPlugin(Plugin):
         
         # Get the DID of the user
         did_url = f"https://public.api.bsky.app/xrpc/com.atproto.identity.resolveHandle?handle={user}"
-        async with self.http.get(did_url) as response:
+        async with await self.get_metadata(did_url, cache=True) as response:
             if response.status != 200:
                 self.log.warning(f"Failed to resolve handle {user}: HTTP {response.status}")
                 return
@@ -344,7 +1038,7 @@ class SocialMediaDownloadPlugin(Plugin):
             
         # Get the post using the DID and post ID and Bluesky's public relay API
         post_url = f"https://public.api.bsky.app/xrpc/app.bsky.feed.getPosts?uris=at://{did}/app.bsky.feed.post/{post_id}"
-        async with self.http.get(post_url) as response:
+        async with await self.get_metadata(post_url, cache=True) as response:
             if response.status != 200:
                 self.log.warning(f"Failed to fetch post {post_id}: HTTP {response.status}")
                 return
@@ -360,15 +1054,21 @@ class SocialMediaDownloadPlugin(Plugin):
 
             # Handle attachments
             embed = post.get("embed", {})
+            # The post record has the blobs behind the embed, with the size of each upload.
+            record_embed = post.get("record", {}).get("embed", {})
             if embed:
                 if "images" in embed:
+                    record_images = record_embed.get("images", [])
                     # We'll use the fullsize image if available, otherwise the thumbnail
-                    for image in embed["images"]:
+                    for i, image in enumerate(embed["images"]):
                         fullsize = image.get("fullsize")
                         thumb = image.get("thumb")
                         alt = image.get("alt", "Bluesky Image")
+                        expected_size = None
                         if fullsize:
                             media_url = fullsize
+                            if i < len(record_images):
+                                expected_size = record_images[i].get("image", {}).get("size")
                         elif thumb:
                             media_url = thumb
                         else:
@@ -377,33 +1077,44 @@ class SocialMediaDownloadPlugin(Plugin):
                         
                         mime_type = mimetypes.guess_type(media_url)[0] or "image/jpeg"
                         file_name = f"{post_id}_image.jpg"
-                        await self.send_image(evt, media_url, mime_type, file_name)
+                        await self.send_image(evt, media_url, mime_type, file_name, expected_size)
                 elif "playlist" in embed:
                     playlist_url = embed["playlist"]
                     thumbnail_url = embed.get("thumbnail")
                     self.log.info(f"Video URL: {playlist_url}, Thumbnail URL: {thumbnail_url}")
                     
                     if playlist_url and self.config["bluesky.video"]:
-                        media_bytes = await self.download_m3u8_file(playlist_url)
-                        if not media_bytes:
-                            self.log.warning(f"Failed to download video from {playlist_url}")
-                            return
-                        
                         mime_type = "video/mp4"
                         file_name = f"{post_id}_video.mp4"
-                        uri = await self.client.upload_media(media_bytes, mime_type=mime_type, filename=file_name)
-                        await self.client.send_file(evt.room_id, url=uri, info=BaseFileInfo(mimetype=mime_type, size=len(media_bytes)), file_name=file_name, file_type=MessageType.VIDEO)
+                        if not await self.send_cached(evt.room_id, playlist_url, file_name, MessageType.VIDEO):
+                            media = await self.download_m3u8_file(playlist_url, record_embed.get("video", {}).get("size"))
+                            if media is None:
+                                self.log.warning(f"Failed to download video from {playlist_url}")
+                                return
+
+                            async with media:
+                                if await self.send_known_blob(evt.room_id, media, file_name, MessageType.VIDEO, playlist_url):
+                                    return
+                                await self.postprocess_video(media, playlist_url)
+                                await self.send_media(evt.room_id, media, mime_type, file_name, MessageType.VIDEO, playlist_url)
                     
                     if thumbnail_url and self.config["bluesky.thumbnail"]:
                         mime_type = mimetypes.guess_type(thumbnail_url)[0] or "image/jpeg"
                         file_name = f"{post_id}_thumbnail.jpg"
                         await self.send_image(evt, thumbnail_url, mime_type, file_name)
     
-    async def download_m3u8_file(self, m3u8_url: str):
+    async def download_m3u8_file(self, m3u8_url: str, expected_size=None) -> Media:
+        with self.tracer.span("download_m3u8_file", url=m3u8_url) as span:
+            media = await self._download_m3u8_file(m3u8_url, expected_size)
+            if span is not None and media is not None:
+                span.set("size", media.size)
+            return media
+
+    async def _download_m3u8_file(self, m3u8_url: str, expected_size=None) -> Media:
         async with self.http.get(m3u8_url) as response:
             if response.status != 200:
                 self.log.warning(f"Failed to fetch playlist: {m3u8_url} — HTTP {response.status}")
-                return b''
+                return None
             playlist = await response.text()
         
         if "#EXT-X-STREAM-INF" in playlist:
@@ -411,9 +1122,9 @@ class SocialMediaDownloadPlugin(Plugin):
             next_m3u8 = next((line for line in lines if not line.startswith("#")), None)
             if not next_m3u8:
                 self.log.warning(f"No variant found in master playlist: {m3u8_url}")
-                return b''
+                return None
             nested_url = urljoin(m3u8_url, next_m3u8)
-            return await self.download_m3u8_file(nested_url)
+            return await self._download_m3u8_file(nested_url, expected_size)
 
         segment_urls = []
         base_url = m3u8_url.rsplit("/", 1)[0] + "/"
@@ -424,24 +1135,36 @@ class SocialMediaDownloadPlugin(Plugin):
 
         if not segment_urls:
             self.log.warning(f"No segments found in: {m3u8_url}")
-            return b''
-
-        segment_data = []
-        for i, url in enumerate(segment_urls):
-            async with self.http.get(url) as segment_response:
-                if segment_response.status != 200:
-                    self.log.warning(f"Failed to download segment {i + 1}: {url} — HTTP {segment_response.status}")
-                    continue
-                segment_data.append(await segment_response.read())
-                if i % 10 == 0:
-                    self.log.debug(f"Downloaded segment {i + 1}/{len(segment_urls)}")
+            return None
 
-        if not segment_data:
+        # Without the size of the uploaded video, the payload spills to disk once it outgrows its reservation.
+        media = await self.downloader.open(expected_size)
+        downloaded = 0
+        try:
+            async with self.transfer(self.estimate_size(MessageType.VIDEO, expected_size)):
+                with self.metrics.stage("download"):
+                    for i, url in enumerate(segment_urls):
+                        async with self.http.get(url) as segment_response:
+                            if segment_response.status != 200:
+                                self.log.warning(f"Failed to download segment {i + 1}: {url} — HTTP {segment_response.status}")
+                                self.metrics.error("download", segment_response.status)
+                                continue
+                            await self.downloader.read_into(media, segment_response)
+                            downloaded += 1
+                            if i % 10 == 0:
+                                self.log.debug(f"Downloaded segment {i + 1}/{len(segment_urls)}")
+        except BaseException:
+            media.close()
+            raise
+        self.metrics.add_bytes("download", media.size)
+
+        if not downloaded:
             self.log.warning("All segment downloads failed.")
-            return b''
+            media.close()
+            return None
 
         self.log.info("All segments downloaded.")
-        return b"".join(segment_data)
+        return media
 
     async def get_aparat_video_id(self, url):
         match = aparat_pattern.findall(url)
@@ -462,7 +1185,7 @@ class SocialMediaDownloadPlugin(Plugin):
         video_id = url_tup[2]  # Directly extract the video ID from the regex groups
         query_url = await self.generate_aparat_query_url(video_id)
 
-        response = await self.http.get(query_url)
+        response = await self.get_metadata(query_url, cache=True)
         if response.status != 200:
             self.log.warning(f"Unexpected status fetching video data: {query_url}: {response.status}")
             return
@@ -476,14 +1199,9 @@ class SocialMediaDownloadPlugin(Plugin):
 
         if self.config["aparat.thumbnail"]:
             thumbnail_url = data['video']['big_poster']  # Higher quality thumbnail
-            response = await self.http.get(thumbnail_url)
-            if response.status != 200:
-                self.log.warning(f"Unexpected status fetching image {thumbnail_url}: {response.status}")
-                return
-            thumbnail = await response.read()
             filename = f"{video_id}.jpg"
-            uri = await self.client.upload_media(thumbnail, mime_type='image/jpeg', filename=filename)
-            await self.client.send_image(evt.room_id, url=uri, file_name=filename, info=ImageInfo(mimetype='image/jpeg'))
+            if not await self.send_remote_media(evt, thumbnail_url, 'image/jpeg', filename, description="image"):
+                return
 
         if self.config["aparat.video"]:
             try:
@@ -500,26 +1218,11 @@ class SocialMediaDownloadPlugin(Plugin):
 
                 self.log.info(f"Downloading Aparat video from {video_url}")
 
-                video_response = await self.http.get(video_url)
-                if video_response.status != 200:
-                    self.log.warning(f"Failed to download Aparat video: HTTP {video_response.status}")
-                    return
-
-                video_data = await video_response.read()
                 mime_type = 'video/mp4'
                 filename = f"{title}.mp4"
 
-                uri = await self.client.upload_media(video_data, mime_type=mime_type, filename=filename)
-                await self.client.send_file(
-                    evt.room_id,
-                    url=uri,
-                    info=BaseFileInfo(
-                        mimetype=mime_type,
-                        size=len(video_data)
-                    ),
-                    file_name=filename,
-                    file_type=MessageType.VIDEO
-                )
+                if not await self.send_remote_media(evt, video_url, mime_type, filename, MessageType.VIDEO, "Aparat video"):
+                    return
                 self.log.info(f"Successfully sent Aparat video {filename}")
 
             except KeyError as e:
@@ -0,0 +1,40 @@
+import asyncio
+import logging
+import unittest
+from types import SimpleNamespace
+
+from mediapipeline import Backlog
+
+
+class DiscardTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_redacted_events_are_not_handled(self):
+        handled = []
+        busy = asyncio.Event()
+
+        async def handler(evt):
+            handled.append(evt.event_id)
+
+        backlog = Backlog(3, handler, lambda: not busy.is_set(), logging.getLogger("test"), settle=0,
+                          poll_interval=0.001)
+        busy.set()
+        for i, event_id in enumerate(["$a", "$b", "$c"]):
+            backlog.add(SimpleNamespace(room_id="!room", event_id=event_id, timestamp=i))
+        backlog.add(SimpleNamespace(room_id="!other", event_id="$d", timestamp=3))
+        self.assertEqual(backlog.discard("!room", "$a"), 1)
+        # Once the backlog has settled the events wait to be handled outside of the per-room queues.
+        await asyncio.sleep(0.01)
+        self.assertEqual(backlog.discard("!room", "$b"), 1)
+        self.assertEqual(backlog.discard("!other"), 1)
+        self.assertEqual(len(backlog), 1)
+        busy.clear()
+        for _ in range(100):
+            if not len(backlog):
+                break
+            await asyncio.sleep(0.001)
+        self.assertEqual(handled, ["$c"])
+        backlog.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
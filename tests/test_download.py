@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import unittest
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from mediapipeline import Downloader, FixtureSession, FixtureStore, MemoryBudget, PriorityGate
+from mediapipeline.fixtures import Exchange
+
+BODY_SIZE = 800_000
+BODY = os.urandom(300_000)
+ETAG = '"v1"'
+
+
+class TransferSlotTest(unittest.IsolatedAsyncioTestCase):
+    """Downloads and uploads share transfer slots while downloads also reserve memory that is only given back after
+    the upload; more jobs than slots, each filling the budget, must not wait for each other in a circle."""
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        store = FixtureStore(self.directory.name)
+        self.urls = [f"https://media.test/{i}.mp4" for i in range(8)]
+        for url in self.urls:
+            store.record(store.key("GET", url),
+                         Exchange(200, "OK", url, [("Content-Type", "video/mp4")], bytes(BODY_SIZE), 0, 0))
+        self.budget = MemoryBudget(BODY_SIZE + BODY_SIZE // 2)
+        self.gate = PriorityGate(2)
+        self.downloader = Downloader(FixtureSession(store, timing=False), self.budget, spill_threshold=64 * 1024,
+                                     spool_threshold=10 * BODY_SIZE, spool_dir=self.directory.name)
+
+    async def asyncTearDown(self):
+        self.directory.cleanup()
+
+    async def job(self, url):
+        media = await self.downloader.fetch(url, transfer=lambda size: self.gate.slot(size or 0))
+        async with media:
+            self.assertEqual(media.size, BODY_SIZE)
+            # The upload, which needs a slot of its own while the download's reservation is still held.
+            async with self.gate.slot(media.size):
+                await asyncio.sleep(0)
+
+    async def test_more_jobs_than_slots_complete(self):
+        await asyncio.wait_for(asyncio.gather(*(self.job(url) for url in self.urls)), timeout=10)
+        self.assertEqual(self.budget.used, 0)
+        self.assertEqual(self.gate.used, 0)
+
+
+class RangeServer:
+    """Serves BODY with ranges validated by ETAG, and cuts the connection off after *drop_after* bytes of the first
+    response."""
+
+    def __init__(self, drop_after=None):
+        self.drop_after = drop_after
+        self.requests = []
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        range_header = request.headers.get("Range")
+        self.requests.append(range_header)
+        headers = {"Accept-Ranges": "bytes", "ETag": ETAG, "Content-Type": "video/mp4"}
+        if range_header and request.headers.get("If-Range", ETAG) == ETAG:
+            start, _, end = range_header[len("bytes="):].partition("-")
+            start, end = int(start), int(end) + 1 if end else len(BODY)
+            if start >= len(BODY):
+                return web.Response(status=416, headers={**headers, "Content-Range": f"bytes */{len(BODY)}"})
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(BODY)}"
+            return web.Response(status=206, body=BODY[start:end], headers=headers)
+        if self.drop_after is not None:
+            drop_after, self.drop_after = self.drop_after, None
+            response = web.StreamResponse(headers=headers)
+            response.content_length = len(BODY)
+            await response.prepare(request)
+            await response.write(BODY[:drop_after])
+            request.transport.close()
+            return response
+        return web.Response(body=BODY, headers=headers)
+
+
+class ResumeTest(unittest.IsolatedAsyncioTestCase):
+    """Downloads continue from the last byte received with If-Range requests, and start over when the entity has
+    changed."""
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.budget = MemoryBudget(10 * len(BODY))
+        self.http = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.http.close()
+        if hasattr(self, "server"):
+            await self.server.close()
+        self.directory.cleanup()
+
+    async def serve(self, server: RangeServer) -> str:
+        app = web.Application()
+        app.router.add_get("/video.mp4", server.handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url("/video.mp4"))
+
+    def downloader(self, **kwargs) -> Downloader:
+        return Downloader(self.http, self.budget, spill_threshold=64 * 1024, spool_threshold=10 * len(BODY),
+                          spool_dir=self.directory.name, chunk_size=16 * 1024, retry_backoff=0, **kwargs)
+
+    def partial_download(self, data: bytes) -> str:
+        path = os.path.join(self.directory.name, "partial.part")
+        with open(path, "wb") as file:
+            file.write(data)
+        return path
+
+    async def assert_complete(self, media):
+        async with media:
+            self.assertEqual(media.size, len(BODY))
+            self.assertEqual(bytes(media.getvalue()), BODY)
+            self.assertEqual(media.digest(), hashlib.sha256(BODY).hexdigest())
+        self.assertEqual(self.budget.used, 0)
+
+    async def test_dropped_connection_continues_from_last_byte(self):
+        server = RangeServer(drop_after=100_000)
+        url = await self.serve(server)
+        await self.assert_complete(await self.downloader().fetch(url))
+        self.assertEqual(server.requests[0], None)
+        start = int(server.requests[1][len("bytes="):-1])
+        self.assertGreater(start, 0)
+        self.assertLessEqual(start, 100_000)
+
+    async def test_dropped_connection_fails_after_last_attempt(self):
+        url = await self.serve(RangeServer(drop_after=100_000))
+        with self.assertRaises(aiohttp.ClientPayloadError):
+            await self.downloader(range_attempts=1).fetch(url)
+        self.assertEqual(self.budget.used, 0)
+
+    async def test_resume_from_spool_file(self):
+        server = RangeServer()
+        url = await self.serve(server)
+        path = self.partial_download(BODY[:123_456])
+        await self.assert_complete(await self.downloader().fetch(url, resume=(path, ETAG)))
+        self.assertEqual(server.requests, ["bytes=123456-"])
+        self.assertFalse(os.path.exists(path))
+
+    async def test_resume_of_complete_download(self):
+        url = await self.serve(RangeServer())
+        path = self.partial_download(BODY)
+        await self.assert_complete(await self.downloader().fetch(url, resume=(path, ETAG)))
+
+    async def test_changed_entity_starts_over(self):
+        server = RangeServer()
+        url = await self.serve(server)
+        path = self.partial_download(b"an older version of the file")
+        await self.assert_complete(await self.downloader().fetch(url, resume=(path, '"v0"')))
+        self.assertEqual(server.requests, ["bytes=28-"])
+        self.assertFalse(os.path.exists(path))
+
+    async def test_parallel_ranges_are_assembled_in_order(self):
+        server = RangeServer()
+        url = await self.serve(server)
+        await self.assert_complete(await self.downloader(parallel_ranges=4).fetch(url))
+        self.assertEqual(server.requests[0], None)
+        self.assertEqual(sorted(server.requests[1:]), ["bytes=150000-224999", "bytes=225000-299999",
+                                                       "bytes=75000-149999"])
+
+
+if __name__ == "__main__":
+    unittest.main()
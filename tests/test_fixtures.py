@@ -0,0 +1,91 @@
+import tempfile
+import unittest
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import instaloader
+from mediapipeline import FixtureMissing, FixtureSession, FixtureStore
+
+VIDEO = bytes(range(256)) * 64
+
+
+async def graphql(request: web.Request) -> web.Response:
+    return web.json_response({"query": request.query.get("q")}, headers={"Set-Cookie": "csrftoken=abc"})
+
+
+async def login(request: web.Request) -> web.Response:
+    form = await request.post()
+    return web.json_response({"user": form.get("user")})
+
+
+async def video(request: web.Request) -> web.Response:
+    return web.Response(body=VIDEO, content_type="video/mp4")
+
+
+class RecordReplayTest(unittest.IsolatedAsyncioTestCase):
+    """Traffic recorded through a :class:`FixtureSession` comes back the same when it is replayed from disk,
+    including through the Instaloader context that Instagram posts are looked up with."""
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        app = web.Application()
+        app.router.add_get("/graphql", graphql)
+        app.router.add_post("/login", login)
+        app.router.add_get("/video.mp4", video)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+        self.directory.cleanup()
+
+    async def record(self, **store_options):
+        async with aiohttp.ClientSession() as http:
+            recorder = FixtureSession(FixtureStore(self.directory.name, **store_options), http)
+            async with recorder.get(self.server.make_url("/graphql"), params={"q": "post"}) as response:
+                self.assertEqual(await response.json(), {"query": "post"})
+            async with recorder.post(self.server.make_url("/login"), data={"user": "me"}) as response:
+                self.assertEqual(await response.json(), {"user": "me"})
+            async with recorder.get(self.server.make_url("/video.mp4")) as response:
+                self.assertEqual(await response.read(), VIDEO)
+
+    async def test_replay(self):
+        await self.record()
+        player = FixtureSession(FixtureStore(self.directory.name), timing=False)
+
+        async with player.get(self.server.make_url("/graphql"), params={"q": "post"}) as response:
+            self.assertEqual(response.status, 200)
+            self.assertEqual(await response.json(), {"query": "post"})
+            self.assertEqual(response.cookies["csrftoken"].value, "abc")
+        async with player.post(self.server.make_url("/login"), data={"user": "me"}) as response:
+            self.assertEqual(await response.json(), {"user": "me"})
+        # Requests are told apart by their query and body.
+        with self.assertRaises(FixtureMissing):
+            await player.get(self.server.make_url("/graphql"), params={"q": "profile"})
+        with self.assertRaises(FixtureMissing):
+            await player.post(self.server.make_url("/login"), data={"user": "you"})
+
+        context = instaloader.AsyncInstaloaderContext(quiet=True, http=player)
+        self.assertIs(context.cdn_http, player)
+        response = await context.get_raw(str(self.server.make_url("/video.mp4")))
+        try:
+            self.assertEqual(response.headers["Content-Type"], "video/mp4")
+            self.assertEqual(await response.read(), VIDEO)
+        finally:
+            response.release()
+        await context.close()
+
+    async def test_truncated_media_is_padded_to_its_size(self):
+        await self.record(media="truncate", media_limit=1024)
+        player = FixtureSession(FixtureStore(self.directory.name), timing=False)
+        async with player.get(self.server.make_url("/video.mp4")) as response:
+            body = await response.read()
+        self.assertEqual(len(body), len(VIDEO))
+        self.assertEqual(body[:1024], VIDEO[:1024])
+        self.assertEqual(body[1024:], bytes(len(VIDEO) - 1024))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import asyncio
+import unittest
+
+from mediapipeline import JobRegistry
+
+
+class CancelTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancelled_tells_redactions_from_shutdown(self):
+        jobs = JobRegistry()
+        redacted = asyncio.create_task(asyncio.sleep(10))
+        shut_down = asyncio.create_task(asyncio.sleep(10))
+        runs = [asyncio.create_task(jobs.run("!room", "$redacted", redacted)),
+                asyncio.create_task(jobs.run("!room", "$other", shut_down))]
+        await asyncio.sleep(0)
+        self.assertEqual(jobs.cancel_event("!room", "$redacted"), 1)
+        shut_down.cancel()
+        self.assertEqual(await asyncio.wait_for(asyncio.gather(*runs), timeout=1), [False, False])
+        self.assertTrue(jobs.cancelled(redacted))
+        self.assertFalse(jobs.cancelled(shut_down))
+
+    async def test_shutdown_waits_for_jobs_to_unwind(self):
+        jobs = JobRegistry()
+        unwound = []
+
+        async def job():
+            try:
+                await asyncio.sleep(10)
+            finally:
+                await asyncio.sleep(0)
+                unwound.append(True)
+
+        task = asyncio.create_task(job())
+        run = asyncio.create_task(jobs.run("!room", "$event", task))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(jobs.shutdown(), timeout=1)
+        self.assertEqual(unwound, [True])
+        self.assertFalse(jobs.cancelled(task))
+        self.assertFalse(await run)
+
+
+if __name__ == "__main__":
+    unittest.main()
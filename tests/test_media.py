@@ -0,0 +1,75 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from mediapipeline import Media
+
+DATA = os.urandom(100_000)
+# Regions written out of order: ahead of the hashed prefix, next to each other in both directions, and finally
+# the gap that joins everything up.
+REGIONS = [(60_000, 80_000), (80_000, 100_000), (30_000, 45_000), (20_000, 30_000), (45_000, 60_000),
+           (0, 20_000)]
+
+
+class DigestTest(unittest.TestCase):
+    """The SHA-256 of a payload is computed while it is written, also when its regions arrive out of order."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assemble(self, spill_threshold: int) -> Media:
+        media = Media(spill_threshold, self.directory.name)
+        media.allocate(len(DATA))
+        for start, end in REGIONS:
+            self.assertIsNone(media.digest())
+            media.write_at(start, DATA[start:end])
+        return media
+
+    def test_out_of_order_regions_in_memory(self):
+        media = self.assemble(len(DATA))
+        self.assertFalse(media.spilled)
+        self.assertEqual(bytes(media.getvalue()), DATA)
+        self.assertEqual(media.digest(), hashlib.sha256(DATA).hexdigest())
+        media.close()
+
+    def test_out_of_order_regions_in_spool_file(self):
+        media = self.assemble(0)
+        self.assertTrue(media.spilled)
+        self.assertEqual(media.getvalue(), DATA)
+        self.assertEqual(media.digest(), hashlib.sha256(DATA).hexdigest())
+        media.close()
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_sequential_writes_across_spill(self):
+        media = Media(30_000, self.directory.name)
+        for start in range(0, len(DATA), 7_000):
+            media.write(DATA[start:start + 7_000])
+        self.assertTrue(media.spilled)
+        self.assertEqual(media.digest(), hashlib.sha256(DATA).hexdigest())
+        media.close()
+
+    def test_digest_survives_replacement(self):
+        media = Media(len(DATA), self.directory.name)
+        media.write(DATA)
+        media.replace_content(b"processed")
+        self.assertEqual(media.getvalue(), b"processed")
+        self.assertEqual(media.digest(), hashlib.sha256(DATA).hexdigest())
+        media.close()
+
+    def test_adopted_spool_file_is_hashed_from_the_start(self):
+        path = os.path.join(self.directory.name, "partial.part")
+        with open(path, "wb") as file:
+            file.write(DATA[:40_000])
+        media = Media(0, self.directory.name)
+        media.adopt(path)
+        media.write(DATA[40_000:])
+        self.assertEqual(media.digest(), hashlib.sha256(DATA).hexdigest())
+        media.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import unittest
+
+from mediapipeline import Media, MediaCache
+
+
+def payload(byte: int, size: int = 1000) -> Media:
+    media = Media(size)
+    media.write(bytes([byte]) * size)
+    return media
+
+
+class MediaCacheTest(unittest.IsolatedAsyncioTestCase):
+    """The on-disk media cache: index replay after a crash, eviction order and compaction of the index log."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        self.directory.cleanup()
+
+    def open(self, max_bytes: int = 1 << 20) -> MediaCache:
+        cache = MediaCache(self.directory.name, max_bytes)
+        self.caches.append(cache)
+        return cache
+
+    def reopen(self, cache: MediaCache, max_bytes: int = 1 << 20) -> MediaCache:
+        cache.close()
+        self.caches.remove(cache)
+        return self.open(max_bytes)
+
+    async def put(self, cache: MediaCache, url: str, byte: int, size: int = 1000) -> str:
+        media = payload(byte, size)
+        try:
+            await cache.put(url, media)
+            return media.digest()
+        finally:
+            media.close()
+
+    def read(self, cache: MediaCache, url: str) -> bytes:
+        media = cache.get(url)
+        self.assertIsNotNone(media)
+        try:
+            return bytes(media.getvalue())
+        finally:
+            media.close()
+
+    def objects(self) -> set:
+        return set(os.listdir(os.path.join(self.directory.name, "objects")))
+
+    async def test_replay_after_truncated_last_line(self):
+        cache = self.open()
+        await self.put(cache, "https://cdn.example/a.jpg", 1)
+        second = await self.put(cache, "https://cdn.example/b.jpg", 2)
+        cache.close()
+        self.caches.remove(cache)
+        # A crash in the middle of appending the record of the second entry.
+        index = os.path.join(self.directory.name, "index.jsonl")
+        with open(index, "r+b") as file:
+            file.truncate(os.path.getsize(index) - 7)
+
+        cache = self.open()
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.digest_for("https://cdn.example/b.jpg"))
+        # The file that was never logged is removed.
+        self.assertNotIn(second, self.objects())
+
+        # The first record appended after the torn line is not lost with it.
+        third = await self.put(cache, "https://cdn.example/c.jpg", 3)
+        cache = self.reopen(cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.digest_for("https://cdn.example/c.jpg"), third)
+        self.assertEqual(self.read(cache, "https://cdn.example/c.jpg"), bytes([3]) * 1000)
+        self.assertEqual(self.read(cache, "https://cdn.example/a.jpg"), bytes([1]) * 1000)
+
+    async def test_least_recently_used_are_evicted_first(self):
+        cache = self.open(max_bytes=3000)
+        first = await self.put(cache, "https://cdn.example/1", 1)
+        second = await self.put(cache, "https://cdn.example/2", 2)
+        third = await self.put(cache, "https://cdn.example/3", 3)
+        # A hit makes the oldest entry the most recently used.
+        self.read(cache, "https://cdn.example/1")
+        fourth = await self.put(cache, "https://cdn.example/4", 4)
+        self.assertIsNone(cache.digest_for("https://cdn.example/2"))
+        self.assertEqual(self.objects(), {first, third, fourth})
+        self.assertEqual(cache.size, 3000)
+
+        # The order survives a restart, so the next eviction takes the third entry.
+        cache = self.reopen(cache, max_bytes=3000)
+        self.assertEqual(cache.size, 3000)
+        await self.put(cache, "https://cdn.example/5", 5)
+        self.assertIsNone(cache.digest_for("https://cdn.example/3"))
+        self.assertEqual(cache.digest_for("https://cdn.example/1"), first)
+        self.assertEqual(cache.digest_for("https://cdn.example/4"), fourth)
+        self.assertNotIn(second, self.objects())
+        self.assertNotIn(third, self.objects())
+
+    async def test_payload_larger_than_cache_is_not_stored(self):
+        cache = self.open(max_bytes=500)
+        await self.put(cache, "https://cdn.example/big", 1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(self.objects(), set())
+
+    async def test_compaction_keeps_entries_and_order(self):
+        cache = self.open(max_bytes=3000)
+        first = await self.put(cache, "https://cdn.example/1", 1)
+        second = await self.put(cache, "https://cdn.example/2", 2)
+        third = await self.put(cache, "https://cdn.example/3?b=2&a=1", 3)
+        for _ in range(1100):
+            self.read(cache, "https://cdn.example/2")
+        self.read(cache, "https://cdn.example/1")
+        index = os.path.join(self.directory.name, "index.jsonl")
+        with open(index, encoding="utf-8") as file:
+            self.assertLess(sum(1 for _ in file), 1000)
+
+        cache = self.reopen(cache, max_bytes=3000)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.digest_for("https://cdn.example/3?a=1&b=2"), third)
+        # Least recently used first: the third entry, then the second, then the first.
+        await self.put(cache, "https://cdn.example/4", 4)
+        self.assertIsNone(cache.digest_for("https://cdn.example/3?a=1&b=2"))
+        await self.put(cache, "https://cdn.example/5", 5)
+        self.assertIsNone(cache.digest_for("https://cdn.example/2"))
+        self.assertEqual(cache.digest_for("https://cdn.example/1"), first)
+        self.assertNotIn(second, self.objects())
+
+
+if __name__ == "__main__":
+    unittest.main()
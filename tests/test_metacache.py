@@ -0,0 +1,99 @@
+import unittest
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from mediapipeline import MetadataCache, canonical_url
+
+
+class Upstream:
+    """A metadata API that tags its responses with an ETag and answers a matching If-None-Match with 304."""
+
+    def __init__(self):
+        self.version = 1
+        self.status = 200
+        self.requests = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests.append(request.headers.get("If-None-Match"))
+        etag = f'"v{self.version}"'
+        if self.status != 200:
+            return web.json_response({"error": "unavailable"}, status=self.status)
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.json_response({"version": self.version}, headers={"ETag": etag})
+
+
+class MetadataCacheTest(unittest.IsolatedAsyncioTestCase):
+    """Responses are served from memory while fresh and revalidated with their ETag once they are stale."""
+
+    async def asyncSetUp(self):
+        self.upstream = Upstream()
+        app = web.Application()
+        app.router.add_get("/api/post", self.upstream.handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.http = aiohttp.ClientSession()
+        self.cache = MetadataCache(self.http, 16)
+        self.url = str(self.server.make_url("/api/post?id=1"))
+
+    async def asyncTearDown(self):
+        await self.http.close()
+        await self.server.close()
+
+    def entry(self):
+        return self.cache._entries.get(canonical_url(self.url))
+
+    def expire(self) -> None:
+        self.entry().expires_at = 0
+
+    async def test_hit_while_fresh(self):
+        response, result = await self.cache.get(self.url, 60)
+        self.assertEqual(result, "miss")
+        self.assertEqual(await response.json(), {"version": 1})
+        response, result = await self.cache.get(self.url, 60)
+        self.assertEqual(result, "hit")
+        self.assertEqual(await response.json(), {"version": 1})
+        self.assertEqual(self.upstream.requests, [None])
+
+    async def test_not_modified_refreshes_the_time_to_live(self):
+        await self.cache.get(self.url, 60)
+        entry = self.entry()
+        self.expire()
+        response, result = await self.cache.get(self.url, 60)
+        self.assertEqual(result, "revalidated")
+        self.assertIs(self.entry(), entry)
+        self.assertEqual(entry.expires_at - entry.fetched_at, 60_000)
+        self.assertGreater(entry.expires_at, 0)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.json(), {"version": 1})
+        self.assertEqual(self.upstream.requests, [None, '"v1"'])
+        # Fresh again, so the next lookup does not go upstream.
+        _, result = await self.cache.get(self.url, 60)
+        self.assertEqual(result, "hit")
+        self.assertEqual(len(self.upstream.requests), 2)
+
+    async def test_changed_response_replaces_the_entry(self):
+        await self.cache.get(self.url, 60)
+        self.expire()
+        self.upstream.version = 2
+        response, result = await self.cache.get(self.url, 60)
+        self.assertEqual(result, "miss")
+        self.assertEqual(await response.json(), {"version": 2})
+        response, result = await self.cache.get(self.url, 60)
+        self.assertEqual(result, "hit")
+        self.assertEqual(await response.json(), {"version": 2})
+
+    async def test_errors_are_not_cached(self):
+        self.upstream.status = 503
+        response, result = await self.cache.get(self.url, 60)
+        self.assertEqual((response.status, result), (503, "miss"))
+        self.upstream.status = 200
+        response, result = await self.cache.get(self.url, 60)
+        self.assertEqual((response.status, result), (200, "miss"))
+        self.assertEqual(len(self.upstream.requests), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,21 @@
+import asyncio
+import unittest
+
+from mediapipeline import PriorityGate
+
+
+class PriorityGateTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_zero_slots_means_no_limit(self):
+        gate = PriorityGate(0)
+
+        async def transfer():
+            async with gate.slot(1024):
+                await asyncio.sleep(0)
+
+        await asyncio.wait_for(asyncio.gather(*(transfer() for _ in range(3))), timeout=1)
+        self.assertEqual(gate.used, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
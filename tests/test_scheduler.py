@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+
+from mediapipeline import FairScheduler
+
+
+class QuotaTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_taking_back_a_yielded_slot_is_not_charged(self):
+        scheduler = FairScheduler(1, room_rate=0.001, room_burst=1)
+
+        async def job():
+            async with scheduler.slot("!room", "@user") as slot:
+                async with slot.yielded():
+                    await asyncio.sleep(0)
+
+        await asyncio.wait_for(job(), timeout=1)
+        # The room's one token went to the job; giving its slot up and taking it back did not throttle it.
+        self.assertEqual(scheduler.used, 0)
+        self.assertEqual(scheduler.waiting, 0)
+
+        waiting = asyncio.create_task(scheduler.acquire("!room", "@user"))
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+        waiting.cancel()
+
+    async def test_cancelled_job_does_not_wait_for_its_slot(self):
+        scheduler = FairScheduler(1)
+        entered = asyncio.Event()
+
+        async def job():
+            async with scheduler.slot("!room", "@user") as slot:
+                async with slot.yielded():
+                    entered.set()
+                    await asyncio.sleep(10)
+
+        task = asyncio.create_task(job())
+        await entered.wait()
+        # Another job takes the slot the first one gave up, and keeps it.
+        await scheduler.acquire("!room", "@other")
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(task, timeout=1)
+        self.assertEqual(scheduler.used, 1)
+        self.assertEqual(scheduler.waiting, 0)
+
+    async def test_shorter_quota_delay_moves_the_timer_earlier(self):
+        scheduler = FairScheduler(0, room_rate=0.01, room_burst=1, user_rate=0, user_burst=1)
+        await scheduler.acquire("!slow", "@user")
+        slow = asyncio.create_task(scheduler.acquire("!slow", "@user"))
+        await asyncio.sleep(0)
+        # The slow room waits 100 s for its next token; the fast one only 0.05 s.
+        scheduler.room_rate = 20
+        await scheduler.acquire("!fast", "@user")
+        fast = asyncio.create_task(scheduler.acquire("!fast", "@user"))
+        await asyncio.wait_for(fast, timeout=1)
+        self.assertFalse(slow.done())
+        slow.cancel()
+
+
+if __name__ == "__main__":
+    unittest.main()